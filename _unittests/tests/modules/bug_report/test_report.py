@@ -0,0 +1,57 @@
+import unittest
+from fairtest.modules.bug_report.report import *
+from fairtest.modules.context_discovery import guided_tree, tree_parser
+from fairtest.modules.metrics import NMI, CondNMI
+from fairtest.investigation import Feature, Target
+import numpy as np
+import pandas as pd
+
+
+class Stream(object):
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(str(line))
+
+
+class TestingReport(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        n = 2000
+        data = pd.DataFrame({'cat': np.random.randint(0, 4, n),
+                             'expl': np.random.randint(0, 3, n),
+                             'sens': np.random.randint(0, 2, n)})
+        data['out'] = (((data['cat'] == 1) & (data['sens'] == 1)) |
+                       (np.random.rand(n) < 0.3)).astype(int)
+        self.data = data
+        self.info = {'cat': Feature('context', 4),
+                     'expl': Feature('expl', 3),
+                     'sens': Feature('sens', 2)}
+        self.output = Target(np.array(['out']), arity=2)
+
+    def test_print_context_ct(self):
+        for (expl, metric) in [(None, NMI()), ('expl', CondNMI())]:
+            tree = guided_tree.build_tree(self.data, self.info, 'sens', expl,
+                                          self.output, metric, 0.95, 2, 200)
+            root = tree_parser.find_contexts(tree, self.data, self.info,
+                                             'sens', expl, self.output)[0]
+            stats = [0.01, 0.02, 0.5]
+            if expl:
+                stats = np.array([stats]*4)
+
+            stream = Stream()
+            namer = Namer('sens', expl, self.output, None)
+            print_context_ct(root, stats, 'NMI', namer, stream)
+
+            # the integer counts of the contingency table(s)
+            text = '\n'.join(stream.lines)
+            self.assertIn('|Total', text)
+            tables = [root.data] if expl is None else root.data
+            for table in tables:
+                self.assertIn('{}(100%)'.format(int(np.sum(table))), text)
+            self.assertIn('p-value = 5.00e-01', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
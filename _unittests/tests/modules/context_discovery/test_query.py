@@ -0,0 +1,83 @@
+import unittest
+from fairtest.modules.context_discovery.query import *
+from fairtest.modules.context_discovery import guided_tree, tree_parser
+from fairtest.modules.metrics import NMI, CORR
+from fairtest.investigation import Feature, Target
+from sklearn.preprocessing import LabelEncoder
+import numpy as np
+import pandas as pd
+import sqlite3
+
+
+class TestingQuery(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        n = 5000
+        raw = pd.DataFrame({
+            'city': np.random.choice(["O'Hare", 'Paris', 'Rome', 'Oslo'], n),
+            'age': np.random.randint(18, 80, n).astype(float),
+            'sex': np.random.choice(['F', 'M'], n)})
+        raw['out'] = np.where((raw['city'] == 'Paris') & (raw['sex'] == 'F') |
+                              (np.random.rand(n) < 0.3), 'yes', 'no')
+        self.raw = raw
+
+        self.encoders = {}
+        data = raw.copy()
+        for col in ['city', 'sex', 'out']:
+            self.encoders[col] = LabelEncoder()
+            data[col] = self.encoders[col].fit_transform(data[col])
+        self.data = data
+
+        self.info = {'city': Feature('context', 4),
+                     'age': Feature('context'),
+                     'sex': Feature('sens', 2)}
+        self.output = Target(np.array(['out']), arity=2)
+        self.tree = guided_tree.build_tree(data, self.info, 'sex', None,
+                                           self.output, NMI(), 0.95, 3, 200)
+
+    def test_compilers(self):
+        bound = Bound()
+        bound.lower = 30.5
+        path = {'age': bound, 'city': 0}
+        self.assertEqual(to_sql(path, self.encoders),
+                         '"age" > 30.5 AND "city" = \'O\'\'Hare\'')
+        self.assertEqual(to_pandas(path, self.encoders),
+                         '`age` > 30.5 and `city` == "O\'Hare"')
+        self.assertEqual(to_sql({}), '1 = 1')
+
+        contexts = tree_parser.find_contexts(self.tree, self.data, self.info,
+                                             'sex', None, self.output)
+        clauses, index = compile_contexts(contexts, self.encoders,
+                                          compiler=to_pandas)
+        self.assertEqual(len(clauses), len(set(clauses)))
+        for (context, idx) in zip(contexts, index):
+            self.assertEqual(len(self.raw.query(clauses[idx])), context.size)
+
+    def test_fetch_contexts(self):
+        connection = sqlite3.connect(':memory:')
+        self.raw.to_sql('decisions', connection, index=False)
+
+        contexts = tree_parser.find_contexts(self.tree, self.data, self.info,
+                                             'sex', None, self.output)
+        fetched = fetch_contexts(self.tree, connection, 'decisions',
+                                 self.info, 'sex', None, self.output,
+                                 self.encoders)
+        fetched = dict((context.num, context) for context in fetched)
+
+        self.assertEqual(len(contexts), len(fetched))
+        for context in contexts:
+            self.assertEqual(context.size, fetched[context.num].size)
+            self.assertTrue(np.allclose(context.data,
+                                        fetched[context.num].data))
+
+        # unsupported options and metrics
+        self.assertRaises(ValueError, fetch_contexts, self.tree, connection,
+                          'decisions', self.info, 'sex', None, self.output,
+                          self.encoders, prune_insignificant=True)
+        self.assertRaises(ValueError, fetch_contexts, self.tree, connection,
+                          'decisions', self.info, 'sex', None, self.output,
+                          self.encoders, new_metric=CORR())
+
+
+if __name__ == '__main__':
+    unittest.main()
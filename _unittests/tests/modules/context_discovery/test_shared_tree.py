@@ -0,0 +1,99 @@
+import unittest
+from fairtest.modules.context_discovery.guided_tree import build_tree, \
+    build_shared_tree
+from fairtest.modules.metrics import NMI, CORR
+from fairtest.investigation import Feature, Target
+import numpy as np
+import pandas as pd
+import random
+
+
+def node_key(node):
+    return '/'.join([n.name for n in node.get_ancestors()[::-1] + [node]])
+
+
+class TestingSharedTree(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        n = 10000
+        data = pd.DataFrame({'cat': np.random.randint(0, 4, n),
+                             'cont': np.random.rand(n),
+                             'sens1': np.random.randint(0, 2, n),
+                             'sens2': np.random.randint(0, 3, n)})
+        data['out'] = (((data['cat'] == 1) & (data['sens1'] == 1)) |
+                       ((data['cont'] < 0.3) & (data['sens2'] == 2)) |
+                       (np.random.rand(n) < 0.3)).astype(int)
+        self.data = data
+        self.info = {'cat': Feature('context', 4),
+                     'cont': Feature('context'),
+                     'sens1': Feature('sens', 2),
+                     'sens2': Feature('sens', 3)}
+        self.output = Target(np.array(['out']), arity=2)
+
+    def test_single_protected_feature(self):
+        # with one protected feature, the shared tree is the guided tree
+        data = self.data.drop('sens2', axis=1)
+        for metric in [NMI(), CORR()]:
+            random.seed(0)
+            tree = build_tree(data, self.info, 'sens1', None, self.output,
+                              metric, 0.95, 3, 200)
+            random.seed(0)
+            shared = build_shared_tree(data, self.info, ['sens1'], None,
+                                       self.output, {'sens1': metric},
+                                       0.95, 3, 200)['sens1']
+
+            nodes = dict((node_key(n), n) for n in tree.traverse())
+            shared_nodes = dict((node_key(n), n) for n in shared.traverse())
+            self.assertEqual(sorted(nodes.keys()), sorted(shared_nodes.keys()))
+            for (key, node) in nodes.items():
+                self.assertEqual(node.size, shared_nodes[key].size)
+                self.assertTrue(np.allclose(node.metric.stats,
+                                            shared_nodes[key].metric.stats))
+
+    def test_correlation_offset(self):
+        # the statistics of correlation metrics do not lose precision for
+        # targets with a large mean compared to their spread
+        data = self.data.drop('sens2', axis=1)
+        data['out'] = data['out'] + 0.1*np.random.rand(len(data))
+        shifted = data.copy()
+        shifted['out'] = shifted['out'] + 1e8
+
+        trees = []
+        for d in [data, shifted]:
+            random.seed(0)
+            trees.append(build_shared_tree(d, self.info, ['sens1'], None,
+                                           self.output, {'sens1': CORR()},
+                                           0.95, 3, 200)['sens1'])
+
+        nodes = [dict((node_key(n), n) for n in tree.traverse())
+                 for tree in trees]
+        self.assertEqual(sorted(nodes[0].keys()), sorted(nodes[1].keys()))
+        for (key, node) in nodes[0].items():
+            self.assertTrue(np.allclose(node.metric.stats,
+                                        nodes[1][key].metric.stats,
+                                        atol=1e-6))
+
+    def test_multiple_protected_features(self):
+        trees = build_shared_tree(self.data, self.info, ['sens1', 'sens2'],
+                                  None, self.output,
+                                  {'sens1': NMI(), 'sens2': NMI()},
+                                  0.95, 3, 200)
+        keys = [[node_key(n) for n in trees[sens].traverse()]
+                for sens in ['sens1', 'sens2']]
+        self.assertEqual(keys[0], keys[1])
+        self.assertTrue(len(keys[0]) > 1)
+
+        # protected features are not used for splits
+        for node in trees['sens1'].iter_descendants():
+            self.assertTrue(node.feature in ['cat', 'cont'])
+
+        # each tree holds the metrics of its own protected feature
+        for sens in ['sens1', 'sens2']:
+            ct = pd.crosstab(self.data['out'], self.data[sens]).values
+            self.assertTrue(np.allclose(trees[sens].metric.stats,
+                                        NMI().compute(ct, 0.95,
+                                                      exact=False).stats))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from fairtest.modules.context_discovery.table_cache import *
+from fairtest.modules.context_discovery.tree_parser import Bound
+import numpy as np
+import pandas as pd
+
+
+class TestingTableCache(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_lru(self):
+        cache = TableCache(max_size=2)
+        cache.lookup('a', lambda: np.zeros(2))
+        cache.lookup('b', lambda: np.ones(2))
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+        # tables are returned by copy
+        table = cache.lookup('a', lambda: None)
+        table += 10
+        self.assertTrue(np.all(cache.lookup('a', lambda: None) == 0))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        # 'b' is the least recently used table
+        cache.lookup('c', lambda: np.ones(2))
+        self.assertEqual(len(cache), 2)
+        cache.lookup('b', lambda: 2*np.ones(2))
+        self.assertEqual(cache.misses, 4)
+
+        cache.clear()
+        self.assertEqual((len(cache), cache.hits, cache.misses), (0, 0, 0))
+
+        with self.assertRaises(ValueError):
+            TableCache(max_size=0)
+
+    def test_keys(self):
+        data = pd.DataFrame(np.random.randint(0, 5, (100, 3)),
+                            columns=['a', 'b', 'c'])
+        self.assertEqual(fingerprint(data), fingerprint(data.copy()))
+
+        other = data.copy()
+        other.iloc[0, 0] += 1
+        self.assertNotEqual(fingerprint(data), fingerprint(other))
+
+        bound = Bound()
+        bound.upper = 3
+        self.assertEqual(path_key({'a': 1, 'b': bound}),
+                         path_key({'b': bound, 'a': 1}))
+        self.assertEqual(path_key(['a = 1', 'b <= 3']),
+                         path_key(['b <= 3', 'a = 1']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+from fairtest.modules.metrics.accumulator import *
+from fairtest.modules.metrics.correlation import correlation
+from fairtest.modules.metrics import NMI, CondDIFF, CORR, REGRESSION
+import numpy as np
+import pandas as pd
+
+
+class TestingAccumulator(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_table(self):
+        data = pd.DataFrame({'expl': np.random.randint(0, 3, 500),
+                             'out': np.random.randint(0, 2, 500),
+                             'sens': np.random.randint(0, 4, 500)})
+        records = data[['expl', 'out', 'sens']].values
+
+        acc = TableAccumulator((3, 2, 4)).update(records)
+        for k in range(3):
+            group = data[data['expl'] == k]
+            expected = pd.crosstab(group['out'], group['sens']).values
+            self.assertTrue(np.array_equal(acc.finalize()[k], expected))
+        self.assertTrue(np.array_equal(acc.size(),
+                                       data['expl'].value_counts().sort_index()))
+
+        # merging partial tables
+        parts = [TableAccumulator((3, 2, 4)).update(r)
+                 for r in np.array_split(records, 4)]
+        merged = parts[0]
+        for part in parts[1:]:
+            merged.merge(part)
+        self.assertTrue(np.array_equal(merged.finalize(), acc.finalize()))
+
+        self.assertRaises(ValueError, acc.merge, TableAccumulator((2, 4)))
+
+    def test_moments(self):
+        x = np.random.randn(1000)
+        y = 0.5*x + np.random.randn(1000)
+        data = np.column_stack((x, y))
+
+        acc = MomentAccumulator((6,))
+        for batch in np.array_split(data, 7):
+            acc.update(batch)
+        (sum_x, sum_x2, sum_y, sum_y2, sum_xy, n) = acc.finalize()
+        self.assertEqual(n, 1000)
+        self.assertAlmostEqual(sum_x, 0)
+        self.assertAlmostEqual(sum_x2, ((x - x.mean())**2).sum())
+        self.assertAlmostEqual(sum_xy, ((x - x.mean())*(y - y.mean())).sum())
+        self.assertAlmostEqual(correlation(acc.finalize()), correlation(data))
+
+        # statistics around a common shift are additive
+        parts = [MomentAccumulator((6,)).update(batch)
+                 for batch in np.array_split(data, 3)]
+        total = sum(part.finalize(shift=(1, 2)) for part in parts)
+        self.assertTrue(np.allclose(total, acc.finalize(shift=(1, 2))))
+        self.assertTrue(np.allclose(total, [(x-1).sum(), ((x-1)**2).sum(),
+                                            (y-2).sum(), ((y-2)**2).sum(),
+                                            ((x-1)*(y-2)).sum(), 1000]))
+
+        # merging, with empty accumulators
+        merged = MomentAccumulator((6,))
+        for part in parts + [MomentAccumulator((6,))]:
+            merged.merge(part)
+        self.assertTrue(np.allclose(merged.finalize(), acc.finalize()))
+
+    def test_groups(self):
+        groups = np.random.randint(0, 3, 600)
+        data = np.column_stack((groups, np.random.randn(600, 2)))
+        acc = MomentAccumulator((3, 6)).update(data[:250])
+        acc.merge(MomentAccumulator((3, 6)).update(data[250:]))
+        for k in range(3):
+            group = data[groups == k, 1:]
+            self.assertAlmostEqual(correlation(acc.finalize()[k]),
+                                   correlation(group))
+        self.assertTrue(np.array_equal(acc.size(), np.bincount(groups)))
+
+    def test_precision(self):
+        # large mean compared to the variance
+        x = 1e8 + np.random.rand(10000)
+        y = x + 0.1*np.random.rand(10000)
+        expected = np.corrcoef(x - 1e8, y - 1e8)[0, 1]
+
+        acc = MomentAccumulator((6,))
+        for batch in np.array_split(np.column_stack((x, y)), 10):
+            acc.update(batch)
+        self.assertAlmostEqual(correlation(acc.finalize()), expected,
+                               places=8)
+
+    def test_metrics(self):
+        self.assertEqual(NMI.accumulator_type, TableAccumulator)
+        self.assertEqual(CondDIFF.accumulator_type, TableAccumulator)
+        self.assertEqual(CORR.accumulator_type, MomentAccumulator)
+        self.assertIsNone(REGRESSION.accumulator_type)
+
+
+if __name__ == '__main__':
+    unittest.main()
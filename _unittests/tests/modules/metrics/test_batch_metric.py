@@ -0,0 +1,192 @@
+import unittest
+from fairtest.modules.metrics import *
+from fairtest.modules.metrics.binary_metrics import batch_difference
+from fairtest.modules.metrics.correlation import batch_correlation
+from fairtest.modules.context_discovery import guided_tree, tree_parser
+from fairtest.modules.monitoring.monitor import ContextMonitor
+from fairtest.modules.statistics.multiple_testing import compute_stats
+from fairtest.investigation import Feature, Target, metric_from_string
+import numpy as np
+import pandas as pd
+
+
+class RateGap(BatchMetric):
+    """
+    Difference of positive rates, as DIFF
+    """
+    dataType = Metric.DATATYPE_CT
+
+    @staticmethod
+    def stats_batch(data, conf):
+        return batch_difference(data, conf=conf)
+
+    @staticmethod
+    def statistic_batch(data):
+        return batch_difference(data)
+
+
+class Correlation(BatchMetric):
+    """
+    Pearson correlation, as CORR
+    """
+    dataType = Metric.DATATYPE_CORR
+
+    @staticmethod
+    def stats_batch(data, conf):
+        return batch_correlation(data, conf=conf)
+
+    @staticmethod
+    def statistic_batch(data):
+        return np.clip(batch_correlation(data), -1, 1)
+
+
+class MeanTarget(BatchMetric):
+    """
+    Mean of the target, which is not invariant to shifts of the data
+    """
+    dataType = Metric.DATATYPE_CORR
+
+    @staticmethod
+    def stats_batch(data, conf):
+        mean = MeanTarget.statistic_batch(data)
+        return mean - 0.1, mean + 0.1, np.ones(mean.shape)
+
+    @staticmethod
+    def statistic_batch(data):
+        data = np.asarray(data, dtype=float)
+        return data[..., 2] / data[..., 5]
+
+
+class TestingBatchMetric(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        n = 3000
+        data = pd.DataFrame({'cat': np.random.randint(0, 4, n),
+                             'sens': np.random.randint(0, 2, n)})
+        data['out'] = (((data['cat'] == 1) & (data['sens'] == 1)) |
+                       (np.random.rand(n) < 0.3)).astype(int)
+        self.data = data
+        self.info = {'cat': Feature('context', 4),
+                     'sens': Feature('sens', 2)}
+        self.output = Target(np.array(['out']), arity=2)
+
+    def test_same_as_builtin(self):
+        tables = np.random.randint(0, 50, (20, 2, 2))
+        for (metric, builtin) in [(RateGap(), DIFF()), (Correlation(), CORR())]:
+            if metric.dataType == Metric.DATATYPE_CT:
+                contexts = list(tables)
+            else:
+                contexts = [np.random.randn(200, 2) for _ in range(5)]
+                contexts.append(np.random.randn(1500, 2))
+
+            self.assertTrue(np.allclose(
+                metric.compute_batch(contexts, 0.95),
+                builtin.compute_batch(contexts, 0.95)))
+
+            # exact statistics derived from the kernels
+            for data in contexts[:3] + contexts[-1:]:
+                stats = metric.compute(data, 0.95, exact=True,
+                                       rng=np.random.RandomState(0)).stats
+                expected = builtin.compute(data, 0.95, exact=True,
+                                           rng=np.random.RandomState(0)).stats
+                self.assertTrue(np.allclose(stats, expected))
+                self.assertAlmostEqual(metric.abs_effect(),
+                                       builtin.abs_effect())
+
+    def test_tree_and_monitor(self):
+        trees = [guided_tree.build_tree(self.data, self.info, 'sens', None,
+                                        self.output, metric, 0.95, 2, 100)
+                 for metric in [RateGap(), DIFF()]]
+        contexts = [tree_parser.find_contexts(tree, self.data, self.info,
+                                              'sens', None, self.output)
+                    for tree in trees]
+        self.assertEqual([str(c.path) for c in contexts[0]],
+                         [str(c.path) for c in contexts[1]])
+
+        monitor = ContextMonitor(trees[0], self.info, 'sens', None,
+                                 self.output)
+        monitor.update(self.data)
+        stats = monitor.stats()
+        for context in contexts[1]:
+            self.assertTrue(np.allclose(
+                stats[context.num],
+                DIFF().approx_stats(np.array(context.data), 0.95)))
+
+    def test_shift(self):
+        # the kernels get the raw sums of the data
+        data = self.data.copy()
+        data['score'] = 5 + data['out'] + np.random.rand(len(data))
+        data['cont'] = np.random.rand(len(data))
+        info = dict(self.info)
+        info['out'] = Feature('context', 2)
+        info['cont'] = Feature('context')
+        output = Target(np.array(['score']))
+        metric = MeanTarget()
+
+        tree = guided_tree.build_tree(data, info, 'sens', None, output,
+                                      metric, 0.95, 2, 100)
+        contexts = tree_parser.find_contexts(tree, data, info, 'sens', None,
+                                             output)
+        monitor = ContextMonitor(tree, info, 'sens', None, output)
+        monitor.update(data)
+        stats = monitor.stats()
+
+        for context in contexts:
+            expected = np.array(context.data)[:, 0].mean()
+            self.assertGreater(expected, 5)
+            (ci_low, ci_high, _) = metric.approx_stats(context.data, 0.95)
+            self.assertAlmostEqual((ci_low + ci_high) / 2, expected)
+            self.assertAlmostEqual((stats[context.num][0] +
+                                    stats[context.num][1]) / 2, expected)
+
+        # statistics of the contexts sent to the testing workers
+        tested = compute_stats(contexts, False, 0.95, 0)['stats']
+        for (context, (ci_low, ci_high, _)) in zip(contexts, tested):
+            self.assertAlmostEqual((ci_low + ci_high) / 2,
+                                   np.array(context.data)[:, 0].mean())
+
+        # scores of the tree's nodes
+        self.assertAlmostEqual((tree.metric.stats[0] +
+                                tree.metric.stats[1]) / 2,
+                               data['score'].mean())
+        self.assertTrue(all(
+            (node.metric.stats[0] + node.metric.stats[1]) / 2 > 5
+            for node in tree.get_descendants()))
+
+    def test_registry(self):
+        self.assertIsInstance(metric_from_string('NMI'), NMI)
+        self.assertIsInstance(metric_from_string('CondCorr'), CondCORR)
+        metric = metric_from_string('REGRESSION', topk=3, candidates=5)
+        self.assertEqual((metric.topk, metric.candidates), (3, 5))
+        self.assertRaises(ValueError, metric_from_string, 'RateGap')
+
+        register_metric('RateGap', RateGap)
+        try:
+            self.assertIn('RateGap', registered_metrics())
+            self.assertIsInstance(metric_from_string('RateGap', topk=3),
+                                  RateGap)
+            self.assertRaises(ValueError, register_metric, 'RateGap', CORR)
+        finally:
+            unregister_metric('RateGap')
+        self.assertRaises(ValueError, get_metric, 'RateGap')
+
+        @register_metric('Gap')
+        def gap(**kwargs):
+            return RateGap()
+        try:
+            self.assertIsInstance(get_metric('Gap'), RateGap)
+        finally:
+            unregister_metric('Gap')
+
+    def test_declaration(self):
+        class NoKernel(BatchMetric):
+            dataType = Metric.DATATYPE_CT
+        self.assertRaises(ValueError, NoKernel)
+
+        class Regression(RateGap):
+            dataType = Metric.DATATYPE_REG
+        self.assertRaises(ValueError, Regression)
+
+
+if __name__ == '__main__':
+    unittest.main()
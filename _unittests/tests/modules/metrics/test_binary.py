@@ -59,6 +59,38 @@ class TestingMutualInfo(unittest.TestCase):
                          [[1000, 1000], [1000, 1000]]])
         self.assertAlmostEqual(cond_difference(data), 0, delta=0.02)
 
+    def test_batch_ratio(self):
+        tables = np.random.randint(0, 50, (20, 2, 2))
+        for (ct, rat) in zip(tables, batch_ratio(tables)):
+            self.assertAlmostEqual(rat, ratio(ct))
+
+    def test_batch_cond_diff(self):
+        tables = np.random.randint(0, 50, (20, 3, 2, 2))
+        cond_diffs = batch_cond_difference(tables)
+        self.assertEqual(cond_diffs.shape, (20,))
+        for (ct, cond_diff) in zip(tables, cond_diffs):
+            self.assertAlmostEqual(cond_diff, cond_difference(ct))
+            self.assertAlmostEqual(batch_difference(ct[0]), difference(ct[0]))
+
+        # empty strata
+        tables[3] = 0
+        self.assertEqual(batch_cond_difference(tables)[3], 0)
+
+    def test_compute_batch(self):
+        tables = np.random.randint(0, 50, (20, 2, 2))
+        tables[0] = [[1000, 0], [0, 1000]]
+        data = list(tables) + [np.array([[10, 20]])]
+        for metric in [DIFF(), RATIO()]:
+            (stats, metrics) = metric.compute_batch(data, 0.95,
+                                                    full_output=True)
+            self.assertEqual(stats.shape, (21, 4))
+            for (ct, row, m) in zip(data, stats, metrics):
+                expected = metric.compute(ct, conf=0.95, exact=False)
+                assertAlmostEqualTuples(self, row[0:3], expected.stats,
+                                        delta=1e-7)
+                self.assertAlmostEqual(row[3], expected.abs_effect())
+                self.assertAlmostEqual(m.abs_effect(), row[3])
+
     def test_approx_stats(self):
         data = np.array([[300, 150], [150, 300]])
 
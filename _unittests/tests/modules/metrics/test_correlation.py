@@ -40,6 +40,68 @@ class TestingMutualInfo(unittest.TestCase):
         assertAlmostEqualTuples(self, correlation(data, conf=0.95)[0:1], (0, 0),
                                 delta=0.03)
 
+    def test_batch_correlation(self):
+        data = np.random.rand(20, 50, 2)
+        sums = np.stack([data[:, :, 0].sum(axis=1),
+                         (data[:, :, 0]**2).sum(axis=1),
+                         data[:, :, 1].sum(axis=1),
+                         (data[:, :, 1]**2).sum(axis=1),
+                         (data[:, :, 0]*data[:, :, 1]).sum(axis=1),
+                         np.full(20, 50)], axis=1)
+        corrs = batch_correlation(sums)
+        for (d, corr) in zip(data, corrs):
+            self.assertAlmostEqual(corr, correlation(d, conf=None))
+
+        # degenerate
+        self.assertTrue(batch_correlation([0, 0, 0, 0, 0, 100]) == 0)
+
+    def test_compute_batch(self):
+        data = [np.random.rand(size, 2) for size in [2, 10, 50, 50, 100]]
+        data.append(np.ones((10, 2)))
+        stats = CORR().compute_batch(data, 0.95)
+        for (d, row) in zip(data, stats):
+            expected = CORR().compute(d, conf=0.95, exact=False)
+            assertAlmostEqualTuples(self, row[0:3], expected.stats,
+                                        delta=1e-7)
+            self.assertAlmostEqual(row[3], expected.abs_effect())
+
+        # aggregate statistics
+        sums = np.array([[d[:, 0].sum(), np.dot(d[:, 0], d[:, 0]),
+                          d[:, 1].sum(), np.dot(d[:, 1], d[:, 1]),
+                          np.dot(d[:, 0], d[:, 1]), len(d)] for d in data])
+        self.assertTrue(np.allclose(CORR().compute_batch(sums, 0.95), stats))
+
+    def test_precision(self):
+        # large values compared to their spread, in single precision
+        x = 1e4 + np.random.rand(100000)
+        data = np.column_stack((x, x + 0.5*np.random.rand(100000)))
+        data = data.astype(np.float32)
+        expected = np.corrcoef(data.astype(float).T)[0, 1]
+
+        self.assertAlmostEqual(correlation(data, conf=None), expected,
+                               places=6)
+        (ci_low, ci_high, _) = correlation(data, conf=0.95)
+        self.assertTrue(ci_low < expected < ci_high < 1)
+
+        moments = centered_moments(np.stack((data, data[::-1])))
+        self.assertEqual(moments.shape, (2, 6))
+        self.assertTrue(np.allclose(batch_correlation(moments), expected))
+        self.assertEqual(float_array(data).dtype, np.float32)
+
+    def test_exact_ci_offset(self):
+        # bootstrap confidence intervals of data with a large mean compared
+        # to its spread
+        x = np.random.randint(0, 2, 800).astype(float)
+        y = 0.4*x + np.random.randn(800)
+        data = np.column_stack((y, x))
+        expected = CORR.exact_ci(data, 0.95, rng=np.random.RandomState(0))
+        self.assertTrue(0 < expected[0] < expected[1])
+
+        for offset in [1e6, 1e8]:
+            shifted = np.column_stack((y + offset, x))
+            ci = CORR.exact_ci(shifted, 0.95, rng=np.random.RandomState(0))
+            self.assertTrue(np.allclose(ci, expected, atol=1e-3))
+
     def test_approx_stats(self):
         data = np.random.rand(100, 2)
         data = pd.DataFrame(data)
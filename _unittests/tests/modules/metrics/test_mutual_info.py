@@ -54,6 +54,17 @@ class TestingMutualInfo(unittest.TestCase):
                                               exact=False).stats[0:1],
                                 delta=0.01)
 
+    def test_compute_batch(self):
+        tables = np.random.randint(0, 50, (20, 3, 2))
+        tables[0] = 0
+        tables[1, 0] = 0
+        stats = NMI().compute_batch(tables, 0.95)
+        for (ct, row) in zip(tables, stats):
+            expected = NMI().compute(ct, conf=0.95, exact=False)
+            self.assertAlmostEqual(row[0], expected.stats[0])
+            self.assertAlmostEqual(row[2], expected.stats[2])
+            self.assertAlmostEqual(row[3], expected.abs_effect())
+
     def test_corner_cases_cond_mi(self):
         # degenerate 1
         data = np.array([[[100, 0]]])
@@ -75,5 +86,37 @@ class TestingMutualInfo(unittest.TestCase):
         self.assertAlmostEqual(cond_mutual_info(data, norm=False), 0,
                                delta=0.02)
 
+    def test_batch_cond_mi(self):
+        tables = np.random.randint(0, 50, (20, 3, 4, 2))
+        for norm in [True, False]:
+            cond_mis = batch_cond_mutual_info(tables, norm=norm)
+            self.assertEqual(cond_mis.shape, (20,))
+            for (ct, cond_mi) in zip(tables, cond_mis):
+                self.assertAlmostEqual(cond_mi, cond_mutual_info(ct, norm))
+
+        # degenerate
+        self.assertTrue(batch_cond_mutual_info(np.array([[[100, 0]]])) == 0)
+        self.assertTrue(batch_cond_mutual_info(np.zeros((3, 4, 2))) == 0)
+
+    def test_cond_nmi(self):
+        data = np.random.randint(0, 200, (3, 2, 3))
+        data[0] *= 10
+
+        # approximate statistics of the whole context and of each sub-group
+        stats = CondNMI().compute(data, 0.95, exact=False).stats
+        self.assertEqual(stats.shape, (4, 3))
+        self.assertTrue(np.allclose(stats[0], cond_mutual_info(data,
+                                                               conf=0.95)))
+        for (ct, row) in zip(data, stats[1:]):
+            self.assertTrue(np.allclose(row, mutual_info(ct, conf=0.95)))
+
+        # exact statistics, with intervals of the sub-groups taken from the
+        # bootstrap samples of the whole context
+        stats = CondNMI().compute(data, 0.95, exact=True,
+                                  rng=np.random.RandomState(0)).stats
+        for (ct, row) in zip(data, stats[1:]):
+            expected = NMI().compute(ct, 0.95, exact=True).stats
+            assertAlmostEqualTuples(self, row, expected, delta=0.01)
+
 if __name__ == '__main__':
     unittest.main()
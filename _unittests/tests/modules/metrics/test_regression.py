@@ -3,6 +3,8 @@ from fairtest.modules.metrics.regression import *
 import rpy2.robjects as ro
 from rpy2.robjects import numpy2ri
 import numpy as np
+import pandas as pd
+from copy import copy
 
 
 class TestingRegression(unittest.TestCase):
@@ -20,15 +22,147 @@ class TestingRegression(unittest.TestCase):
         data[data.columns[-1]] = np.random.randint(0, 2, NUM_SAMPLES)
 
         stats = REGRESSION(topk=100).compute(data, conf=0.95).stats
-        stats = stats.reset_index(drop=True)
-        count = 0
-        for idx in stats.index:
-            if stats.iloc[idx][2] <= 0.05:
-                count += 1
+        count = np.sum(stats['pval'] <= 0.05)
 
         # we expect roughly 5% of the p-values to be significant
         self.assertTrue(0.025 <= count/(1.0 * NUM_SAMPLES) <= 0.075)
 
+    def test_inverse_diagonal(self):
+        labels = (np.random.rand(500, 30) < 0.2).astype(float)
+        labels[:, 3] = 0
+        gram = labels.T.dot(labels)
+        self.assertTrue(np.allclose(inverse_diagonal(gram),
+                                    np.diag(np.linalg.pinv(gram))))
+
+        # collinear labels fall back to the pseudo-inverse
+        labels[:, 4] = labels[:, 5]
+        gram = labels.T.dot(labels)
+        self.assertTrue(np.allclose(inverse_diagonal(gram),
+                                    np.diag(np.linalg.pinv(gram))))
+
+    def test_sparse_labels(self):
+        labels = (np.random.rand(1000, 20) < 0.1).astype(float)
+        data = pd.DataFrame(labels)
+        data[20] = np.random.randint(0, 2, 1000)
+        sparse_data = data[data.columns[:-1]].astype(
+            pd.SparseDtype(float, 0))
+        sparse_data[20] = data[20]
+
+        self.assertEqual(label_matrix(sparse_data[sparse_data.columns[:-1]]
+                                      ).format, 'csr')
+        dense = REGRESSION(topk=5).compute(data, conf=0.95)
+        sparse = REGRESSION(topk=5).compute(sparse_data, conf=0.95)
+        self.assertTrue(np.allclose(dense.fit_state.gram,
+                                    sparse.fit_state.gram))
+        self.assertTrue(np.allclose(dense.fit_state.coef,
+                                    sparse.fit_state.coef, atol=1e-3))
+
+    def test_child_metric(self):
+        labels = (np.random.rand(1000, 20) < 0.1).astype(float)
+        data = pd.DataFrame(labels)
+        data[20] = np.random.randint(0, 2, 1000)
+        parent = REGRESSION(topk=5).compute(data, conf=0.95)
+
+        # the Gram matrix is updated from the parent's, and the fit is
+        # warm-started from the parent's coefficients
+        for rows in [np.arange(700), np.arange(300)]:
+            child = parent.child_metric().compute(data.iloc[rows], conf=0.95)
+            cold = REGRESSION(topk=5).compute(data.iloc[rows], conf=0.95)
+            self.assertTrue(np.allclose(child.fit_state.gram,
+                                        cold.fit_state.gram))
+            self.assertTrue(np.allclose(child.fit_state.coef,
+                                        cold.fit_state.coef, atol=1e-2))
+            self.assertIsNone(child.parent_state)
+
+        # contexts of a trained metric do not share their statistics
+        contexts = [copy(parent).compute(data.iloc[rows], conf=0.95)
+                    for rows in [np.arange(500), np.arange(500, 1000)]]
+        self.assertFalse(np.array_equal(contexts[0].stats['pval'],
+                                        contexts[1].stats['pval']))
+
+    def test_screening(self):
+        sens = np.random.randint(0, 2, 2000)
+        labels = (np.random.rand(2000, 100) < 0.2).astype(float)
+        # labels associated with the protected feature
+        for col in [7, 42, 63]:
+            labels[:, col] = np.where(np.random.rand(2000) < 0.3, sens,
+                                      labels[:, col])
+
+        columns = screen_labels(labels, sens, 10)
+        self.assertEqual(len(columns), 10)
+        self.assertTrue(set([7, 42, 63]) <= set(columns))
+
+        # same z-scores as the DIFF metric on each label
+        z_scores = []
+        for col in range(100):
+            ct = pd.crosstab(labels[:, col], sens).values
+            (ci_low, ci_high, _) = DIFF().compute(ct, conf=0.95,
+                                                  exact=False).stats
+            z_scores.append(abs(ci_low + ci_high) / (ci_high - ci_low))
+        expected = np.sort(np.argsort(-np.array(z_scores),
+                                      kind='mergesort')[:10])
+        self.assertTrue(np.array_equal(columns, expected))
+
+        # the regression only fits the candidates, and reports the positions
+        # of the labels in the data
+        data = pd.DataFrame(labels)
+        data[100] = sens
+        metric = REGRESSION(topk=3, candidates=10).compute(data, conf=0.95)
+        self.assertTrue(np.array_equal(metric.fit_state.columns, columns))
+        self.assertEqual(set(metric.stats['label']), set([7, 42, 63]))
+
+        # sub-contexts fitted on other candidates
+        child = metric.child_metric().compute(data.iloc[:1500], conf=0.95)
+        cold = REGRESSION(topk=3, candidates=10).compute(data.iloc[:1500],
+                                                         conf=0.95)
+        self.assertTrue(np.allclose(child.fit_state.gram,
+                                    cold.fit_state.gram))
+        self.assertTrue(np.array_equal(child.stats['label'],
+                                       cold.stats['label']))
+
+        self.assertRaises(ValueError, REGRESSION, topk=10, candidates=5)
+
+    def test_label_stats(self):
+        sens = np.random.randint(0, 2, 2000)
+        labels = (np.random.rand(2000, 8) < 0.3).astype(float)
+        labels[:, 2] = sens
+        labels[:, 5] = 0
+        data = pd.DataFrame(labels)
+        data[8] = sens
+
+        tables = label_tables(labels, sens)
+        self.assertEqual(tables.shape, (8, 2, 2))
+        self.assertTrue(np.array_equal(
+            tables[0], pd.crosstab(labels[:, 0], sens).values))
+
+        # labels should be binary
+        self.assertRaises(ValueError, label_tables, 2*labels, sens)
+
+        # same statistics as DIFF on the crosstab of each label, with
+        # approximate statistics for large data and exact ones otherwise
+        metric = REGRESSION(topk=8).compute(data, conf=0.95)
+        for rows in [np.arange(2000), np.arange(300)]:
+            context = copy(metric).compute(data.iloc[rows], conf=0.95,
+                                           exact=True,
+                                           rng=np.random.RandomState(0))
+            rng = np.random.RandomState(0)
+            self.assertTrue(np.array_equal(context.stats['label'],
+                                           metric.stats['label']))
+            for (idx, row) in zip(metric.stats['label'], context.stats):
+                ct = pd.crosstab(data.iloc[rows][idx],
+                                 data.iloc[rows][8]).values
+                expected = DIFF().compute(ct, conf=0.95, exact=True,
+                                          rng=rng).stats
+                self.assertTrue(np.allclose(
+                    [row['ci_low'], row['ci_high'], row['pval']], expected))
+
+        # a context with a single protected value
+        context = copy(metric).compute(data[data[8] == 0], conf=0.95,
+                                       exact=False)
+        self.assertTrue(np.all(context.stats['ci_low'] == 0))
+        self.assertTrue(np.all(context.stats['ci_high'] == 1))
+        self.assertTrue(np.all(context.stats['pval'] == 1))
+
+
 if __name__ == '__main__':
     unittest.main()
-
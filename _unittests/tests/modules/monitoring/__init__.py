@@ -0,0 +1,3 @@
+"""
+Unit Tests for Monitoring Module
+"""
@@ -0,0 +1,81 @@
+import unittest
+from fairtest.modules.monitoring.monitor import *
+from fairtest.modules.monitoring.window import SlidingWindow
+from fairtest.modules.context_discovery import guided_tree, tree_parser
+from fairtest.modules.metrics import NMI, CORR
+from fairtest.investigation import Feature, Target
+import numpy as np
+import pandas as pd
+
+
+class TestingMonitor(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        n = 5000
+        data = pd.DataFrame({'cat': np.random.randint(0, 4, n),
+                             'cont': np.random.rand(n),
+                             'sens': np.random.randint(0, 2, n)})
+        data['out'] = (((data['cat'] == 1) & (data['sens'] == 1)) |
+                       (np.random.rand(n) < 0.3)).astype(int)
+        self.data = data
+        self.info = {'cat': Feature('context', 4),
+                     'cont': Feature('context'),
+                     'sens': Feature('sens', 2)}
+        self.output = Target(np.array(['out']), arity=2)
+
+    def test_batches_match_full_data(self):
+        for metric in [NMI(), CORR()]:
+            tree = guided_tree.build_tree(self.data, self.info, 'sens', None,
+                                          self.output, metric, 0.95, 3, 200)
+            contexts = tree_parser.find_contexts(tree, self.data, self.info,
+                                                 'sens', None, self.output)
+            monitor = ContextMonitor(tree, self.info, 'sens', None,
+                                     self.output)
+            for rows in np.array_split(np.arange(len(self.data)), 7):
+                monitor.update(self.data.iloc[rows])
+            stats = monitor.stats()
+
+            self.assertEqual(len(contexts), len(monitor.contexts))
+            for context in contexts:
+                online = monitor.contexts[context.num]
+                self.assertEqual(context.size, online.size)
+                self.assertEqual(str(context.path), str(online.path))
+
+                if metric.dataType == Metric.DATATYPE_CT:
+                    self.assertTrue(np.allclose(np.array(context.data),
+                                                online.data))
+                    expected = metric.approx_stats(online.data, 0.95)
+                    self.assertTrue(np.allclose(stats[context.num], expected))
+                else:
+                    # sums around the means of the first batch
+                    data = np.array(context.data)
+                    (shift_x, shift_y) = monitor.shift
+                    self.assertAlmostEqual(online.data[0],
+                                           (data[:, 1] - shift_x).sum())
+                    self.assertAlmostEqual(online.data[2],
+                                           (data[:, 0] - shift_y).sum())
+                    self.assertAlmostEqual(stats[context.num][2],
+                                           metric.approx_stats(data, 0.95)[2])
+
+            monitor.reset()
+            self.assertTrue(all(s is None for s in monitor.stats()))
+
+    def test_sliding_window(self):
+        tree = guided_tree.build_tree(self.data, self.info, 'sens', None,
+                                      self.output, NMI(), 0.95, 3, 200)
+        monitor = ContextMonitor(tree, self.info, 'sens', None, self.output,
+                                 window=SlidingWindow(2))
+        batches = np.array_split(np.arange(len(self.data)), 5)
+        for rows in batches:
+            monitor.advance()
+            monitor.update(self.data.iloc[rows])
+
+        # only the last two batches are in the window
+        last = self.data.iloc[np.concatenate(batches[-2:])]
+        self.assertEqual(monitor.sizes()[0], len(last))
+        expected = pd.crosstab(last['out'], last['sens']).values
+        self.assertTrue(np.allclose(monitor.values()[0], expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+from fairtest.modules.monitoring.window import *
+import numpy as np
+
+
+class TestingWindow(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.buckets = [np.random.randint(0, 100, (3, 2, 2))
+                        for _ in range(5)]
+
+    def fill(self, window):
+        for bucket in self.buckets:
+            window.add(bucket)
+            window.advance()
+
+    def test_cumulative(self):
+        window = CumulativeWindow()
+        self.assertTrue(window.total() is None)
+        self.fill(window)
+        self.assertTrue(np.allclose(window.total(), sum(self.buckets)))
+
+    def test_tumbling(self):
+        window = TumblingWindow(2)
+        for bucket in self.buckets[:3]:
+            window.add(bucket)
+            window.advance()
+        window.add(self.buckets[3])
+        self.assertTrue(np.allclose(window.total(),
+                                    self.buckets[2] + self.buckets[3]))
+
+    def test_sliding(self):
+        window = SlidingWindow(3)
+        self.fill(window)
+        # the current bucket is empty
+        self.assertTrue(np.allclose(window.total(),
+                                    self.buckets[3] + self.buckets[4]))
+        window.add(self.buckets[0])
+        self.assertTrue(np.allclose(window.total(),
+                                    self.buckets[3] + self.buckets[4] +
+                                    self.buckets[0]))
+
+    def test_decayed(self):
+        window = DecayedWindow(half_life=1)
+        self.fill(window)
+        expected = sum(b * 0.5 ** (5 - i) for (i, b) in enumerate(self.buckets))
+        self.assertTrue(np.allclose(window.total(), expected))
+
+        window.reset()
+        self.assertTrue(window.total() is None)
+
+        with self.assertRaises(ValueError):
+            DecayedWindow(half_life=0)
+        with self.assertRaises(ValueError):
+            SlidingWindow(0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+from fairtest.modules.statistics.confidence_interval import *
+from fairtest.modules.metrics.mutual_info import mutual_info, \
+    batch_mutual_info, cond_mutual_info, batch_cond_mutual_info
+import numpy as np
+import scipy.stats as stats
+
+
+class TestingConfidenceInterval(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_ci_mi(self):
+        g = np.array([0.01, 0.5, 3.0, 10.0, 150.0, 2000.0])
+        dof = np.array([1, 2, 1, 4, 6, 12])
+        for p in [0.005, 0.025, 0.975, 0.995]:
+            self.assertTrue(np.allclose(chi2_noncentrality(g, dof, p),
+                                        special.chndtrinc(g, dof, p),
+                                        rtol=1e-7, atol=1e-7))
+
+        (ci_low, ci_high) = ci_mi(g, dof, 1000, 0.95)
+        for i in range(len(g)):
+            (low, high) = ci_mi(g[i], dof[i], 1000, 0.95)
+            self.assertAlmostEqual(ci_low[i], low)
+            self.assertAlmostEqual(ci_high[i], high)
+
+        # coarser tolerance
+        (ci_low_approx, _) = ci_mi(g, dof, 1000, 0.95, tol=1e-3)
+        self.assertTrue(np.allclose(ci_low_approx, ci_low, atol=1e-3))
+
+    def test_bootstrap_ci_ct(self):
+        data = np.array([[30, 20], [22, 28]])
+        ci = bootstrap_ci_ct(data, lambda ct: mutual_info(ct, norm=True),
+                             num_samples=2000)
+        vec_ci = bootstrap_ci_ct(data, batch_mutual_info, vectorized=True)
+        for (low, high) in zip(ci, vec_ci):
+            self.assertAlmostEqual(low, high, delta=0.01)
+
+    def test_bootstrap_ci_ct_cond(self):
+        data = np.array([[[30, 20], [22, 28]], [[40, 45], [30, 50]]])
+        ci = bootstrap_ci_ct_cond(data, cond_mutual_info, num_samples=2000)
+        vec_ci = bootstrap_ci_ct_cond(data, batch_cond_mutual_info,
+                                      vectorized=True)
+        for (low, high) in zip(ci, vec_ci):
+            self.assertAlmostEqual(low, high, delta=0.01)
+
+    def test_bootstrap_ci_ct_strata(self):
+        data = np.array([[[30, 20], [22, 28]], [[40, 45], [30, 50]]])
+        (ci_low, ci_high) = bootstrap_ci_ct_strata(
+            data, batch_mutual_info, rng=np.random.RandomState(0))
+        self.assertEqual(ci_low.shape, (3,))
+
+        # same samples as for the weighted average
+        expected = bootstrap_ci_ct_cond(data, batch_cond_mutual_info,
+                                        vectorized=True,
+                                        rng=np.random.RandomState(0))
+        self.assertTrue(np.allclose((ci_low[0], ci_high[0]), expected))
+
+        for (ct, low, high) in zip(data, ci_low[1:], ci_high[1:]):
+            ci = bootstrap_ci_ct(ct, batch_mutual_info, vectorized=True)
+            self.assertAlmostEqual(low, ci[0], delta=0.01)
+            self.assertAlmostEqual(high, ci[1], delta=0.01)
+
+    def test_bootstrap_ci_corr(self):
+        x = np.random.randint(0, 2, 500)
+        y = 0.3*x + np.random.randn(500)
+
+        def batch_corr(sums):
+            (sum_x, sum_x2, sum_y, sum_y2, sum_xy, n) = sums.T
+            return (n*sum_xy - sum_x*sum_y) / \
+                np.sqrt((n*sum_x2 - sum_x**2) * (n*sum_y2 - sum_y**2))
+
+        ci = bootstrap_ci_corr(x, y, lambda a, b: stats.pearsonr(a, b)[0],
+                               num_samples=2000)
+        vec_ci = bootstrap_ci_corr(x, y, batch_corr, vectorized=True,
+                                   max_cells=10000)
+        for (low, high) in zip(ci, vec_ci):
+            self.assertAlmostEqual(low, high, delta=0.02)
+
+    def test_rng(self):
+        data = np.array([[30, 20], [22, 28]])
+        cis = [bootstrap_ci_ct(data, batch_mutual_info, vectorized=True,
+                               rng=np.random.default_rng(seed))
+               for seed in [1, 1, 2]]
+        self.assertEqual(cis[0], cis[1])
+        self.assertNotEqual(cis[0], cis[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+from fairtest.modules.statistics.cost_model import *
+from fairtest.modules.metrics import NMI, DIFF, CORR, CondDIFF
+import numpy as np
+
+
+class TestingCostModel(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_expected_mc_samples(self):
+        self.assertEqual(expected_mc_samples(), 10000)
+        self.assertEqual(expected_mc_samples(0.5), 200)
+        self.assertEqual(expected_mc_samples(0.001), 10000)
+
+        # early rejection of significant tests
+        self.assertLess(expected_mc_samples(0.0, alpha=0.01), 10000)
+        self.assertGreater(expected_mc_samples(0.0, alpha=0.001),
+                           expected_mc_samples(0.0, alpha=0.01))
+
+    def test_estimate_cost(self):
+        small = np.array([[10, 20, 5], [15, 8, 12]])
+        large = 100*small
+        self.assertLess(estimate_cost(NMI(), small, False, 0.95),
+                        estimate_cost(NMI(), small, True, 0.95))
+
+        # large tables are handled with asymptotic methods
+        self.assertEqual(estimate_cost(DIFF(), large[:, :2], True, 0.95),
+                         estimate_cost(DIFF(), large[:, :2], False, 0.95))
+
+        # sequential tests are cheaper for insignificant contexts
+        self.assertLess(estimate_cost(NMI(), small, True, 0.95, pval=0.5),
+                        estimate_cost(NMI(), small, True, 0.95, pval=0.06))
+
+        data = np.random.randn(500, 2)
+        self.assertLess(estimate_cost(CORR(), data[:100], True, 0.95),
+                        estimate_cost(CORR(), data, True, 0.95))
+
+        cost = estimate_cost(CondDIFF(), [small[:, :2], large[:, :2]], True,
+                             0.95)
+        self.assertGreater(cost, estimate_cost(NMI(), small[:, :2], True,
+                                               0.95))
+
+    def test_plan(self):
+        tables = [np.random.randint(5, 60, (2, 3)) for _ in range(5)]
+        metrics = [NMI() for _ in tables]
+        confs = [0.95]*len(tables)
+
+        self.assertEqual(plan(metrics, tables, confs, 1000), [True]*5)
+        self.assertEqual(plan(metrics, tables, confs, 0), [False]*5)
+
+        # the smallest contexts use exact methods first
+        cost = estimate_cost(NMI(), tables[0], True, 0.95)
+        exact = plan(metrics, tables, confs, 2.5*cost)
+        self.assertTrue(0 < sum(exact) < 5)
+        sizes = [t.sum() for t in tables]
+        self.assertLessEqual(max(s for (s, e) in zip(sizes, exact) if e),
+                             min(s for (s, e) in zip(sizes, exact) if not e))
+
+
+if __name__ == '__main__':
+    unittest.main()
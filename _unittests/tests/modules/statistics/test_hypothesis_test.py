@@ -0,0 +1,233 @@
+import unittest
+from fairtest.modules.statistics.hypothesis_test import *
+from scipy.special import xlogy, gammaln
+import numpy as np
+import itertools
+
+
+def exact_mi_pval_2x2(data):
+    """
+    Exact permutation p-value for the mutual information of a 2x2 table
+    """
+    (rows, cols, n) = (data.sum(axis=1), data.sum(axis=0), data.sum())
+
+    def stat(a):
+        table = np.array([[a, rows[0]-a], [cols[0]-a, rows[1]-cols[0]+a]])
+        return xlogy(table, table).sum()
+
+    support = range(max(0, cols[0]-rows[1]), min(rows[0], cols[0])+1)
+    return sum([stats.hypergeom.pmf(a, n, rows[0], cols[0])
+                for a in support if stat(a) >= stat(data[0, 0]) - 1e-9])
+
+
+def exact_mi_pval(data):
+    """
+    Exact permutation p-value for the mutual information of a table, by
+    enumeration of all tables with the same margins
+    """
+    (rows, cols, n) = (data.sum(axis=1), data.sum(axis=0), data.sum())
+
+    def tables(rows, cols):
+        if len(rows) == 1:
+            yield [cols]
+            return
+        for first in itertools.product(*[range(min(rows[0], c) + 1)
+                                         for c in cols]):
+            if sum(first) == rows[0]:
+                for rest in tables(rows[1:], [c - x for (c, x) in
+                                              zip(cols, first)]):
+                    yield [list(first)] + rest
+
+    stat_0 = xlogy(data, data).sum()
+    pval = 0
+    for table in tables(list(rows), list(cols)):
+        table = np.array(table)
+        if xlogy(table, table).sum() >= stat_0 - 1e-9:
+            pval += np.exp(gammaln(rows + 1).sum() + gammaln(cols + 1).sum() -
+                           gammaln(n + 1) - gammaln(table + 1).sum())
+    return pval
+
+
+class TestingHypothesisTest(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_g_test(self):
+        tables = np.random.randint(0, 8, (50, 3, 4))
+        tables[::5, 0, :] = 0
+        tables[::7, :, 1:] = 0
+        tables[::9] = 0
+
+        for correction in [False, True]:
+            (g, pval, dof) = g_test_batch(tables, correction=correction)
+            for (i, data) in enumerate(tables):
+                # zero rows and columns are ignored
+                reduced = data[data.sum(axis=1) > 0][:, data.sum(axis=0) > 0]
+                if not reduced.size:
+                    self.assertEqual((g[i], pval[i], dof[i]), (0, 1.0, 1))
+                    continue
+
+                expected = stats.chi2_contingency(
+                    reduced, correction=correction,
+                    lambda_="log-likelihood")
+                self.assertAlmostEqual(g[i], expected[0])
+                self.assertAlmostEqual(pval[i], expected[1])
+                self.assertEqual(dof[i], expected[2])
+
+                (g_i, pval_i, dof_i, _) = g_test(data, correction=correction)
+                self.assertAlmostEqual(g_i, expected[0])
+                self.assertAlmostEqual(pval_i, expected[1])
+                self.assertEqual(dof_i, expected[2])
+
+        data = np.array([[12, 10, 0], [9, 14, 0]])
+        expected = stats.chi2_contingency(data[:, :2], correction=False,
+                                          lambda_="log-likelihood")
+        self.assertTrue(np.allclose(g_test(data)[:3], expected[:3]))
+
+    def test_xlogx(self):
+        counts = np.array([0, 1, 2, 10, XLOGX_TABLE_SIZE-1, XLOGX_TABLE_SIZE,
+                           10*XLOGX_TABLE_SIZE])
+        self.assertTrue(np.allclose(xlogx(counts), xlogy(counts, counts),
+                                    rtol=1e-14))
+        self.assertTrue(np.array_equal(xlogx(counts),
+                                       xlogx(counts.astype(float))))
+        self.assertEqual(xlogx(counts.reshape(7, 1)).shape, (7, 1))
+
+        self.assertTrue(np.array_equal(as_counts(np.array([1.0, 3.0])),
+                                       [1, 3]))
+        self.assertIsNone(as_counts(np.array([1.0, 2.5])))
+
+        # integer and fractional tables give the same G-test
+        tables = np.random.randint(0, 1000, (20, 3, 2))
+        (g, pval, dof) = g_test_batch(tables)
+        (g_f, pval_f, dof_f) = g_test_batch(tables + 1e-12)
+        self.assertTrue(np.allclose(g, g_f))
+        self.assertTrue(np.allclose(pval, pval_f))
+        self.assertTrue(np.array_equal(dof, dof_f))
+
+    def test_sample_tables(self):
+        data = np.array([[30, 20, 5], [10, 25, 8]])
+        tables = sample_tables(data, 10000)
+        self.assertEqual(tables.shape, (10000, 2, 3))
+        self.assertTrue(np.all(tables.sum(axis=2) == data.sum(axis=1)))
+        self.assertTrue(np.all(tables.sum(axis=1) == data.sum(axis=0)))
+
+        expected = np.outer(data.sum(axis=1), data.sum(axis=0)) / \
+            (1.0*data.sum())
+        self.assertTrue(np.allclose(tables.mean(axis=0), expected, atol=0.2))
+
+        # empty rows and columns
+        data = np.array([[5, 0], [0, 0]])
+        self.assertTrue(np.all(sample_tables(data, 10) == data))
+
+    def test_permutation_test_ct2(self):
+        for data in [np.array([[12, 10], [9, 14]]),
+                     np.array([[40, 25], [20, 35]])]:
+            self.assertAlmostEqual(permutation_test_ct2(data),
+                                   exact_mi_pval_2x2(data), delta=0.01)
+
+        # strong dependency
+        data = np.array([[30000, 20000, 5000], [10000, 25000, 8000]])
+        self.assertEqual(permutation_test_ct2(data, num_samples=1000), 0.001)
+
+    def test_permutation_test_ct_cond(self):
+        data = np.array([[[30, 20], [22, 28]], [[40, 45], [30, 50]]])
+        stat = lambda ct: abs(np.average([ct[i][0, 0] - ct[i][1, 1]
+                                          for i in range(len(ct))]))
+        vec_stat = lambda cts: np.abs(np.mean(cts[:, :, 0, 0] -
+                                              cts[:, :, 1, 1], axis=1))
+        pval = permutation_test_ct_cond(data, stat, num_samples=2000)
+        vec_pval = permutation_test_ct_cond(data, vec_stat, vectorized=True)
+        self.assertAlmostEqual(pval, vec_pval, delta=0.03)
+
+    def test_exact_test_ct(self):
+        # 2x2 tables
+        for data in [np.array([[12, 10], [9, 14]]),
+                     np.array([[40, 25], [20, 35]]),
+                     np.array([[60, 20], [22, 58]])]:
+            self.assertAlmostEqual(exact_test_ct(data),
+                                   exact_mi_pval_2x2(data))
+
+        # network algorithm
+        data = np.array([[12, 10], [9, 14]])
+        self.assertAlmostEqual(exact_test_ct(np.hstack((data, [[0], [0]])),
+                                             max_size=10000),
+                               exact_mi_pval_2x2(data))
+        for data in [np.array([[5, 3, 7], [2, 8, 4]]),
+                     np.array([[5, 3, 7], [2, 8, 4], [6, 1, 3]])]:
+            self.assertAlmostEqual(exact_test_ct(data),
+                                   permutation_test_ct(data), delta=0.01)
+
+        for data in [np.array([[3, 1, 2], [0, 4, 1], [2, 2, 0]]),
+                     np.array([[2, 0, 3, 1], [1, 4, 0, 2]]),
+                     np.array([[2, 1, 0, 1], [0, 2, 1, 1], [1, 0, 3, 0]])]:
+            self.assertAlmostEqual(exact_test_ct(data),
+                                   exact_mi_pval(data))
+
+        # larger tables remain exact (deterministic)
+        data = np.random.RandomState(0).multinomial(
+            60, np.ones(16) / 16.).reshape(4, 4)
+        self.assertEqual(exact_test_ct(data, rng=np.random.RandomState(0)),
+                         exact_test_ct(data, rng=np.random.RandomState(1)))
+
+        # fall-back to Monte-Carlo sampling
+        data = np.array([[5, 3, 7], [2, 8, 4], [6, 1, 3]])
+        self.assertAlmostEqual(exact_test_ct(data, max_size=10),
+                               exact_test_ct(data), delta=0.05)
+        self.assertEqual(exact_test_ct(data, full_output=True)[1], 0)
+        self.assertGreater(exact_test_ct(data, max_size=10,
+                                         full_output=True)[1], 0)
+
+        # degenerate
+        self.assertEqual(exact_test_ct(np.array([[10, 20], [0, 0]])), 1)
+
+    def test_sequential(self):
+        # weak dependency: stops after a few hundred permutations
+        data = np.array([[12, 10], [9, 14]])
+        (pval, num_samples) = permutation_test_ct2(data, sequential=True,
+                                                   full_output=True)
+        self.assertLess(num_samples, 1000)
+        self.assertAlmostEqual(pval, exact_mi_pval_2x2(data), delta=0.1)
+
+        # strong dependency: stops once the p-value is below alpha
+        data = np.array([[60, 20], [22, 58]])
+        (pval, num_samples) = permutation_test_ct2(data, sequential=True,
+                                                   alpha=0.01,
+                                                   full_output=True)
+        self.assertLess(pval, 0.01)
+        self.assertLess(num_samples, 10000)
+
+        # no early rejection without a significance level
+        (pval, num_samples) = permutation_test_ct2(data, sequential=True,
+                                                   full_output=True)
+        self.assertEqual(num_samples, 10000)
+
+    def test_permutation_test_corr(self):
+        x = np.random.randn(200)
+        y = 0.1*x + np.random.randn(200)
+        self.assertAlmostEqual(permutation_test_corr(x, y, num_samples=2000),
+                               stats.pearsonr(x, y)[1], delta=0.03)
+        (pval, num_samples) = permutation_test_corr(x, y, sequential=True,
+                                                    full_output=True)
+        self.assertAlmostEqual(pval, stats.pearsonr(x, y)[1], delta=0.1)
+        self.assertLess(num_samples, 10000)
+
+    def test_rng(self):
+        data = np.array([[[30, 20], [22, 28]], [[40, 45], [30, 50]]])
+        stat = lambda cts: cts[:, :, 0, 0].sum(axis=1)
+
+        pvals = [permutation_test_ct_cond(data, stat, vectorized=True,
+                                          num_samples=500,
+                                          rng=np.random.default_rng(seed))
+                 for seed in [1, 1, 2]]
+        self.assertEqual(pvals[0], pvals[1])
+        self.assertNotEqual(pvals[0], pvals[2])
+
+        # the global random state is left untouched
+        state = np.random.get_state()[1].copy()
+        permutation_test_ct2(data[0], rng=np.random.default_rng(0))
+        self.assertTrue(np.all(np.random.get_state()[1] == state))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import unittest
+from fairtest.modules.statistics.multiple_testing import *
+from fairtest.modules.statistics.multiple_testing import _compact_data
+from fairtest.modules.metrics import NMI, CondDIFF, CORR, CondCORR
+from fairtest.modules.metrics.regression import label_records
+import numpy as np
+import pandas as pd
+
+
+class Context(object):
+    def __init__(self, metric, data):
+        self.metric = metric
+        self.data = data
+
+
+class Investigation(object):
+    def __init__(self):
+        self.contexts = {}
+        self.random_state = 0
+
+
+class TestingMultipleTesting(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_compute_stats(self):
+        tables = [pd.DataFrame(np.random.randint(5, 60, (2, 3)))
+                  for _ in range(4)]
+        cond_tables = [pd.DataFrame(np.random.randint(5, 60, (2, 2)))
+                       for _ in range(3)]
+        contexts = [Context(NMI(), ct) for ct in tables] + \
+            [Context(CondDIFF(), cond_tables)]
+
+        stats = compute_stats(contexts[:4], True, 0.95, 0)['stats']
+        self.assertTrue(all(np.array_equal(c.metric.stats, s)
+                            for (c, s) in zip(contexts, stats)))
+
+        # exact p-values need no Monte-Carlo samples, unlike the conditional
+        # test
+        self.assertEqual([c.metric.num_samples for c in contexts[:4]],
+                         [0]*4)
+        num_samples = compute_stats(contexts[4:], True, 0.95, 0)['num_samples']
+        self.assertGreater(num_samples[0], 0)
+        self.assertEqual(contexts[4].metric.num_samples, num_samples[0])
+
+        # the statistics do not depend on the number of workers
+        for metric_contexts in [contexts[:4], contexts[4:]]:
+            serial = compute_stats(metric_contexts, True, 0.95, 0)['stats']
+            parallel = compute_stats(metric_contexts, True, 0.95, 0,
+                                     n_jobs=2)['stats']
+            for (s, p) in zip(serial, parallel):
+                self.assertTrue(np.array_equal(np.asarray(s, dtype=float),
+                                               np.asarray(p, dtype=float)))
+
+    def test_compact_data(self):
+        def corr_data(n):
+            x = np.random.randint(0, 2, n)
+            return np.column_stack((100 + x + np.random.randn(n), x))
+
+        small = corr_data(300)
+        large = corr_data(3000)
+
+        # complete data is only sent if exact methods need it
+        self.assertEqual(_compact_data(CORR(), small, True).shape, (300, 2))
+        self.assertEqual(_compact_data(CORR(), small, False).shape, (6,))
+        self.assertEqual(_compact_data(CORR(), large, True).shape, (6,))
+        self.assertEqual([d.shape for d in _compact_data(
+            CondCORR(), [small, large], True)], [(300, 2), (6,)])
+
+        # the asymptotic statistics are those of the complete data
+        contexts = [Context(CORR(), large), Context(CORR(), small),
+                    Context(CondCORR(), [small, large])]
+        for c in contexts:
+            expected = c.metric.compute(c.data, 0.95, exact=False).stats
+            stats = compute_stats([c], False, 0.95, 0)['stats'][0]
+            self.assertTrue(np.allclose(stats, expected))
+            if c.data is large:
+                stats = compute_stats([c], True, 0.95, 0)['stats'][0]
+                self.assertTrue(np.allclose(stats, expected))
+
+    def test_records(self):
+        stats = [[0.1, 0.2, 0.01], np.array([0.0, 0.3, 0.5])]
+        cond_stats = [np.array([[0.1, 0.2, 0.01], [0.0, 0.3, 0.5],
+                                [0.2, 0.4, 0.001]])]*2
+        reg_stats = [label_records([4, 1], np.array([[0.1, 0.2, 0.01],
+                                                     [0.0, 0.3, 0.5]]))]
+
+        records = to_records(stats)
+        self.assertEqual(list(records['context']), [0, 1])
+        self.assertEqual(list(records['hypothesis']), [0, 0])
+        for (s, r) in zip(stats, from_records(records, NMI)):
+            self.assertTrue(np.array_equal(s, r))
+
+        records = to_records(cond_stats)
+        self.assertEqual(list(records['context']), [0, 0, 0, 1, 1, 1])
+        self.assertEqual(list(records['hypothesis']), [0, 1, 2, 0, 1, 2])
+        for (s, r) in zip(cond_stats, from_records(records, CondDIFF)):
+            self.assertTrue(np.array_equal(s, r))
+
+        records = to_records(reg_stats)
+        self.assertEqual(list(records['hypothesis']), [4, 1])
+        frame = stats_frame(records, index=['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(list(frame.index), ['e', 'b'])
+        self.assertTrue(np.array_equal(frame.values,
+                                       [[0.1, 0.2, 0.01], [0.0, 0.3, 0.5]]))
+
+    def test_compute_investigation_stats(self):
+        tables = [pd.DataFrame(np.random.randint(5, 60, (2, 2)))
+                  for _ in range(6)]
+        inv = Investigation()
+        inv.contexts = {
+            'a': [Context(NMI(), ct) for ct in tables[:3]],
+            'b': [Context(CondDIFF(), tables[3:5]),
+                  Context(CondDIFF(), tables[4:])]}
+
+        # the statistics are computed at the same (Bonferroni) level with
+        # and without correction
+        raw = compute_investigation_stats(inv, False, 0.95, correct=False)
+        self.assertEqual(num_hypotheses(inv), 9)
+        raw = compute_investigation_stats(inv, False, 1-0.05/9, correct=False)
+        corrected = compute_investigation_stats(inv, False, 0.95)
+        self.assertEqual(len(raw['a']), 3)
+        self.assertEqual(np.shape(raw['b'][0]), (3, 3))
+
+        # Holm's correction over all hypotheses of the investigation
+        pvals = np.concatenate([np.ravel(np.asarray(s)[..., -1])
+                                for sens in ['a', 'b'] for s in raw[sens]])
+        expected = multipletests(pvals, alpha=0.05, method='holm')[1]
+        actual = np.concatenate([np.ravel(np.asarray(s)[..., -1])
+                                 for sens in ['a', 'b']
+                                 for s in corrected[sens]])
+        self.assertTrue(np.allclose(actual, expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,6 +13,7 @@ setup(name='fairtest',
                 'fairtest.modules.bug_report',
                 'fairtest.modules.context_discovery',
                 'fairtest.modules.metrics',
+                'fairtest.modules.monitoring',
                 'fairtest.modules.statistics',
                 #'fairtest.service',
                 #'fairtest.service.helpers',
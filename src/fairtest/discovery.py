@@ -12,7 +12,8 @@ class Discovery(Investigation):
     A FairTest Discovery Investigation
     """
     def __init__(self, data_source, protected, output, expl=None,
-                 metrics=None, topk=10, random_state=None, to_drop=None):
+                 metrics=None, topk=10, random_state=None, to_drop=None,
+                 candidates=None):
         """
         Initializes a FairTest Testing Investigation.
 
@@ -34,9 +35,14 @@ class Discovery(Investigation):
             seed for random generators
         to_drop :
             features to drop from the training set
+        candidates :
+            number of output features, screened by their marginal
+            association with the protected feature, that the regression
+            metric is fitted on (all output features if None)
         """
 
         self.topk = topk
+        self.candidates = candidates
 
         logging.info('New Discovery Investigation')
         Investigation.__init__(self, data_source, protected, output,
@@ -45,6 +51,9 @@ class Discovery(Investigation):
         if self.topk < 1 or self.topk > self.output.num_labels:
             raise ValueError('topk should be in [1, %d]'
                              % self.output.num_labels)
+        if self.candidates is not None and self.candidates < self.topk:
+            raise ValueError('candidates should be at least topk (%d)'
+                             % self.topk)
 
     def set_default_metrics(self):
         out = self.output
@@ -59,7 +68,8 @@ class Discovery(Investigation):
                 if isinstance(self.metrics[sens_str], basestring):
                     self.metrics[sens_str] = \
                         metric_from_string(self.metrics[sens_str],
-                                           topk=self.topk)
+                                           topk=self.topk,
+                                           candidates=self.candidates)
 
                 self.metrics[sens_str].validate(sens, out, expl)
             else:
@@ -71,4 +81,5 @@ class Discovery(Investigation):
                                      'explanatory features')
                 logging.info('Choosing metric REGRESSION for feature %s' %
                              sens_str)
-                self.metrics[sens_str] = REGRESSION(topk=self.topk)
+                self.metrics[sens_str] = REGRESSION(topk=self.topk,
+                                                    candidates=self.candidates)
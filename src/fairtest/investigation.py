@@ -5,6 +5,7 @@ An abstract FairTest Investigation.
 from .modules.context_discovery import tree_parser as tree_parser
 from .modules.context_discovery import guided_tree as guided_tree
 from .modules.statistics import multiple_testing as multitest
+from .modules.metrics.registry import get_metric
 from .modules.bug_report import report as report_module
 from .modules.bug_report import filter_rank as filter_rank
 from .holdout import DataSource
@@ -155,7 +156,7 @@ class Investigation(object):
 
 def train(investigations, max_depth=5, min_leaf_size=100,
           score_aggregation=guided_tree.ScoreParams.AVG, max_bins=10,
-          subsample_frac=1.0):
+          subsample_frac=1.0, cache=None, shared_tree=False):
     """
     Form hypotheses about discrimination contexts for each protected feature
     in each investigation
@@ -183,6 +184,21 @@ def train(investigations, max_depth=5, min_leaf_size=100,
     max_bins :
         maximum number of bins used for finding splits on continuous
         features
+
+    subsample_frac :
+        fraction of the contextual features considered for each split
+
+    cache :
+        cache for the aggregated statistics of sub-populations (a
+        `TableCache'), shared across protected features and investigations,
+        e.g., `table_cache.DEFAULT_CACHE'. If ``None`` (the default), no
+        caching is performed
+
+    shared_tree :
+        if ``True``, investigations with multiple protected features build a
+        single tree whose splits are scored over all protected features. The
+        binning, partitioning and histograms are then shared across protected
+        features, and protected features are not used as contextual features
     """
 
     if max_depth < 0:
@@ -209,7 +225,23 @@ def train(investigations, max_depth=5, min_leaf_size=100,
         inv.train_params = {'max_depth': max_depth,
                             'min_leaf_size': min_leaf_size,
                             'agg_type': score_aggregation,
-                            'max_bins': max_bins}
+                            'max_bins': max_bins,
+                            'shared_tree': shared_tree}
+
+        if shared_tree and len(inv.sens_features) > 1:
+            logging.info('Begin training phase with protected '
+                         'features %s' % inv.sens_features)
+            metrics = dict((sens, copy(inv.metrics[sens]))
+                           for sens in inv.sens_features)
+            trees = guided_tree.build_shared_tree(data, inv.feature_info,
+                                                  inv.sens_features, inv.expl,
+                                                  inv.output, metrics,
+                                                  inv.holdout.test_set_conf,
+                                                  max_depth, min_leaf_size,
+                                                  score_aggregation, max_bins,
+                                                  subsample_frac)
+            inv.trained_trees.update(trees)
+            continue
 
         # find discrimination contexts for each sensitive feature
         for sens in inv.sens_features:
@@ -223,12 +255,16 @@ def train(investigations, max_depth=5, min_leaf_size=100,
                                           copy(inv.metrics[sens]),
                                           conf, max_depth, min_leaf_size,
                                           score_aggregation, max_bins,
-                                          subsample_frac)
+                                          subsample_frac, cache)
             inv.trained_trees[sens] = tree
 
+    if cache is not None:
+        cache.log_stats()
+
 
 def test(investigations, prune_insignificant=True, exact=True, correct=True,
-         new_metrics=None, new_expl=None):
+         new_metrics=None, new_expl=None, cache=None, n_jobs=1,
+         time_budget=None):
     """
     Compute effect sizes and p-values for the discrimination contexts
     discovered on the training set. Correct intervals and p-values across
@@ -249,6 +285,23 @@ def test(investigations, prune_insignificant=True, exact=True, correct=True,
         generate p-values and confidence intervals. Otherwise, confidence
         intervals are generated with bootstrapping techniques and p-values
         via Monte-Carlo permutation tests.
+
+    cache :
+        cache for the contingency tables of contexts (a `TableCache'),
+        shared across protected features, investigations and repeated
+        calls, e.g., `table_cache.DEFAULT_CACHE'. If ``None`` (the default),
+        no caching is performed
+
+    n_jobs :
+        number of worker processes used to compute the statistics of the
+        contexts (-1 for one per CPU). The results do not depend on the
+        number of workers
+
+    time_budget :
+        if set along with ``exact``, the wall-clock time (in seconds) allowed
+        for computing the statistics. Exact methods are then used for the
+        contexts that fit within the budget, by increasing size, and
+        asymptotic methods for the others
     """
 
     if not hasattr(investigations, '__iter__'):
@@ -306,15 +359,19 @@ def test(investigations, prune_insignificant=True, exact=True, correct=True,
                 inv.contexts[sens] = tree_parser.find_contexts(tree, data, inv.feature_info,
                                                                sens, inv.expl, inv.output,
                                                                prune_insignificant,
-                                                               new_metric=new_metric)
+                                                               new_metric=new_metric,
+                                                               cache=cache)
                 logging.info('Parsed tree for sensitive feature %s' % sens)
 
         # compute p-values and confidence intervals with FWER correction
         logging.info('Begin testing phase')
-        np.random.seed(investigations[0].random_state)
 
         multitest.compute_all_stats(investigations, exact,
-                                    holdout.test_set_conf, correct)
+                                    holdout.test_set_conf, correct,
+                                    n_jobs=n_jobs, time_budget=time_budget)
+
+        if cache is not None:
+            cache.log_stats()
     else : #except Exception as e:
         holdout.return_unused_data(test_data)
 
@@ -476,6 +533,9 @@ def metric_from_string(m_str, **kwargs):
     """
     Gets a Metric from its string representation
 
+    Metrics are looked up in the registry of metrics (see
+    `register_metric' in `modules.metrics').
+
     Parameters
     ----------
     m_str :
@@ -484,20 +544,4 @@ def metric_from_string(m_str, **kwargs):
     kwargs :
         additional arguments used for constructing a metric
     """
-    if m_str == "NMI" or m_str == "MI":
-        return NMI()
-    elif m_str == "CORR":
-        return CORR()
-    elif m_str == "DIFF":
-        return DIFF()
-    elif m_str == "RATIO":
-        return RATIO()
-    elif m_str == "REGRESSION":
-        return REGRESSION(topk=kwargs['topk'])
-    elif m_str == "CondDIFF":
-        return CondDIFF()
-    elif m_str == "CondNMI":
-        return CondNMI()
-    elif m_str == "CondCorr":
-        return CondCORR()
-    raise ValueError('Unknown fairness Metric {}'.format(m_str))
+    return get_metric(m_str, **kwargs)
@@ -2,7 +2,6 @@
 Filter and Rank Association Bugs.
 """
 from ..metrics import Metric
-import pandas as pd
 import numpy as np
 import logging
 
@@ -48,10 +47,9 @@ def filter_rank_bugs(context_stats, node_filter=FILTER_BETTER_THAN_ANCESTORS,
         filtered_bugs = [(c, c_stats) for (c, c_stats) in context_stats if
                          not c.isroot and c.metric.abs_effect() > 0]
     else:
-        if isinstance(context_stats[0][1], pd.DataFrame):
+        if np.ndim(context_stats[0][1]) == 2:
             filtered_bugs = [(c, c_stats) for (c, c_stats) in context_stats
-                             if not c.isroot and
-                             np.array(c_stats)[0][-1] <= 1-conf]
+                             if not c.isroot and c_stats[0][-1] <= 1-conf]
         else:
             filtered_bugs = [(c, c_stats) for (c, c_stats) in context_stats if
                              not c.isroot and c_stats[-1] <= 1-conf]
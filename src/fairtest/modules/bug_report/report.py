@@ -23,6 +23,7 @@ import sys
 from ..metrics import Metric
 from ..context_discovery.tree_parser import Bound
 from ..bug_report import filter_rank
+from ..statistics import multiple_testing as multitest
 
 
 class Namer(object):
@@ -160,8 +161,8 @@ def print_summary(all_contexts, displayed_contexts, namer, output_stream):
         """
         if node.num in displayed_contexts:
             if node.metric.dataType != Metric.DATATYPE_REG:
-                if isinstance(node.metric.stats, pd.DataFrame):
-                    (ci_low, ci_high, _) = node.metric.stats.loc[0]
+                if np.ndim(node.metric.stats) == 2:
+                    (ci_low, ci_high, _) = node.metric.stats[0]
                 else:
                     (ci_low, ci_high, _) = node.metric.stats
 
@@ -247,6 +248,7 @@ def bug_report(contexts, stats, sens, expl, output, output_stream,
                            output_stream, plot_dir)
     else:
         print_context_reg(root, root_stats, namer, output_stream)
+    print_num_samples(root, output_stream)
     output_stream.write('='*80)
     output_stream.write('')
 
@@ -271,6 +273,7 @@ def bug_report(contexts, stats, sens, expl, output, output_stream,
                                plot_dir)
         else:
             print_context_reg(context, context_stats, namer, output_stream)
+        print_num_samples(context, output_stream)
         output_stream.write('-'*80)
         output_stream.write('')
 
@@ -279,6 +282,25 @@ def bug_report(contexts, stats, sens, expl, output, output_stream,
     return print_summary(contexts, displayed_bugs, namer, output_stream)
 
 
+def print_num_samples(context, output_stream):
+    """
+    Print the number of Monte-Carlo samples drawn by the tests of a context,
+    if its p-values were not computed exactly or approximately
+
+    Parameters
+    ----------
+    context :
+        the context
+
+    output_stream :
+        the stream to output data to
+    """
+    if context.metric.num_samples:
+        output_stream.write('p-values estimated from {} Monte-Carlo samples'.
+                            format(context.metric.num_samples))
+        output_stream.write('')
+
+
 def print_context(path, namer):
     """
     Prints a description of an association context.
@@ -327,7 +349,7 @@ def print_context_ct(context, context_stats, metric_name, namer, output_stream):
     out = namer.output.names[0]
 
     if not namer.expl:
-        ct = context.data
+        ct = pd.DataFrame(context.data)
         ct.index = namer.get_target_vals(out, len(ct.index))
         ct.index.name = out
         ct.columns = namer.get_sens_feature_vals(len(ct.columns))
@@ -343,7 +365,7 @@ def print_context_ct(context, context_stats, metric_name, namer, output_stream):
                 output_stream.write('> {} = {} ; size {} ({:.2f}%):'.\
                     format(namer.expl, expl_values[i], size, weight))
 
-                (effect_low, effect_high, p_val) = context_stats.loc[i+1]
+                (effect_low, effect_high, p_val) = context_stats[i+1]
                 output_stream.write('p-value = {:.2e} ; {} = [{:.4f}, {:.4f}]'.\
                     format(p_val, 'DIFF', effect_low, effect_high))
 
@@ -355,7 +377,7 @@ def print_context_ct(context, context_stats, metric_name, namer, output_stream):
                 output_stream.write(str(pretty_ct(ct)))
                 output_stream.write('')
 
-        context_stats = context_stats.loc[0]
+        context_stats = context_stats[0]
 
     # print p-value and confidence interval of MI
     (effect_low, effect_high, p_val) = context_stats
@@ -517,7 +539,6 @@ def print_context_corr(context, context_stats, metric_name, namer,
         else:
             plt.show()
     else:
-        context_stats = context_stats.values
         expl_values = namer.get_expl_feature_vals(len(context_stats))
         for i in range(len(context.data)):
             if len(context.data[i]) > 0:
@@ -600,12 +621,11 @@ def print_context_reg(context, context_stats, namer, output_stream):
     output_stream.write('')
     labels = namer.output.names
 
-    stats = context_stats.copy()
-    stats.index = [labels[idx] for idx in stats.index.values]
+    stats = multitest.stats_frame(context_stats, index=labels)
 
     # sort the labels by p-value as all the tests were performed on the same
     # sample size
-    sorted_results = stats.sort(columns=['pval'], ascending=True)
+    sorted_results = stats.sort_values(by='pval', ascending=True)
 
     pd.set_option('display.max_rows', context.metric.topk)
     output_stream.write(sorted_results)
@@ -2,19 +2,17 @@
 Guided Tree Construction Algorithm.
 """
 from ..metrics import Metric
-import operator
+from . import table_cache
 import numpy as np
 from collections import Counter
 from sklearn.externals import six
 from sklearn.externals.six import StringIO
-from copy import copy
 import logging
 import multiprocessing
 import traceback
 import sys
 import random
 import math
-from functools import reduce
 
 
 def find_thresholds(data, features, feature_info, num_bins):
@@ -101,7 +99,8 @@ class SplitParams(object):
     Split parameters
     """
     def __init__(self, targets, sens, expl, dim, feature_info,
-                 thresholds, min_leaf_size, subsample):
+                 thresholds, min_leaf_size, subsample, cache=None,
+                 fingerprint=None):
         self.targets = targets
         self.sens = sens
         self.expl = expl
@@ -110,11 +109,53 @@ class SplitParams(object):
         self.thresholds = thresholds
         self.min_leaf_size = min_leaf_size
         self.subsample = subsample
+        self.cache = cache
+        self.fingerprint = fingerprint
+
+
+def cached_stats(split_params, metric, pred, feature, compute):
+    """
+    Looks up the statistics of a split in the table cache
+
+    Parameters
+    ----------
+    split_params :
+        the splitting parameters
+
+    metric :
+        the metric the statistics are computed for
+
+    pred :
+        the predicate defining the current context
+
+    feature :
+        the feature to split on (or None for the current context)
+
+    compute :
+        a function without arguments that computes the statistics
+
+    Returns
+    -------
+    stats :
+        the statistics of the split
+    """
+    if split_params.cache is None or metric.dataType == Metric.DATATYPE_REG:
+        return compute()
+
+    thresholds = split_params.thresholds.get(feature, None)
+    if thresholds is not None:
+        thresholds = tuple(thresholds)
+
+    key = (split_params.fingerprint, table_cache.path_key(pred), feature,
+           thresholds, split_params.sens, tuple(split_params.targets),
+           split_params.expl, split_params.dim, metric.dataType,
+           metric.shift_invariant)
+    return split_params.cache.lookup(key, compute)
 
 
 def build_tree(data, feature_info, sens, expl, output, metric, conf,
                max_depth, min_leaf_size=100, agg_type='avg', max_bins=10,
-               subsample_frac=1.0):
+               subsample_frac=1.0, cache=None):
     """
     Builds a decision tree guided towards nodes with high bias
 
@@ -153,6 +194,13 @@ def build_tree(data, feature_info, sens, expl, output, metric, conf,
     max_bins :
         maximum number of bins to use when binning continuous features
 
+    subsample_frac :
+        fraction of the features to consider for each split
+
+    cache :
+        a `TableCache' for the aggregated statistics of sub-populations
+        (or None)
+
     Returns
     -------
     tree :
@@ -171,18 +219,7 @@ def build_tree(data, feature_info, sens, expl, output, metric, conf,
     logging.debug('Contextual Features: %s', features)
 
     # check the data dimensions
-    if metric.dataType == Metric.DATATYPE_CORR:
-        if expl:
-            dim = (feature_info[expl].arity, 6)
-        else:
-            dim = 6
-    else:
-        # get the dimensions of the OUTPUT x SENSITIVE contingency table
-        if expl:
-            dim = (feature_info[expl].arity, output.arity,
-                   feature_info[sens].arity)
-        else:
-            dim = (output.arity, feature_info[sens].arity)
+    dim = metric_dim(metric, feature_info, sens, expl, output)
 
     logging.debug('Data Dimension for Metric: %s', dim)
 
@@ -190,14 +227,24 @@ def build_tree(data, feature_info, sens, expl, output, metric, conf,
     cont_thresholds = find_thresholds(data, features, feature_info, max_bins)
 
     score_params = ScoreParams(metric, agg_type, conf)
+    fingerprint = table_cache.fingerprint(data) if cache is not None \
+        else None
     split_params = SplitParams(targets, sens, expl, dim, feature_info,
-                               cont_thresholds, min_leaf_size, subsample_frac)
+                               cont_thresholds, min_leaf_size, subsample_frac,
+                               cache, fingerprint)
 
     # get a measure for the root
     if metric.dataType == Metric.DATATYPE_CT:
-        stats = [count_values(data, sens, targets[0], expl, dim)[0]]
+        stats = [cached_stats(split_params, metric, [], None,
+                              lambda: aggregate_values(metric, data, sens,
+                                                       targets[0], expl,
+                                                       dim))[0]]
     elif metric.dataType == Metric.DATATYPE_CORR:
-        stats = [corr_values(data, sens, targets[0], expl, dim)[0]]
+        shift = None if metric.shift_invariant else (0, 0)
+        stats = [cached_stats(split_params, metric, [], None,
+                              lambda: aggregate_values(metric, data, sens,
+                                                       targets[0], expl, dim,
+                                                       shift))[0]]
     else:
         stats = [data[targets+[sens]]]
 
@@ -243,14 +290,26 @@ def build_tree(data, feature_info, sens, expl, output, metric, conf,
 
         # make a new leaf if recursion is stopped
         if (depth == max_depth) or (len(split_features) == 0):
+            if metric.dataType == Metric.DATATYPE_REG:
+                node.metric.fit_state = None
             return
 
         logging.debug('looking for splits at pred %s', pred)
 
+        # the regressions of the children start from the node's fit, which
+        # is not needed anymore once the node is split
+        node_score_params = score_params
+        if metric.dataType == Metric.DATATYPE_REG:
+            node_score_params = ScoreParams(node.metric.child_metric(),
+                                            score_params.agg_type,
+                                            score_params.conf)
+            node.metric.fit_state = None
+
         # select the best feature to split on
         split_score, best_feature, threshold, to_drop, child_metrics = \
             select_best_feature(node_data, split_features, split_params,
-                                score_params, parent_score, pool)
+                                node_score_params, parent_score, pool, pred)
+        del node_score_params
 
         # no split found, make a leaf
         if best_feature is None:
@@ -336,6 +395,404 @@ def build_tree(data, feature_info, sens, expl, output, metric, conf,
     return tree
 
 
+def build_shared_tree(data, feature_info, sens_features, expl, output, metrics,
+                      conf, max_depth, min_leaf_size=100, agg_type='avg',
+                      max_bins=10, subsample_frac=1.0):
+    """
+    Builds a single guided tree for multiple protected features.
+
+    The continuous features are binned once, rows are partitioned once per
+    node and, for each candidate feature, the joint histograms
+    (bin x output x sens_k) of all protected features are computed in a
+    single pass that shares the bin and output marginals. A split is scored
+    by averaging its score over all protected features.
+
+    Contrary to independent trees, protected features are never used as
+    contextual features.
+
+    Parameters
+    ----------
+    data :
+        the dataset
+
+    feature_info :
+        information about user features
+
+    sens_features :
+        names of the sensitive features
+
+    expl :
+        name of the explanatory feature
+
+    output :
+        the target feature
+
+    metrics :
+        dictionary of the fairness metrics to use, indexed by sensitive
+        feature
+
+    conf :
+        the confidence level
+
+    max_depth :
+        maximum depth of the decision-tree
+
+    min_leaf_size :
+        minimum size of a leaf
+
+    agg_type :
+        aggregation method for children scores
+
+    max_bins :
+        maximum number of bins to use when binning continuous features
+
+    subsample_frac :
+        fraction of the features to consider for each split
+
+    Returns
+    -------
+    trees :
+        dictionary of trees indexed by sensitive feature. All trees have the
+        same structure but hold the metrics of their own protected feature
+    """
+    from ete3 import Tree
+    logging.info('Building a Shared Guided Decision Tree for %s',
+                 sens_features)
+
+    for sens in sens_features:
+        if metrics[sens].dataType not in [Metric.DATATYPE_CT,
+                                          Metric.DATATYPE_CORR]:
+            raise ValueError('Metric %s not usable with a shared tree'
+                             % metrics[sens])
+
+    targets = output.names.tolist()
+    features = set(data.columns.tolist())-set(sens_features)-set([expl]) - \
+        set(targets)
+    logging.debug('Contextual Features: %s', features)
+
+    # bin the continuous features once for all protected features
+    cont_thresholds = find_thresholds(data, features, feature_info, max_bins)
+    codes = {}
+    num_bins = {}
+    for feature in features:
+        if feature_info[feature].arity:
+            codes[feature] = np.asarray(data[feature], dtype=int)
+            num_bins[feature] = feature_info[feature].arity
+        else:
+            codes[feature] = np.digitize(data[feature],
+                                         cont_thresholds[feature], right=True)
+            num_bins[feature] = len(cont_thresholds[feature]) + 1
+
+    target_vals = np.asarray(data[targets[0]])
+    sens_vals = dict((sens, np.asarray(data[sens])) for sens in sens_features)
+    dim_expl = feature_info[expl].arity if expl else 1
+    expl_vals = np.asarray(data[expl], dtype=int) if expl else None
+
+    dims = {}
+    for sens in sens_features:
+        if metrics[sens].dataType == Metric.DATATYPE_CORR:
+            dims[sens] = (6,)
+        else:
+            dims[sens] = (output.arity, feature_info[sens].arity)
+        if expl:
+            dims[sens] = (dim_expl,) + dims[sens]
+
+    score_params = dict((sens, ScoreParams(metrics[sens], agg_type, conf))
+                        for sens in sens_features)
+
+    def histograms(rows, feature):
+        """
+        Joint histograms of all protected features for the bins of a feature
+
+        Parameters
+        ----------
+        rows :
+            the rows of the current node
+
+        feature :
+            the feature to bin on (or None for a single bin)
+
+        Returns
+        -------
+        hists :
+            dictionary of (bin x [expl x] output x sens) histograms, or
+            (bin x [expl x] 6) summary statistics computed with the metric's
+            accumulator, indexed by sensitive feature
+
+        sizes :
+            the (bin x expl) sizes
+        """
+        if feature is None:
+            (bins, nbins) = (np.zeros(len(rows), dtype=int), 1)
+        else:
+            (bins, nbins) = (codes[feature][rows], num_bins[feature])
+
+        # marginals shared by all protected features
+        group = bins*dim_expl + expl_vals[rows] if expl else bins
+        num_groups = nbins*dim_expl
+        sizes = np.bincount(group, minlength=num_groups)
+        group_target = None
+
+        hists = {}
+        for sens in sens_features:
+            s_vals = sens_vals[sens][rows]
+            if metrics[sens].dataType == Metric.DATATYPE_CT:
+                if group_target is None:
+                    group_target = group*output.arity + target_vals[rows]
+                dim_s = feature_info[sens].arity
+                hist = np.bincount(group_target*dim_s + s_vals,
+                                   minlength=num_groups*output.arity*dim_s)
+            else:
+                # the statistics of all bins share a shift so that they can
+                # be summed (the means of the node, or no shift for metrics
+                # that are not invariant to shifts)
+                y = target_vals[rows].astype(float)
+                x = s_vals.astype(float)
+                if metrics[sens].shift_invariant and len(rows):
+                    shift = (x.mean(), y.mean())
+                else:
+                    shift = (0, 0)
+                acc = metrics[sens].accumulator_type((num_groups, 6))
+                hist = acc.update(np.column_stack((group, x, y))).finalize(
+                    shift)
+            hists[sens] = hist.reshape((nbins,) + dims[sens])
+
+        return hists, sizes.reshape(nbins, dim_expl)
+
+    def child_size(sizes):
+        """
+        Size of a child (smallest explanatory group, if any)
+
+        Parameters
+        ----------
+        sizes :
+            the sizes of the child's explanatory groups
+
+        Returns
+        -------
+        size :
+            the child's size
+        """
+        if not expl:
+            return sizes.sum()
+        sizes = sizes[sizes > 0]
+        return sizes.min() if len(sizes) else 0
+
+    def score_split(children, weight=1):
+        """
+        Scores a split for all protected features
+
+        Parameters
+        ----------
+        children :
+            dictionary of the children's statistics indexed by sensitive
+            feature
+
+        weight :
+            weight to apply to the score
+
+        Returns
+        -------
+        split_scores :
+            split scores, indexed by sensitive feature
+
+        child_metrics :
+            list of the children's metrics, indexed by sensitive feature
+        """
+        split_scores = {}
+        child_metrics = [{} for _ in children[sens_features[0]]]
+        for sens in sens_features:
+            split_scores[sens], sens_metrics = \
+                score(children[sens], score_params[sens], weight)
+            for (child, metric) in zip(child_metrics, sens_metrics):
+                child[sens] = metric
+        return split_scores, child_metrics
+
+    def test_feature(rows, feature):
+        """
+        Finds the best split on a feature for all protected features
+
+        Parameters
+        ----------
+        rows :
+            the rows of the current node
+
+        feature :
+            the feature to consider
+
+        Returns
+        -------
+        split :
+            the split scores, the threshold (or None for categorical splits)
+            and a dictionary of child metrics, or None if no split is valid
+        """
+        hists, sizes = histograms(rows, feature)
+
+        if feature_info[feature].arity:
+            children = [b for b in range(num_bins[feature])
+                        if child_size(sizes[b]) >= min_leaf_size]
+            if len(children) < 2:
+                return None
+
+            n_children = sum([sizes[b].sum() for b in children])
+            split_scores, child_metrics = score_split(
+                dict((sens, [hists[sens][b] for b in children])
+                     for sens in sens_features),
+                weight=1.0*n_children/len(rows))
+            return split_scores, None, dict(zip(children, child_metrics))
+
+        cum_hists = dict((sens, np.cumsum(hists[sens], axis=0))
+                         for sens in sens_features)
+        cum_sizes = np.cumsum(sizes, axis=0)
+
+        # only split after non-empty bins
+        valid = [b for b in range(num_bins[feature])
+                 if sizes[b].sum() > 0 and
+                 child_size(cum_sizes[b]) >= min_leaf_size and
+                 child_size(cum_sizes[-1] - cum_sizes[b]) >= min_leaf_size]
+        if not valid:
+            return None
+
+        # score all valid splits at once, for each protected feature
+        split_scores = np.mean([
+            score_batch(np.stack((cum_hists[sens][valid],
+                                  cum_hists[sens][-1] -
+                                  cum_hists[sens][valid]), axis=1),
+                        score_params[sens])
+            for sens in sens_features], axis=0)
+
+        b = valid[_best_split(split_scores)]
+        split_scores, child_metrics = score_split(
+            dict((sens, [cum_hists[sens][b],
+                         cum_hists[sens][-1] - cum_hists[sens][b]])
+                 for sens in sens_features))
+        return split_scores, b, dict(zip(['left', 'right'], child_metrics))
+
+    tree = Tree()
+    root_hists, _ = histograms(np.arange(len(data)), None)
+    _, root_metrics = score_split(dict((sens, [root_hists[sens][0]])
+                                       for sens in sens_features))
+    tree.add_features(metrics=root_metrics[0])
+
+    def rec_build_tree(rows, node, pred, split_features, depth,
+                       parent_scores):
+        """
+        Recursive tree building.
+
+        Parameters
+        ----------
+        rows :
+            the rows of the current node
+
+        node :
+            the current node
+
+        pred :
+            the predicate defining the current context
+
+        split_features :
+            the features on which a split can occur
+
+        depth :
+            the current depth
+
+        parent_scores :
+            the metric scores at the parent, indexed by sensitive feature
+        """
+        node.add_features(size=len(rows))
+
+        # make a new leaf if recursion is stopped
+        if (depth == max_depth) or (len(split_features) == 0):
+            return
+
+        logging.debug('looking for splits at pred %s', pred)
+
+        candidates = random.sample(
+            sorted(split_features),
+            int(math.ceil(subsample_frac*len(split_features))))
+
+        results = []
+        to_drop = []
+        for feature in candidates:
+            split = test_feature(rows, feature)
+            if split is None:
+                to_drop.append(feature)
+                continue
+
+            (split_scores, bin_idx, child_metrics) = split
+            split_score = np.mean(list(split_scores.values()))
+            if np.isnan(split_score):
+                to_drop.append(feature)
+                continue
+
+            # check if there is a child with higher score than the parent
+            better_than_parent = \
+                len([metric for child in child_metrics.values()
+                     for (sens, metric) in child.items()
+                     if metric.abs_effect() > parent_scores[sens]]) > 0
+            results.append((better_than_parent, split_score, feature,
+                            split_scores, bin_idx, child_metrics))
+
+        logging.debug('dropping features: %s', to_drop)
+
+        if not results:
+            return
+        (better_than_parent, split_score, feature, split_scores, bin_idx,
+         child_metrics) = sorted(results, key=lambda r: (r[0], r[1]),
+                                 reverse=True)[0]
+        if not better_than_parent:
+            logging.debug('No split produced a context better than parent')
+            return
+
+        feature_codes = codes[feature][rows]
+        if feature_info[feature].arity:
+            logging.info('splitting on %s (score=%s) at pred %s',
+                         feature, split_score, pred)
+            for (category, metrics_k) in sorted(child_metrics.items()):
+                new_pred = "{} = {}".format(feature, category)
+                child = node.add_child(name=str(new_pred))
+                child.add_features(feature_type='categorical',
+                                   feature=feature,
+                                   category=category,
+                                   metrics=metrics_k)
+                rec_build_tree(rows[feature_codes == category], child,
+                               pred+[new_pred],
+                               split_features-set(to_drop + [feature]),
+                               depth+1, split_scores)
+        else:
+            threshold = cont_thresholds[feature][bin_idx]
+            logging.info('splitting on %s (score=%s) with threshold %s at '
+                         'pred %s', feature, split_score, threshold, pred)
+            for (is_left, side, op) in [(True, 'left', '<='),
+                                        (False, 'right', '>')]:
+                new_pred = "{} {} {}".format(feature, op, threshold)
+                child = node.add_child(name=str(new_pred))
+                child.add_features(feature_type='continuous',
+                                   feature=feature,
+                                   threshold=threshold,
+                                   is_left=is_left,
+                                   metrics=child_metrics[side])
+                mask = (feature_codes <= bin_idx) if is_left \
+                    else (feature_codes > bin_idx)
+                rec_build_tree(rows[mask], child, pred+[new_pred],
+                               split_features-set(to_drop), depth+1,
+                               split_scores)
+
+    rec_build_tree(np.arange(len(data)), tree, [], features, 0,
+                   dict((sens, 0) for sens in sens_features))
+
+    # derive one tree per protected feature
+    trees = {}
+    for sens in sens_features:
+        sens_tree = tree.copy()
+        for node in sens_tree.traverse():
+            node.add_features(metric=node.metrics[sens])
+            node.del_feature('metrics')
+        trees[sens] = sens_tree
+
+    return trees
+
+
 def score_feature(args):
     """
     Scores a particular feature
@@ -353,7 +810,7 @@ def score_feature(args):
     # unpack a long tuple of arguments
     try:
         (feature, sens, targets, expl, feature_info, node_data, split_params,
-         score_params, parent_score) = args
+         score_params, parent_score, pred) = args
 
         feature_list = [feature, sens] + targets
         if expl:
@@ -363,12 +820,12 @@ def score_feature(args):
         if feature_info[feature].arity:
             split_score, metrics = test_cat_feature(node_data[feature_list],
                                                     feature, split_params,
-                                                    score_params)
+                                                    score_params, pred)
             threshold = None
         else:
             split_score, threshold, metrics = \
                     test_cont_feature(node_data[feature_list], feature,
-                                      split_params, score_params)
+                                      split_params, score_params, pred)
 
         logging.debug('feature %s: score %s', feature, split_score)
 
@@ -396,7 +853,7 @@ def score_feature(args):
 
 
 def select_best_feature(node_data, features, split_params,
-                        score_params, parent_score, pool):
+                        score_params, parent_score, pool, pred=()):
     """
     Selects the optimal contextual feature to split on to maximize bias
 
@@ -420,6 +877,9 @@ def select_best_feature(node_data, features, split_params,
     pool :
         the thread pool
 
+    pred :
+        the predicate defining the current context
+
     Returns
     -------
     max_score :
@@ -464,7 +924,8 @@ def select_best_feature(node_data, features, split_params,
         [node_data]*len(features),
         [split_params]*len(features),
         [score_params]*len(features),
-        [parent_score]*len(features)
+        [parent_score]*len(features),
+        [pred]*len(features)
     )
 
     # parallelize scoring of features
@@ -501,103 +962,127 @@ def select_best_feature(node_data, features, split_params,
     return max_score, best_feature, best_threshold, to_drop, best_metrics
 
 
-def count_values(data, sens, target, expl, dim):
+def metric_dim(metric, feature_info, sens, expl, output):
     """
-    Count occurrences of target values and reshape as a contingency table
+    Shape of the sufficient statistics of a metric for a context
 
     Parameters
     ----------
-    data :
-        the data to count
+    metric :
+        the metric
+
+    feature_info :
+        information about the features
 
     sens :
         The sensitive feature
 
-    target :
-        The targeted feature
-
     expl :
         A potentially explanatory feature
 
-    dim :
-        The dimensions of the sensitive and targeted features
+    output :
+        the target feature
 
     Returns
     -------
-    values :
-        the contingency table
-
-    size :
-        the size of the data
+    dim :
+        the shape of the statistics: the OUTPUT x SENSITIVE contingency
+        table for metrics over contingency tables, or the 6 aggregate
+        statistics for correlation metrics, for each explanatory group if
+        any
     """
-    values = np.zeros(dim)
+    if metric.dataType == Metric.DATATYPE_CORR:
+        if expl:
+            return (feature_info[expl].arity, 6)
+        return 6
 
     if expl:
-        # group by value of the explanatory feature
-        groups = [zip(group[target], group[sens])
-                  for (_, group) in data.groupby(expl)]
-        counters = [Counter(group) for group in groups]
-
-        # build a three-way contingency table
-        for k in range(len(counters)):
-            for i in range(dim[1]):
-                for j in range(dim[2]):
-                    values[k, i, j] = counters[k].get((i, j), 0)
+        return (feature_info[expl].arity, output.arity,
+                feature_info[sens].arity)
+    return (output.arity, feature_info[sens].arity)
 
-        return values, min([len(g) for g in groups])
 
-    else:
-        # build a two-dimensional contingency table
-        counter = Counter(zip(data[target], data[sens]))
-        for i in range(dim[0]):
-            for j in range(dim[1]):
-                values[i, j] = counter.get((i, j), 0)
-
-        return values, len(data)
-
-
-def corr_values(data, sens, target, expl, dim):
+def aggregate_values(metric, data, sens, target, expl, dim, shift=None):
     """
-    Get statistics for correlation measures
+    Aggregates the sufficient statistics of a metric with its accumulator
+    (see `accumulator.Accumulator')
 
     Parameters
     ----------
+    metric :
+        the metric, which defines `accumulator_type'
+
     data :
-        the data
+        the data to aggregate
 
     sens :
-        the sensitive feature
+        The sensitive feature
 
     target :
-        the targeted feature
+        The targeted feature
+
+    expl :
+        A potentially explanatory feature
+
+    dim :
+        The dimensions of the statistics (see `metric_dim')
+
+    shift :
+        for correlation metrics, a pair (shift_sens, shift_target)
+        subtracted from the data. The statistics of different subsets of
+        the data are additive if they use the same shift. If None, the
+        statistics are centered
 
     Returns
     -------
     values :
-        an array of aggregate statistics
-    """
+        the contingency table, or the aggregate statistics
+        (sum_x, sum_x2, sum_y, sum_y2, sum_xy, n) of the sensitive (x) and
+        targeted (y) features for correlation metrics
 
+    size :
+        the size of the data (of its smallest explanatory group, if any)
+    """
+    if metric.dataType == Metric.DATATYPE_CT:
+        # records ([expl,] target, sens) of a contingency table
+        columns = [data[target], data[sens]]
+    else:
+        # records ([expl,] x, y) for correlation
+        columns = [data[sens], data[target]]
     if expl:
-        values = np.zeros(dim)
-        groups = [(group[target], group[sens])
-                  for (_, group) in data.groupby(expl)]
-
-        for k, (x, y) in enumerate(groups):
-            values[k] = np.array([x.sum(), np.dot(x, x), y.sum(),
-                                  np.dot(y, y), np.dot(x, y), x.size])
-        return values, min([x.size for (x, _) in groups])
+        columns = [data[expl]] + columns
 
+    acc = metric.accumulator_type(dim).update(np.column_stack(columns))
+    if metric.dataType == Metric.DATATYPE_CT:
+        values = acc.finalize()
     else:
-        (x, y) = (np.array(data[sens]), np.array(data[target]))
-        # sum(x), sum(x^2), sum(y), sum(y^2), sum(xy)
-        return np.array([x.sum(),
-                         np.dot(x, x),
-                         y.sum(),
-                         np.dot(y, y),
-                         np.dot(x, y), x.size]), len(x)
+        values = acc.finalize(shift)
+    return values, _min_group_size(acc.size())
+
+
+def _min_group_size(sizes):
+    """
+    Size of the smallest non-empty explanatory group
+
+    Parameters
+    ----------
+    sizes :
+        the sizes of all explanatory groups, or the size of the data without
+        explanatory feature
+
+    Returns
+    -------
+    size :
+        the size of the smallest group
+    """
+    sizes = np.asarray(sizes)
+    if sizes.ndim == 0:
+        return int(sizes)
+    sizes = sizes[sizes > 0]
+    return int(sizes.min()) if len(sizes) else 0
 
 
-def test_cat_feature(node_data, feature, split_params, score_params):
+def test_cat_feature(node_data, feature, split_params, score_params, pred=()):
     """
     Find the best split for a categorical feature
 
@@ -615,6 +1100,9 @@ def test_cat_feature(node_data, feature, split_params, score_params):
     score_params :
         the split scoring parameters
 
+    pred :
+        the predicate defining the current context
+
     Returns
     -------
     split_score :
@@ -629,16 +1117,25 @@ def test_cat_feature(node_data, feature, split_params, score_params):
     expl = split_params.expl
     targets = split_params.targets
     min_leaf_size = split_params.min_leaf_size
-    data_type = score_params.metric.dataType
+    metric = score_params.metric
+    data_type = metric.dataType
 
     if data_type == Metric.DATATYPE_CT:
         # build a contingency table for each child
-        child_stats = [(key, count_values(group, sens, targets[0], expl, dim))
-                       for key, group in node_data.groupby(feature)]
+        child_stats = cached_stats(
+            split_params, metric, pred, feature,
+            lambda: [(key, aggregate_values(metric, group, sens, targets[0],
+                                            expl, dim))
+                     for key, group in node_data.groupby(feature)])
     elif data_type == Metric.DATATYPE_CORR:
-        # compute summary statistics for each child
-        child_stats = [(key, corr_values(group, sens, targets[0], expl, dim))
-                       for key, group in node_data.groupby(feature)]
+        # compute summary statistics for each child (centered, or the raw
+        # sums for metrics that are not invariant to shifts)
+        shift = None if metric.shift_invariant else (0, 0)
+        child_stats = cached_stats(
+            split_params, metric, pred, feature,
+            lambda: [(key, aggregate_values(metric, group, sens, targets[0],
+                                            expl, dim, shift))
+                     for key, group in node_data.groupby(feature)])
     else:
         # aggregate all the data for each child for regression
         child_stats = [(key, (group[targets+[sens]], len(group)))
@@ -665,7 +1162,7 @@ def test_cat_feature(node_data, feature, split_params, score_params):
         return split_score, None
 
 
-def test_cont_feature(node_data, feature, split_params, score_params):
+def test_cont_feature(node_data, feature, split_params, score_params, pred=()):
     """
     Find the best split for a continuous feature
 
@@ -683,6 +1180,9 @@ def test_cont_feature(node_data, feature, split_params, score_params):
     score_params :
         the split scoring parameters
 
+    pred :
+        the predicate defining the current context
+
     Returns
     -------
     max_score :
@@ -725,7 +1225,7 @@ def test_cont_feature(node_data, feature, split_params, score_params):
                                               data_right[targets+[sens]]],
                                              score_params)
                 logging.debug('split score: %s', split_score)
-                if split_score > max_score:
+                if max_score is None or split_score > max_score:
                     max_score = split_score
                     best_threshold = threshold
                     best_metrics = dict(zip(['left', 'right'], metrics))
@@ -733,60 +1233,62 @@ def test_cont_feature(node_data, feature, split_params, score_params):
         return max_score, best_threshold, best_metrics
 
     # split data based on the bin thresholds
-    groups = node_data.groupby(np.digitize(node_data[feature],
-                                           thresholds, right=True))
+    def bin_stats():
+        """
+        Aggregate the data in each bin
+        """
+        groups = node_data.groupby(np.digitize(node_data[feature],
+                                               thresholds, right=True))
+        if data_type == Metric.DATATYPE_CT:
+            # aggregate all the target counts for each bin
+            return [(key, aggregate_values(score_params.metric, group, sens,
+                                           targets[0], expl, dim))
+                    for (key, group) in groups]
+        else:
+            # correlation scores. The bins share a shift so that their
+            # statistics can be summed (the means of the node, or no shift
+            # for metrics that are not invariant to shifts)
+            if score_params.metric.shift_invariant:
+                shift = (node_data[sens].mean(),
+                         node_data[targets[0]].mean())
+            else:
+                shift = (0, 0)
+            return [(key, aggregate_values(score_params.metric, group, sens,
+                                           targets[0], expl, dim,
+                                           shift=shift))
+                    for (key, group) in groups]
 
-    if data_type == Metric.DATATYPE_CT:
-        # aggregate all the target counts for each bin
-        temp = [(key, count_values(group, sens, targets[0], expl, dim))
-                for (key, group) in groups]
-    elif data_type == Metric.DATATYPE_CORR:
-        # correlation scores
-        temp = [(key, corr_values(group, sens, targets[0], expl, dim))
-                for (key, group) in groups]
+    temp = cached_stats(split_params, score_params.metric, pred, feature,
+                        bin_stats)
 
     # get the indices of the bin thresholds
     keys, temp = zip(*temp)
 
     # get the bins and their sizes
     bins, sizes = zip(*temp)
-    total_size = sum(sizes)
 
-    # aggregate of target counts for the complete data
-    total = reduce(operator.add, bins, np.zeros(dim))
+    # aggregate statistics of the left and right children of all splits
+    lefts = np.cumsum(bins, axis=0)
+    rights = lefts[-1] - lefts
+    sizes_left = np.cumsum(sizes)
+    sizes_right = sizes_left[-1] - sizes_left
 
-    # split on the first threshold
-    (data_left, size_left) = (bins[0], sizes[0])
-    (data_right, size_right) = (total - data_left, total_size - size_left)
+    # check the scores of all valid splits at once
+    valid = np.flatnonzero((sizes_left >= min_leaf_size) &
+                           (sizes_right >= min_leaf_size))
+    if not len(valid):
+        return max_score, best_threshold, best_metrics
 
-    # check score if split is valid
-    if (size_left >= min_leaf_size) and (size_right >= min_leaf_size):
-        split_score, metrics = score([data_left, data_right], score_params)
-        logging.debug('testing threshold %s', thresholds[keys[0]])
+    scores = score_batch(np.stack((lefts[valid], rights[valid]), axis=1),
+                         score_params)
+    for (i, split_score) in zip(valid, scores):
+        logging.debug('testing threshold %s', thresholds[keys[i]])
         logging.debug('split score: %s', split_score)
 
-        max_score = split_score
-        best_threshold = thresholds[keys[0]]
-        best_metrics = dict(zip(['left', 'right'], metrics))
-
-    # check all further splits in order by summing bins
-    for i in range(1, len(bins)):
-        (ct_i, size_i) = (bins[i], sizes[i])
-        data_left += ct_i
-        data_right -= ct_i
-
-        size_left += size_i
-        size_right -= size_i
-
-        if (size_left >= min_leaf_size) and (size_right >= min_leaf_size):
-            split_score, metrics = score([data_left, data_right], score_params)
-            logging.debug('testing threshold %s', thresholds[keys[i]])
-            logging.debug('split score: %s', split_score)
-
-            if max_score is None or split_score > max_score:
-                max_score = split_score
-                best_threshold = thresholds[keys[i]]
-                best_metrics = dict(zip(['left', 'right'], metrics))
+    best = valid[_best_split(scores)]
+    max_score, metrics = score([lefts[best], rights[best]], score_params)
+    best_threshold = thresholds[keys[best]]
+    best_metrics = dict(zip(['left', 'right'], metrics))
 
     return max_score, best_threshold, best_metrics
 
@@ -816,28 +1318,102 @@ def score(stats, score_params, weight=1):
     """
 
     metric = score_params.metric
-    agg_type = score_params.agg_type
     conf = score_params.conf
 
-    metrics = [copy(metric) for _ in stats]
-
-    zip_w_metric = zip(stats, metrics)
-
     # compute a score for each child
-    score_list = [metric_copy.compute(child, conf, exact=False).abs_effect()
-                  for (child, metric_copy) in zip_w_metric]
+    child_stats, metrics = metric.compute_batch(stats, conf, exact=False,
+                                                full_output=True)
+    score_list = child_stats[:, 3]
 
     logging.debug('split score list: %s', score_list)
 
+    totals = [np.asarray(group).sum() for group in stats]
+    split_score = _aggregate(score_list[np.newaxis], np.array([totals]),
+                             score_params.agg_type, weight)[0]
+    return split_score, metrics
+
+
+def score_batch(stats, score_params, weight=1):
+    """
+    Compute the scores of a batch of splits with the same number of children
+
+    Parameters
+    ----------
+    stats :
+        array of statistics of shape (splits, children, ...)
+
+    score_params :
+        split scoring parameters
+
+    weight :
+        weight to apply to the scores
+
+    Returns
+    -------
+    scores :
+        array of the aggregate child scores of each split
+    """
+    stats = np.asarray(stats)
+    (num_splits, num_children) = stats.shape[0:2]
+
+    # compute the scores of all children at once
+    child_stats = score_params.metric.compute_batch(
+        stats.reshape((num_splits*num_children,) + stats.shape[2:]),
+        score_params.conf, exact=False)
+    score_list = child_stats[:, 3].reshape(num_splits, num_children)
+
+    totals = stats.reshape(num_splits, num_children, -1).sum(axis=2)
+    return _aggregate(score_list, totals, score_params.agg_type, weight)
+
+
+def _aggregate(score_list, totals, agg_type, weight):
+    """
+    Aggregates child scores into split scores
+
+    Parameters
+    ----------
+    score_list :
+        array of child scores of shape (splits, children)
+
+    totals :
+        array of child sizes of shape (splits, children)
+
+    agg_type :
+        the aggregation type (see `ScoreParams')
+
+    weight :
+        weight to apply to the scores
+
+    Returns
+    -------
+    scores :
+        array of split scores
+    """
     # take the average or maximum of the child scores
     if agg_type == ScoreParams.WEIGHTED_AVG:
-        totals = [group.sum().sum() for group in stats]
-        probas = [(1.0*tot)/sum(totals) for tot in totals]
-        return weight * np.dot(score_list, probas), metrics
+        probas = (1.0*totals)/totals.sum(axis=1)[:, np.newaxis]
+        return weight * np.sum(score_list*probas, axis=1)
     elif agg_type == ScoreParams.AVG:
-        return weight * np.mean(score_list), metrics
+        return weight * np.mean(score_list, axis=1)
     elif agg_type == ScoreParams.MAX:
-        return max(score_list), metrics
+        return np.max(score_list, axis=1)
+
+
+def _best_split(scores):
+    """
+    Index of the first split with the best score, ignoring NaN scores
+
+    Parameters
+    ----------
+    scores :
+        array of split scores
+
+    Returns
+    -------
+    idx :
+        the index of the best split
+    """
+    return np.argmax(np.where(np.isnan(scores), -np.inf, scores))
 
 
 def export_graphviz(decision_tree, encoders, filename="tree.dot"):
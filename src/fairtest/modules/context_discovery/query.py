@@ -0,0 +1,278 @@
+"""
+Compilation of context predicates into SQL and pandas queries.
+
+Contexts can then be evaluated where the data lives, and only aggregated
+contingency tables need to be fetched.
+"""
+from fairtest.modules.metrics import Metric
+from .tree_parser import Bound, tree_contexts
+import numpy as np
+
+
+def predicates(feature_path, encoders=None):
+    """
+    Convert a predicate path into a list of atomic predicates over the
+    original (un-encoded) feature values
+
+    Parameters
+    ----------
+    feature_path :
+        the predicate path, mapping features to a `Bound' or a category
+
+    encoders :
+        the encoders used to encode categorical features
+
+    Returns
+    -------
+    preds :
+        a sorted list of (feature, operator, value) triples. Operators are
+        one of '>', '<=' and '='
+    """
+    preds = []
+    for feature in sorted(feature_path):
+        constraint = feature_path[feature]
+        if isinstance(constraint, Bound):
+            # infinite bounds are always satisfied
+            if constraint.lower != -float('inf'):
+                preds.append((feature, '>', _raw_value(constraint.lower)))
+            if constraint.upper != float('inf'):
+                preds.append((feature, '<=', _raw_value(constraint.upper)))
+        else:
+            if encoders and feature in encoders:
+                constraint = encoders[feature].classes_[int(constraint)]
+            preds.append((feature, '=', _raw_value(constraint)))
+    return preds
+
+
+def to_sql(feature_path, encoders=None):
+    """
+    Compile a predicate path into a SQL boolean expression
+
+    Parameters
+    ----------
+    feature_path :
+        the predicate path
+
+    encoders :
+        the encoders used to encode categorical features
+
+    Returns
+    -------
+    clause :
+        an expression usable in a WHERE clause
+    """
+    clauses = ['{} {} {}'.format(_sql_name(feature), op, _sql_value(value))
+               for (feature, op, value) in predicates(feature_path, encoders)]
+    if not clauses:
+        return '1 = 1'
+    return ' AND '.join(clauses)
+
+
+def to_pandas(feature_path, encoders=None):
+    """
+    Compile a predicate path into an expression for `DataFrame.query' or
+    `DataFrame.eval'
+
+    Parameters
+    ----------
+    feature_path :
+        the predicate path
+
+    encoders :
+        the encoders used to encode categorical features
+
+    Returns
+    -------
+    expr :
+        a boolean pandas expression
+    """
+    clauses = ['`{}` {} {!r}'.format(feature, '==' if op == '=' else op, value)
+               for (feature, op, value) in predicates(feature_path, encoders)]
+    if not clauses:
+        return 'index == index'
+    return ' and '.join(clauses)
+
+
+def compile_contexts(contexts, encoders=None, compiler=to_sql):
+    """
+    Compile the predicate paths of a list of contexts, sharing identical
+    predicates
+
+    Parameters
+    ----------
+    contexts :
+        a list of contexts
+
+    encoders :
+        the encoders used to encode categorical features
+
+    compiler :
+        the compiler for a single predicate path (`to_sql' or `to_pandas')
+
+    Returns
+    -------
+    clauses :
+        the list of distinct compiled predicates
+
+    index :
+        for each context, the index of its predicate in `clauses'
+    """
+    clauses = []
+    positions = {}
+    index = []
+    for context in contexts:
+        clause = compiler(context.path, encoders)
+        if clause not in positions:
+            positions[clause] = len(clauses)
+            clauses.append(clause)
+        index.append(positions[clause])
+    return clauses, index
+
+
+def count_query(table, clauses, sens, target, expl=None):
+    """
+    Build a single query that counts the (target, sens) values of multiple
+    contexts in one scan of a table
+
+    Parameters
+    ----------
+    table :
+        the name of the table
+
+    clauses :
+        the SQL predicates of the contexts
+
+    sens :
+        the name of the sensitive feature
+
+    target :
+        the name of the target feature
+
+    expl :
+        the name of the explanatory feature
+
+    Returns
+    -------
+    query :
+        the SQL query. Each row holds the grouped values followed by one
+        count per context
+    """
+    groups = [_sql_name(col) for col in ([expl] if expl else []) +
+              [target, sens]]
+    counts = ['SUM(CASE WHEN {} THEN 1 ELSE 0 END)'.format(clause)
+              for clause in clauses]
+    return 'SELECT {} FROM {} GROUP BY {}'.format(
+        ', '.join(groups + counts), _sql_name(table), ', '.join(groups))
+
+
+def fetch_contexts(tree, connection, table, features_info, sens, expl, output,
+                   encoders=None, new_metric=None, prune_insignificant=False):
+    """
+    Obtain the contexts of a tree, with contingency tables aggregated by a
+    database rather than computed from the full data.
+
+    This is an alternative to `tree_parser.find_contexts' for metrics over
+    contingency tables, without the pruning of insignificant contexts.
+
+    Parameters
+    ----------
+    tree :
+        the tree to traverse
+
+    connection :
+        a DB-API connection (e.g. `sqlite3')
+
+    table :
+        the name of the table holding the (un-encoded) dataset
+
+    features_info :
+        information for contextual features
+
+    sens :
+        the name of the sensitive feature
+
+    expl :
+        the name of the explanatory feature
+
+    output :
+        the target feature
+
+    encoders :
+        the encoders used to encode categorical features
+
+    new_metric :
+        a metric to use instead of the one the tree was trained with
+
+    prune_insignificant :
+        not supported, a ValueError is raised if set
+
+    Returns
+    -------
+    contexts :
+        the list of contexts, in level-order, with the same data as
+        produced by `tree_parser.find_contexts'
+    """
+    if prune_insignificant:
+        raise ValueError('Contexts fetched from a database can not be pruned')
+
+    metric = new_metric if new_metric is not None else tree.metric
+    if metric.dataType != Metric.DATATYPE_CT:
+        raise ValueError('Only metrics over contingency tables can be '
+                         'computed from a database, Got %s' % metric)
+
+    target = output.names.tolist()[0]
+    contexts = tree_contexts(tree, metric)
+    clauses, index = compile_contexts(contexts, encoders)
+
+    dim = (output.arity, features_info[sens].arity)
+    if expl:
+        dim = (features_info[expl].arity,) + dim
+    cols = ([expl] if expl else []) + [target, sens]
+
+    tables = np.zeros((len(clauses),) + dim, dtype=int)
+    cursor = connection.cursor()
+    cursor.execute(count_query(table, clauses, sens, target, expl))
+    for row in cursor.fetchall():
+        cell = tuple(_encode(col, val, encoders)
+                     for (col, val) in zip(cols, row[:len(cols)]))
+        tables[(slice(None),) + cell] = row[len(cols):]
+
+    for (context, idx) in zip(contexts, index):
+        context.data = tables[idx].copy()
+        context.size = int(context.data.sum())
+
+    return contexts
+
+
+def _raw_value(value):
+    """
+    Convert numpy scalars into python values
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _encode(feature, value, encoders):
+    """
+    Encode a raw categorical value
+    """
+    if encoders and feature in encoders:
+        return int(encoders[feature].transform([value])[0])
+    return int(value)
+
+
+def _sql_name(name):
+    """
+    Quote a SQL identifier
+    """
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+def _sql_value(value):
+    """
+    Quote a SQL literal
+    """
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "''"))
+    return repr(value)
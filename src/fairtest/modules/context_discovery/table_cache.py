@@ -0,0 +1,135 @@
+"""
+Memoization of aggregated tables for sub-populations.
+"""
+from collections import OrderedDict
+from copy import deepcopy
+import hashlib
+import logging
+
+import pandas as pd
+
+
+class TableCache(object):
+    """
+    A bounded LRU cache of aggregated tables (contingency tables or summary
+    statistics), keyed by a dataset fingerprint, a predicate path and the
+    aggregated columns.
+
+    Attributes
+    ----------
+    max_size :
+        the maximum number of cached tables
+
+    hits :
+        the number of lookups answered from the cache
+
+    misses :
+        the number of lookups that required aggregating the data
+    """
+    def __init__(self, max_size=10000):
+        if max_size <= 0:
+            raise ValueError('max_size must be positive')
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._tables = OrderedDict()
+
+    def lookup(self, key, compute):
+        """
+        Gets a table from the cache, or computes and stores it
+
+        Parameters
+        ----------
+        key :
+            a hashable key identifying the table
+
+        compute :
+            a function without arguments that computes the table
+
+        Returns
+        -------
+        table :
+            a copy of the cached table
+        """
+        if key in self._tables:
+            self.hits += 1
+            table = self._tables.pop(key)
+        else:
+            self.misses += 1
+            table = compute()
+            if len(self._tables) >= self.max_size:
+                # evict the least recently used table
+                self._tables.popitem(last=False)
+
+        self._tables[key] = table
+
+        # tables are updated in place by some callers
+        return deepcopy(table)
+
+    def clear(self):
+        """
+        Discards all cached tables and resets the counters
+        """
+        self._tables.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def log_stats(self):
+        """
+        Logs the cache hit and miss counts
+        """
+        logging.info('Table cache: %d hits, %d misses, %d tables',
+                     self.hits, self.misses, len(self))
+
+    def __len__(self):
+        return len(self._tables)
+
+    def __repr__(self):
+        return "%s(max_size=%s, hits=%s, misses=%s)" \
+               % (self.__class__.__name__, self.max_size, self.hits,
+                  self.misses)
+
+
+def fingerprint(data):
+    """
+    Computes a fingerprint of a dataset
+
+    Parameters
+    ----------
+    data :
+        the dataset
+
+    Returns
+    -------
+    digest :
+        a hash of the dataset's index, columns and values
+    """
+    hashes = pd.util.hash_pandas_object(data, index=True).values
+    digest = hashlib.sha1(hashes.tobytes())
+    digest.update(str(list(data.columns)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def path_key(feature_path):
+    """
+    Canonical, hashable representation of a predicate path
+
+    Parameters
+    ----------
+    feature_path :
+        the predicate path, either a dictionary of feature constraints or a
+        list of predicates
+
+    Returns
+    -------
+    key :
+        a sorted tuple of predicates
+    """
+    if isinstance(feature_path, dict):
+        return tuple(sorted((feature, str(value))
+                            for (feature, value) in feature_path.items()))
+    return tuple(sorted(feature_path))
+
+
+# a cache that investigations may share (caching is opt-in)
+DEFAULT_CACHE = TableCache()
@@ -2,8 +2,7 @@
 Parser and Extractor for tree contexts
 """
 from fairtest.modules.metrics import Metric
-import pandas as pd
-import numpy as np
+from . import guided_tree, table_cache
 from copy import deepcopy, copy
 
 
@@ -101,11 +100,109 @@ def update_cont_path(feature_path, feature, lower_bound=None, upper_bound=None):
     feature_path[feature] = bound
 
 
+def update_node_path(feature_path, node):
+    """
+    Add the predicate of a (non-root) tree node to a predicate path
+
+    Parameters
+    ----------
+    feature_path :
+        the feature path to update
+
+    node :
+        the tree node
+    """
+    if node.feature_type == 'continuous':
+        # update the bound on the continuous feature
+        if node.is_left:
+            update_cont_path(feature_path, node.feature,
+                             upper_bound=node.threshold)
+        else:
+            update_cont_path(feature_path, node.feature,
+                             lower_bound=node.threshold)
+    else:
+        # categorical split
+        feature_path[node.feature] = node.category
+
+
+def node_mask(node, values):
+    """
+    Select the values that satisfy the predicate of a (non-root) tree node
+
+    Parameters
+    ----------
+    node :
+        the tree node
+
+    values :
+        the values of the node's split feature
+
+    Returns
+    -------
+    mask :
+        a boolean mask over the values
+    """
+    if node.feature_type == 'continuous':
+        if node.is_left:
+            return values <= node.threshold
+        return values > node.threshold
+    return values == node.category
+
+
+def tree_contexts(tree, metric=None):
+    """
+    List the contexts of a tree without attaching any data to them.
+
+    Contexts are numbered in the level-order of the tree, as in
+    `find_contexts'.
+
+    Parameters
+    ----------
+    tree :
+        the tree to traverse
+
+    metric :
+        the metric to attach to each context. Defaults to the metric the
+        tree was trained with
+
+    Returns
+    -------
+    contexts :
+        the list of contexts, in level-order
+    """
+    if metric is None:
+        metric = tree.metric
+
+    nodes = list(tree.traverse("levelorder"))
+    node_ids = dict((id(node), i) for (i, node) in enumerate(nodes))
+
+    contexts = []
+    for (i, node) in enumerate(nodes):
+        if node.is_root():
+            parent = None
+            path = {}
+        else:
+            parent = contexts[node_ids[id(node.up)]]
+            path = deepcopy(parent.path)
+            update_node_path(path, node)
+
+        context = Context(i, path, node.is_leaf(), node.is_root(), parent,
+                          None, 0, copy(metric))
+        if parent:
+            parent.children.append(context)
+        contexts.append(context)
+
+    return contexts
+
+
 def find_contexts(tree, data, features_info, sens, expl, output,
-                  prune_insignificant=False, new_metric=None):
+                  prune_insignificant=False, new_metric=None, cache=None):
     """
     Traverse a tree and output contexts for each node.
 
+    For metrics over contingency tables, the tables may also be aggregated
+    by a database with `query.fetch_contexts'.
+
     Parameters
     ----------
     tree :
@@ -130,6 +227,12 @@ def find_contexts(tree, data, features_info, sens, expl, output,
         whether contexts should be pruned if they show no significant
         association on the training set
 
+    new_metric :
+        a metric to use instead of the one the tree was trained with
+
+    cache :
+        a `TableCache' for the contingency tables of contexts (or None)
+
     Returns
     -------
     contexts :
@@ -145,10 +248,34 @@ def find_contexts(tree, data, features_info, sens, expl, output,
         tree_node.add_features(id=node_id)
         node_id += 1
 
-    if new_metric is not None:
-        metric_type = new_metric.dataType
-    else:
-        metric_type = tree.metric.dataType
+    tree_metric = new_metric if new_metric is not None else tree.metric
+    metric_type = tree_metric.dataType
+    if metric_type == Metric.DATATYPE_CT:
+        dim = guided_tree.metric_dim(tree_metric, features_info, sens, expl,
+                                     output)
+
+    fingerprint = table_cache.fingerprint(data) if cache is not None \
+        else None
+
+    def contingency_tables(data_node):
+        """
+        Builds the contingency table(s) of a node with the accumulator of
+        the metric
+
+        Parameters
+        ----------
+        data_node :
+            the sub-dataset rooted at this node
+
+        Returns
+        -------
+        data :
+            a contingency table of integer counts, or an array of
+            contingency tables for each value of the explanatory feature
+        """
+        return guided_tree.aggregate_values(tree_metric, data_node, sens,
+                                            targets[0], expl,
+                                            dim)[0].astype(int)
 
     def bfs(node, parent, data_node, feature_path):
         """
@@ -173,56 +300,25 @@ def find_contexts(tree, data, features_info, sens, expl, output,
 
         # current node
         if not is_root:
-            feature = node.feature
-
-            # check type of feature split
-            if node.feature_type == 'continuous':
-                threshold = node.threshold
-
-                # update the bound on the continuous feature
-                if node.is_left:
-                    update_cont_path(feature_path,
-                                     feature, upper_bound=threshold)
-                    data_node = data_node[data_node[feature] <= threshold]
-                else:
-                    update_cont_path(feature_path,
-                                     feature, lower_bound=threshold)
-                    data_node = data_node[data_node[feature] > threshold]
-            else:
-                # categorical split
-                category = node.category
-                feature_path[feature] = category
-                data_node = data_node[data_node[feature] == category]
+            update_node_path(feature_path, node)
+            data_node = data_node[node_mask(node, data_node[node.feature])]
 
         if metric_type == Metric.DATATYPE_CT:
             # categorical data
-
-            if not expl:
-                # create an empty contingency table
-                ct = pd.DataFrame(0, index=range(output.arity),
-                                  columns=range(features_info[sens].arity))
-                # fill in available values
-                ct = ct.add(pd.crosstab(np.array(data_node[targets[0]]),
-                                        np.array(data_node[sens])),
-                            fill_value=0)
-                data = ct
+            if cache is None:
+                data = contingency_tables(data_node)
             else:
-                dim_expl = features_info[expl].arity
-                cts = dim_expl * \
-                      [pd.DataFrame(0, index=range(output.arity),
-                                    columns=range(features_info[sens].arity))]
-
-                for (key, group) in data_node.groupby(expl):
-                    cts[key] = cts[key].add(
-                        pd.crosstab(np.array(group[targets[0]]),
-                                    np.array(group[sens])), fill_value=0)
-
-                data = [ct.values for ct in cts]
+                key = (fingerprint, table_cache.path_key(feature_path),
+                       targets[0], sens, expl, output.arity, metric_type)
+                data = cache.lookup(key, lambda: contingency_tables(data_node))
 
             additional_data = None
             size = len(data_node)
 
         elif metric_type == Metric.DATATYPE_CORR:
+            # the raw data is kept for exact tests, and reduced to aggregate
+            # statistics for approximate ones when testing (see
+            # `multiple_testing.compute_stats')
             if not expl:
                 # continuous data
                 data = data_node[[targets[0], sens]]
@@ -239,8 +335,12 @@ def find_contexts(tree, data, features_info, sens, expl, output,
             size = len(data_node)
             additional_data = {'data_node': data_node}
 
-        # build a context class and store it in the list
+        # build a context class and store it in the list. The fits of the
+        # regressions are not needed for testing
         metric = copy(node.metric)
+        if metric.dataType == Metric.DATATYPE_REG:
+            metric.fit_state = None
+            metric.parent_state = None
 
         ancestor_ptr = parent
         # prune non-significant contexts
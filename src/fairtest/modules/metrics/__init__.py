@@ -6,3 +6,6 @@ from .mutual_info import NMI, CondNMI
 from .binary_metrics import DIFF, RATIO, CondDIFF
 from .correlation import CORR, CondCORR
 from .regression import REGRESSION
+from .batch_metric import BatchMetric
+from .registry import register_metric, unregister_metric, get_metric, \
+    registered_metrics
@@ -0,0 +1,265 @@
+"""
+Mergeable accumulators for the sufficient statistics of metrics.
+
+Contingency table metrics only depend on counts, and correlation metrics on
+the first and second moments of the data. An accumulator reduces batches of
+records to these statistics (`update'), combines partial results computed
+on different parts of the data (`merge') and returns the statistics in the
+format expected by the metric (`finalize').
+"""
+
+import abc
+
+import numpy as np
+
+
+class Accumulator(object):
+    """
+    An abstract accumulator of sufficient statistics.
+
+    The statistics are accumulated in an array of shape `dim', the shape of
+    a context's data for the metric (e.g., `(target arity, sens arity)' for
+    a contingency table, or `(expl arity, target arity, sens arity)' with an
+    explanatory feature). Records are given as arrays with one row per
+    record. If the statistics are grouped by an explanatory feature, the
+    first column holds the group of each record.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, dim):
+        """
+        Initializes an empty accumulator.
+
+        Parameters
+        ----------
+        dim :
+            the shape of the finalized statistics (an int for a single axis)
+        """
+        self.dim = tuple(int(d) for d in np.atleast_1d(dim))
+
+    @abc.abstractmethod
+    def update(self, batch):
+        """
+        Adds a batch of records
+
+        Parameters
+        ----------
+        batch :
+            an array of records, of shape (n, num columns)
+
+        Returns
+        -------
+        self :
+            the updated accumulator
+        """
+        return
+
+    @abc.abstractmethod
+    def merge(self, other):
+        """
+        Adds the statistics of another accumulator of the same shape
+
+        Parameters
+        ----------
+        other :
+            the accumulator to merge
+
+        Returns
+        -------
+        self :
+            the updated accumulator
+        """
+        return
+
+    @abc.abstractmethod
+    def finalize(self):
+        """
+        Returns the accumulated statistics
+
+        Returns
+        -------
+        values :
+            an array of shape `dim'
+        """
+        return
+
+    @abc.abstractmethod
+    def size(self):
+        """
+        Returns the number of records in each group
+
+        Returns
+        -------
+        sizes :
+            an array with the number of records of each explanatory group,
+            or a scalar without explanatory feature
+        """
+        return
+
+    def _check_merge(self, other):
+        if type(other) != type(self) or other.dim != self.dim:
+            raise ValueError('Can not merge accumulators of type %s%s and '
+                             '%s%s' % (type(self).__name__, self.dim,
+                                       type(other).__name__, other.dim))
+
+
+class TableAccumulator(Accumulator):
+    """
+    Accumulates contingency tables.
+
+    Records are rows of integer codes, one column per axis of the table
+    ([expl,] target, sens).
+    """
+    def __init__(self, dim):
+        Accumulator.__init__(self, dim)
+        self.counts = np.zeros(int(np.prod(self.dim)), dtype=np.int64)
+
+    def update(self, batch):
+        batch = np.asarray(batch, dtype=np.intp).reshape(-1, len(self.dim))
+        idx = np.ravel_multi_index(tuple(batch.T), self.dim)
+        self.counts += np.bincount(idx, minlength=len(self.counts))
+        return self
+
+    def merge(self, other):
+        self._check_merge(other)
+        self.counts += other.counts
+        return self
+
+    def finalize(self):
+        return self.counts.reshape(self.dim).astype(float)
+
+    def size(self):
+        counts = self.counts.reshape(self.dim)
+        if len(self.dim) == 3:
+            return counts.sum(axis=(1, 2))
+        return counts.sum()
+
+
+class MomentAccumulator(Accumulator):
+    """
+    Accumulates the moments of two variables x and y used for correlation.
+
+    Records are rows (x, y), or (group, x, y) with an explanatory feature.
+    The means, centered sums of squares and co-moments are updated with the
+    numerically stable pairwise formulas of Chan et al., rather than by
+    accumulating raw sums of squares, which lose precision for data with a
+    large mean compared to its variance.
+
+    The statistics are finalized as the aggregate statistics
+    (sum_x, sum_x2, sum_y, sum_y2, sum_xy, n) used by correlation metrics,
+    taken around a shift of the data. As correlation is invariant to
+    shifts, the finalized statistics are centered (around the means of the
+    data) by default. Statistics finalized around a common shift are
+    additive.
+
+    References
+    ----------
+    T. F. Chan, G. H. Golub and R. J. LeVeque, "Algorithms for computing the
+    sample variance: analysis and recommendations", The American
+    Statistician, 1983.
+    """
+    def __init__(self, dim):
+        Accumulator.__init__(self, dim)
+        if self.dim[-1] != 6:
+            raise ValueError('Moment statistics should have a last dimension '
+                             'of size 6, Got %s' % (self.dim,))
+        groups = self.dim[:-1]
+        self.n = np.zeros(groups)
+        self.mean_x = np.zeros(groups)
+        self.mean_y = np.zeros(groups)
+        self.m2_x = np.zeros(groups)
+        self.m2_y = np.zeros(groups)
+        self.c_xy = np.zeros(groups)
+
+    def update(self, batch):
+        batch = np.asarray(batch, dtype=float).reshape(-1, len(self.dim)+1)
+        if len(self.dim) == 2:
+            group = batch[:, 0].astype(np.intp)
+        else:
+            group = np.zeros(len(batch), dtype=np.intp)
+        (x, y) = (batch[:, -2], batch[:, -1])
+        num_groups = max(self.n.size, 1)
+
+        # moments of the batch, with two passes over the data
+        n = np.bincount(group, minlength=num_groups).astype(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_x = np.where(n > 0, np.bincount(group, weights=x,
+                                                 minlength=num_groups) / n, 0)
+            mean_y = np.where(n > 0, np.bincount(group, weights=y,
+                                                 minlength=num_groups) / n, 0)
+        dx = x - mean_x[group]
+        dy = y - mean_y[group]
+        moments = [np.bincount(group, weights=w, minlength=num_groups)
+                   for w in [dx*dx, dy*dy, dx*dy]]
+
+        shape = self.n.shape
+        self._combine(n.reshape(shape), mean_x.reshape(shape),
+                      mean_y.reshape(shape),
+                      *[m.reshape(shape) for m in moments])
+        return self
+
+    def merge(self, other):
+        self._check_merge(other)
+        self._combine(other.n, other.mean_x, other.mean_y, other.m2_x,
+                      other.m2_y, other.c_xy)
+        return self
+
+    def _combine(self, n, mean_x, mean_y, m2_x, m2_y, c_xy):
+        """
+        Pairwise update of the moments with those of another sample
+        """
+        total = self.n + n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(total > 0, n / total, 0)
+        delta_x = mean_x - self.mean_x
+        delta_y = mean_y - self.mean_y
+        scale = self.n * weight
+
+        self.m2_x = self.m2_x + m2_x + delta_x*delta_x*scale
+        self.m2_y = self.m2_y + m2_y + delta_y*delta_y*scale
+        self.c_xy = self.c_xy + c_xy + delta_x*delta_y*scale
+        self.mean_x = self.mean_x + delta_x*weight
+        self.mean_y = self.mean_y + delta_y*weight
+        self.n = total
+
+    def finalize(self, shift=None):
+        """
+        Returns the accumulated statistics
+
+        Parameters
+        ----------
+        shift :
+            a pair (shift_x, shift_y) subtracted from the data, or None to
+            center the data on its means
+
+        Returns
+        -------
+        values :
+            an array of shape `dim' of aggregate statistics
+            (sum_x, sum_x2, sum_y, sum_y2, sum_xy, n) of the shifted data
+        """
+        if shift is None:
+            (dx, dy) = (np.zeros(self.n.shape), np.zeros(self.n.shape))
+        else:
+            (dx, dy) = (self.mean_x - shift[0], self.mean_y - shift[1])
+
+        return np.stack((self.n*dx, self.m2_x + self.n*dx*dx,
+                         self.n*dy, self.m2_y + self.n*dy*dy,
+                         self.c_xy + self.n*dx*dy, self.n), axis=-1)
+
+    def means(self):
+        """
+        Returns the means of x and y
+
+        Returns
+        -------
+        mean_x, mean_y :
+            the means of each group
+        """
+        return self.mean_x.copy(), self.mean_y.copy()
+
+    def size(self):
+        if len(self.dim) == 2:
+            return self.n.astype(int)
+        return int(self.n)
@@ -0,0 +1,123 @@
+"""
+Metrics defined by vectorized kernels.
+"""
+
+from .metric import Metric
+from .accumulator import TableAccumulator, MomentAccumulator
+from .correlation import centered_moments, raw_moments
+import fairtest.modules.statistics.hypothesis_test as tests
+import fairtest.modules.statistics.confidence_interval as intervals
+import numpy as np
+
+
+class BatchMetric(Metric):
+    """
+    An abstract metric defined by vectorized kernels over its sufficient
+    statistics.
+
+    Subclasses declare the type of their sufficient statistics with
+    `dataType', and implement two static methods over stacks of sufficient
+    statistics:
+
+    - `stats_batch(data, conf)', which returns arrays of the lower and upper
+      ends of the confidence intervals and of the p-values;
+    - `statistic_batch(data)', which returns an array of the metric's
+      values, used for bootstrap confidence intervals.
+
+    The sufficient statistics are contingency tables of shape
+    (..., target arity, sens arity) for `Metric.DATATYPE_CT', and aggregate
+    statistics (sum_x, sum_x2, sum_y, sum_y2, sum_xy, n) of the protected
+    feature (x) and target (y), of shape (..., 6), for
+    `Metric.DATATYPE_CORR'. Complete correlation data is reduced to
+    aggregate statistics before calling the kernels. These are the raw sums
+    of the data, unless the subclass sets `shift_invariant' because its
+    kernels only depend on the data up to a shift (as Pearson correlation
+    does). The statistics may then be taken around any shift, e.g., centered
+    on the means of the data for better numerical accuracy.
+
+    The batch statistics used by context discovery and testing, the
+    statistics of single contexts, exact tests and exact confidence
+    intervals are derived from these kernels. Exact tests are tests of
+    independence between the protected feature and the target, as for the
+    built-in metrics. The metric's accumulator follows from its data type,
+    so that the metric can be used in context discovery, testing and
+    monitoring as the built-in metrics.
+    """
+
+    # max data size for exact tests and confidence intervals
+    approx_LIMIT_P = 1000
+    approx_LIMIT_CI = 1000
+
+    # kernels over sufficient statistics (static methods of subclasses)
+    stats_batch = None
+    statistic_batch = None
+
+    def __init__(self):
+        Metric.__init__(self)
+        if self.dataType == Metric.DATATYPE_CT:
+            self.accumulator_type = TableAccumulator
+        elif self.dataType == Metric.DATATYPE_CORR:
+            self.accumulator_type = MomentAccumulator
+        else:
+            raise ValueError('Batch metrics should be over contingency tables '
+                             'or correlation data, Got %s' % self.dataType)
+
+        if self.stats_batch is None or self.statistic_batch is None:
+            raise ValueError('%s should define stats_batch and '
+                             'statistic_batch' % type(self).__name__)
+
+    def approx_stats_batch(self, data, conf):
+        data = np.asarray(data, dtype=float)
+
+        # complete correlation data of shape (k, n, 2), with (target, sens)
+        # columns
+        if self.dataType == Metric.DATATYPE_CORR and data.shape[-1] == 2:
+            moments = centered_moments if self.shift_invariant \
+                else raw_moments
+            data = moments(data[..., ::-1])
+        return self.stats_batch(data, conf)
+
+    @staticmethod
+    def batch_abs_effect(ci_low, ci_high):
+        return intervals.batch_z_effect(ci_low, ci_high)
+
+    def approx_stats(self, data, conf):
+        batch = np.asarray(data, dtype=float)[np.newaxis]
+        return tuple(float(a[0]) for a in self.approx_stats_batch(batch, conf))
+
+    def exact_test(self, data, conf=None, rng=None):
+        alpha = None if conf is None else 1-conf
+        data = np.asarray(data, dtype=float)
+        if self.dataType == Metric.DATATYPE_CT:
+            return tests.exact_test_ct(data, alpha=alpha, full_output=True,
+                                       rng=rng)
+        return tests.permutation_test_corr(data[:, 0], data[:, 1],
+                                           sequential=True, alpha=alpha,
+                                           full_output=True, rng=rng)
+
+    def exact_ci(self, data, conf, rng=None):
+        data = np.asarray(data, dtype=float)
+        if self.dataType == Metric.DATATYPE_CT:
+            return intervals.bootstrap_ci_ct(data, self.statistic_batch,
+                                             conf=conf, vectorized=True,
+                                             rng=rng)
+        return intervals.bootstrap_ci_corr(data[:, 1], data[:, 0],
+                                           self.statistic_batch, conf=conf,
+                                           vectorized=True,
+                                           center=self.shift_invariant,
+                                           rng=rng)
+
+    @staticmethod
+    def validate(sens, output, expl):
+        if output.num_labels != 1:
+            raise ValueError('Batch metrics only usable for a single target')
+        if expl is not None:
+            raise ValueError('Batch metrics not usable with explanatory '
+                             'features')
+
+    def abs_effect(self):
+        return float(self.batch_abs_effect(np.float64(self.stats[0]),
+                                           np.float64(self.stats[1])))
+
+    def __str__(self):
+        return type(self).__name__
@@ -4,7 +4,8 @@ Binary Ratio and Difference metrics.
 
 import fairtest.modules.statistics.hypothesis_test as tests
 import fairtest.modules.statistics.confidence_interval as intervals
-from .metric import Metric
+from .metric import Metric, sub_group_stats
+from .accumulator import TableAccumulator
 import pandas as pd
 import numpy as np
 from math import sqrt, log, exp
@@ -15,20 +16,30 @@ class DIFF(Metric):
     Difference metric.
     """
     dataType = Metric.DATATYPE_CT
+    accumulator_type = TableAccumulator
 
     @staticmethod
     def approx_stats(data, conf):
         return difference(data, conf=conf)
 
     @staticmethod
-    def exact_test(data):
-        return tests.permutation_test_ct(data)
+    def exact_test(data, conf=None, rng=None):
+        return tests.exact_test_ct(data,
+                                   alpha=None if conf is None else 1-conf,
+                                   full_output=True, rng=rng)
 
     @staticmethod
-    def exact_ci(data, conf):
-        return intervals.bootstrap_ci_ct(data,
-                                         lambda s: difference(s, conf=None),
-                                         conf=conf)
+    def exact_ci(data, conf, rng=None):
+        return intervals.bootstrap_ci_ct(data, batch_difference, conf=conf,
+                                         vectorized=True, rng=rng)
+
+    @staticmethod
+    def approx_stats_batch(data, conf):
+        return batch_difference(data, conf=conf)
+
+    @staticmethod
+    def batch_abs_effect(ci_low, ci_high):
+        return intervals.batch_z_effect(ci_low, ci_high)
 
     @staticmethod
     def validate(sens, output, expl):
@@ -54,28 +65,32 @@ class CondDIFF(Metric):
     Conditional Difference metric.
     """
     dataType = Metric.DATATYPE_CT
+    accumulator_type = TableAccumulator
 
-    def compute(self, data, conf, exact=True):
-
-        pval = \
-            tests.permutation_test_ct_cond(data,
-                                           lambda ct: abs(cond_difference(ct)))
+    def compute(self, data, conf, exact=True, rng=None):
 
-        ci_low, ci_high = intervals.bootstrap_ci_ct_cond(data, cond_difference,
-                                                         conf=conf)
+        (pval, num_samples) = tests.permutation_test_ct_cond(
+            data, lambda cts: np.abs(batch_cond_difference(cts)),
+            vectorized=True, sequential=True, alpha=1-conf, full_output=True,
+            rng=rng)
 
-        self.stats = pd.DataFrame(columns=['ci_low', 'ci_high', 'pval'])
-        self.stats.loc[0] = [ci_low, ci_high, pval]
+        # the intervals of the whole context and of each sub-group are
+        # bootstrapped from the same samples
+        ci_low, ci_high = intervals.bootstrap_ci_ct_strata(
+            data, batch_difference, conf=conf, rng=rng)
 
-        # compute difference for each sub-group
-        for (idx, sub_ct) in enumerate(data):
-            self.stats.loc[idx+1] = DIFF().compute(sub_ct, conf,
-                                                   exact=exact).stats
+        # compute the statistics of each sub-group. The first row holds the
+        # statistics of the whole context
+        _, sub_stats, sub_samples = sub_group_stats(
+            DIFF(), data, conf, exact=exact, rng=rng,
+            exact_cis=np.column_stack((ci_low[1:], ci_high[1:])))
+        self.stats = np.vstack(([ci_low[0], ci_high[0], pval], sub_stats))
+        self.num_samples = num_samples + sub_samples
 
         return self
 
     def abs_effect(self):
-        (ci_low, ci_high, _) = self.stats.loc[0]
+        (ci_low, ci_high, _) = self.stats[0]
         return intervals.z_effect(ci_low, ci_high)
 
     @staticmethod
@@ -83,11 +98,11 @@ class CondDIFF(Metric):
         raise NotImplementedError()
 
     @staticmethod
-    def exact_test(data):
+    def exact_test(data, conf=None, rng=None):
         raise NotImplementedError()
 
     @staticmethod
-    def exact_ci(data, level):
+    def exact_ci(data, level, rng=None):
         raise NotImplementedError()
 
     @staticmethod
@@ -111,20 +126,30 @@ class RATIO(Metric):
     Ratio metric.
     """
     dataType = Metric.DATATYPE_CT
+    accumulator_type = TableAccumulator
 
     @staticmethod
     def approx_stats(data, conf):
         return ratio(data, conf=conf)
 
     @staticmethod
-    def exact_test(data):
-        return tests.permutation_test_ct(data)
+    def exact_test(data, conf=None, rng=None):
+        return tests.exact_test_ct(data,
+                                   alpha=None if conf is None else 1-conf,
+                                   full_output=True, rng=rng)
 
     @staticmethod
-    def exact_ci(data, conf):
-        return intervals.bootstrap_ci_ct(data,
-                                         lambda s: ratio(s, conf=None),
-                                         conf=conf)
+    def exact_ci(data, conf, rng=None):
+        return intervals.bootstrap_ci_ct(data, batch_ratio, conf=conf,
+                                         vectorized=True, rng=rng)
+
+    @staticmethod
+    def approx_stats_batch(data, conf):
+        return batch_ratio(data, conf=conf)
+
+    @staticmethod
+    def batch_abs_effect(ci_low, ci_high):
+        return intervals.batch_z_effect(np.log(ci_low), np.log(ci_high))
 
     @staticmethod
     def validate(sens, output, expl):
@@ -247,6 +272,104 @@ def cond_difference(data):
     return cond_diff
 
 
+def batch_difference(data, conf=None):
+    """
+    Difference metric for a stack of 2x2 contingency tables.
+
+    Parameters
+    ----------
+    data :
+        array of 2x2 contingency tables, of shape (..., 2, 2)
+
+    conf :
+        level for confidence intervals (or None)
+
+    Returns
+    -------
+    diffs :
+        array of differences, of shape (...). If `conf' is set, arrays of
+        the lower and upper bounds of the confidence intervals and of the
+        p-values are returned instead, as in `difference'
+    """
+    data = np.asarray(data, dtype=float) + 5
+
+    # degenerate tables
+    if data.shape[-2] < 2 or data.shape[-1] < 2:
+        zeros = np.zeros(data.shape[:-2])
+        if conf is not None:
+            return zeros, zeros + 1, zeros + 1.0
+        return zeros
+
+    if conf is None:
+        return _batch_difference(data)[0]
+
+    # confidence levels as in Ruggieri et al. '10
+    diffs, sigma_diff = _batch_difference(data)
+    pval = tests.z_test(diffs, sigma_diff)
+    ci_low, ci_high = intervals.ci_norm(conf, diffs, sigma_diff)
+
+    return np.maximum(ci_low, -1), np.minimum(ci_high, 1), pval
+
+
+def batch_difference_z(data):
+    """
+    Z-scores of the difference metric for a stack of 2x2 contingency tables,
+    i.e., the differences divided by their standard deviations.
+
+    Parameters
+    ----------
+    data :
+        array of 2x2 contingency tables, of shape (..., 2, 2)
+
+    Returns
+    -------
+    z_scores :
+        array of z-scores, of shape (...)
+    """
+    data = np.asarray(data, dtype=float) + 5
+    diffs, sigma_diff = _batch_difference(data)
+    return diffs / sigma_diff
+
+
+def _batch_difference(data):
+    """
+    Differences and their standard deviations for a stack of (smoothed) 2x2
+    contingency tables
+    """
+    # transform contingency tables into probability tables
+    tot = np.sum(data, axis=-2)
+    probas = data[..., 1, :]/tot
+    diffs = probas[..., 0] - probas[..., 1]
+
+    (p1, p2) = (probas[..., 0], probas[..., 1])
+    sigma_diff = np.sqrt(p1*(1-p1)/tot[..., 0] + p2*(1-p2)/tot[..., 1])
+    return diffs, sigma_diff
+
+
+def batch_cond_difference(data):
+    """
+    Conditional difference for a stack of 3-way contingency tables.
+
+    Parameters
+    ----------
+    data :
+        array of 3-way contingency tables, of shape (..., groups, 2, 2)
+
+    Returns
+    -------
+    cond_diffs :
+        array of conditional differences, of shape (...), or 0 for stacks
+        of empty tables
+    """
+    data = np.asarray(data, dtype=float)
+    weights = data.sum(axis=(-2, -1))
+    diffs = batch_difference(data)
+
+    # stacks of empty tables have zero weights, and the degenerate value 0
+    total = np.sum(weights, axis=-1)
+    return np.sum(diffs*weights, axis=-1) / np.where(total > 0, total, 1)
+
+
 def ratio(data, conf=None):
     """
     Ratio metric, possibly with confidence intervals
@@ -311,3 +434,48 @@ def ratio(data, conf=None):
         return ci_low, ci_high, pval
     else:
         return ratio_stat
+
+
+def batch_ratio(data, conf=None):
+    """
+    Ratio metric for a stack of 2x2 contingency tables.
+
+    Parameters
+    ----------
+    data :
+        array of 2x2 contingency tables, of shape (..., 2, 2)
+
+    conf :
+        level for confidence intervals (or None)
+
+    Returns
+    -------
+    ratios :
+        array of ratios, of shape (...). If `conf' is set, arrays of the
+        lower and upper bounds of the confidence intervals and of the
+        p-values are returned instead, as in `ratio'
+    """
+    data = np.asarray(data, dtype=float) + 5
+
+    # degenerate tables
+    if data.shape[-2] < 2 or data.shape[-1] < 2:
+        ones = np.ones(data.shape[:-2])
+        if conf is not None:
+            return ones, ones, ones
+        return ones
+
+    # transform contingency tables into probability tables
+    tot = np.sum(data, axis=-2)
+    probas = data[..., 1, :]/tot
+    ratios = probas[..., 0]/probas[..., 1]
+
+    if conf is None:
+        return ratios
+
+    # confidence levels as in Ruggieri et al. '10
+    sigma_log_ratio = np.sqrt(1.0/data[..., 1, 0] + 1.0/data[..., 1, 1] -
+                              1.0/tot[..., 0] - 1.0/tot[..., 1])
+    pval = tests.z_test(np.log(ratios), sigma_log_ratio)
+    ci_log_ratio = intervals.ci_norm(conf, np.log(ratios), sigma_log_ratio)
+
+    return np.exp(ci_log_ratio[0]), np.exp(ci_log_ratio[1]), pval
@@ -2,12 +2,11 @@
 Correlation Metric.
 """
 
-from .metric import Metric
+from .metric import Metric, sub_group_stats
+from .accumulator import MomentAccumulator
 import fairtest.modules.statistics.hypothesis_test as tests
 import fairtest.modules.statistics.confidence_interval as intervals
-import pandas as pd
 import numpy as np
-import scipy.stats as stats
 from math import sqrt, atanh, tanh
 
 
@@ -16,22 +15,41 @@ class CORR(Metric):
     Pearson Correlation Metric.
     """
     dataType = Metric.DATATYPE_CORR
+    accumulator_type = MomentAccumulator
+    shift_invariant = True
 
     @staticmethod
     def approx_stats(data, conf):
         return correlation(data, conf=conf)
 
     @staticmethod
-    def exact_test(data):
-        return tests.permutation_test_corr(data[data.columns[0]],
-                                           data[data.columns[1]])
+    def exact_test(data, conf=None, rng=None):
+        data = np.asarray(data, dtype=float)
+        return tests.permutation_test_corr(
+            data[:, 0], data[:, 1], sequential=True,
+            alpha=None if conf is None else 1-conf, full_output=True,
+            rng=rng)
 
     @staticmethod
-    def exact_ci(data, conf):
+    def exact_ci(data, conf, rng=None):
+        data = np.asarray(data, dtype=float)
         return intervals.bootstrap_ci_corr(
-            data[data.columns[1]], data[data.columns[0]],
-            lambda x, y: min(1, max(-1, stats.pearsonr(x, y)[0])),
-            conf=conf)
+            data[:, 1], data[:, 0],
+            lambda s: np.clip(batch_correlation(s), -1, 1),
+            conf=conf, vectorized=True, center=True, rng=rng)
+
+    @staticmethod
+    def approx_stats_batch(data, conf):
+        data = float_array(data)
+
+        # aggregate statistics of complete data, of shape (k, n, 2)
+        if data.ndim == 3:
+            data = centered_moments(data)
+        return batch_correlation(data, conf=conf)
+
+    @staticmethod
+    def batch_abs_effect(ci_low, ci_high):
+        return intervals.batch_z_effect(ci_low, ci_high)
 
     @staticmethod
     def validate(sens, output, expl):
@@ -57,22 +75,24 @@ class CondCORR(Metric):
     Conditional Correlation metric.
     """
     dataType = Metric.DATATYPE_CORR
-
-    def compute(self, data, conf, exact=True):
-        [ci_low, ci_high, pval] = cond_correlation(data, conf=conf)
-
-        self.stats = pd.DataFrame(columns=['ci_low', 'ci_high', 'pval'])
-        self.stats.loc[0] = [ci_low, ci_high, pval]
-
-        # compute mutual information for each sub-group
-        for (idx, sub_ct) in enumerate(data):
-            self.stats.loc[idx+1] = CORR().compute(sub_ct, conf,
-                                                   exact=exact).stats
+    accumulator_type = MomentAccumulator
+    shift_invariant = True
+
+    def compute(self, data, conf, exact=True, rng=None):
+        # compute the statistics of each sub-group. The first row holds the
+        # statistics of the whole context, the average of the approximate
+        # statistics of the sub-groups (as in `cond_correlation')
+        metric = CORR()
+        approx, sub_stats, self.num_samples = sub_group_stats(
+            metric, data, conf, exact=exact, rng=rng)
+        weights = [metric.get_size(sub_data) for sub_data in data]
+        context_stats = np.average(approx, axis=0, weights=weights)
+        self.stats = np.vstack((context_stats, sub_stats))
 
         return self
 
     def abs_effect(self):
-        (ci_low, ci_high, _) = self.stats.loc[0]
+        (ci_low, ci_high, _) = self.stats[0]
         return intervals.z_effect(ci_low, ci_high)
 
     @staticmethod
@@ -80,11 +100,11 @@ class CondCORR(Metric):
         raise NotImplementedError()
 
     @staticmethod
-    def exact_test(data):
+    def exact_test(data, conf=None, rng=None):
         raise NotImplementedError()
 
     @staticmethod
-    def exact_ci(data, conf):
+    def exact_ci(data, conf, rng=None):
         raise NotImplementedError()
 
     @staticmethod
@@ -157,16 +177,8 @@ def correlation(data, conf=None):
         sum_xy = data[4]
         n = data[5]
     else:
-        if isinstance(data, pd.DataFrame):
-            data = data.values
-        x = data[:, 0]
-        y = data[:, 1]
-        sum_x = x.sum()
-        sum_x2 = np.dot(x, x)
-        sum_y = y.sum()
-        sum_y2 = np.dot(y, y)
-        sum_xy = np.dot(x, y)
-        n = len(x)
+        (sum_x, sum_x2, sum_y, sum_y2, sum_xy, n) = \
+            centered_moments(data).tolist()
 
     try:
         # correlation coefficient
@@ -206,3 +218,136 @@ def correlation(data, conf=None):
             return -1, 1, 1.0
     else:
         return corr
+
+
+def float_array(data):
+    """
+    Converts data to a floating point array. Single precision data is kept
+    in single precision, other data is converted to double precision.
+
+    Parameters
+    ----------
+    data :
+        the data (an array or DataFrame)
+
+    Returns
+    -------
+    data :
+        the data as a float32 or float64 array
+    """
+    data = np.asarray(data)
+    return data.astype(np.result_type(data.dtype, np.float32), copy=False)
+
+
+def centered_moments(data):
+    """
+    Aggregate statistics of complete data, centered on the means of the data.
+
+    The raw sums of squares and products lose most of their precision when
+    the data has a large mean compared to its spread, as the variance and
+    covariance are then obtained as small differences of large numbers.
+    The deviations from the means are computed instead, in the precision of
+    the data, and summed in double precision (with pairwise summation), so
+    that single precision data gives accurate statistics.
+
+    Parameters
+    ----------
+    data :
+        complete data of shape (..., n, 2)
+
+    Returns
+    -------
+    values :
+        array of aggregate statistics
+        (sum_x, sum_x2, sum_y, sum_y2, sum_xy, n) of the centered data, of
+        shape (..., 6)
+    """
+    data = float_array(data)
+    means = np.mean(data, axis=-2, keepdims=True, dtype=np.float64)
+    dev = data - means.astype(data.dtype)
+    (dx, dy) = (dev[..., 0], dev[..., 1])
+
+    # the means are rounded to the precision of the data, so the sums of the
+    # deviations are kept rather than assumed to be 0
+    sums = [np.sum(w, axis=-1, dtype=np.float64)
+            for w in [dx, dx*dx, dy, dy*dy, dx*dy]]
+    sums.append(np.full_like(sums[0], data.shape[-2]))
+    return np.stack(sums, axis=-1)
+
+
+def raw_moments(data):
+    """
+    Aggregate statistics of complete data, without shift.
+
+    Parameters
+    ----------
+    data :
+        complete data of shape (..., n, 2)
+
+    Returns
+    -------
+    values :
+        array of aggregate statistics
+        (sum_x, sum_x2, sum_y, sum_y2, sum_xy, n) of the data, of shape
+        (..., 6)
+    """
+    data = np.asarray(data, dtype=float)
+    (x, y) = (data[..., 0], data[..., 1])
+    sums = [np.sum(w, axis=-1) for w in [x, x*x, y, y*y, x*y]]
+    sums.append(np.full_like(sums[0], data.shape[-2]))
+    return np.stack(sums, axis=-1)
+
+
+def batch_correlation(data, conf=None):
+    """
+    Pearson correlation for a stack of aggregate statistics.
+
+    Parameters
+    ----------
+    data :
+        array of aggregate statistics
+        (sum_x, sum_x2, sum_y, sum_y2, sum_xy, n), of shape (..., 6)
+
+    conf :
+        level for confidence intervals (or None)
+
+    Returns
+    -------
+    corrs :
+        array of correlation coefficients, of shape (...). Degenerate samples
+        have a correlation of 0. If `conf' is set, arrays of the lower and
+        upper bounds of the confidence intervals and of the p-values are
+        returned instead, as in `correlation'
+    """
+    data = np.asarray(data, dtype=float)
+    sum_x, sum_x2, sum_y, sum_y2, sum_xy, n = np.rollaxis(data, -1)
+
+    var_x = n*sum_x2 - sum_x**2
+    var_y = n*sum_y2 - sum_y**2
+
+    if conf is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = (n*sum_xy - sum_x*sum_y) / (np.sqrt(var_x) *
+                                               np.sqrt(var_y))
+            delta = 1e-5
+            valid = np.isfinite(corr) & (-1-delta <= corr) & \
+                (corr <= 1+delta) & (n > 3)
+
+            # Fisher transform
+            fisher = np.arctanh(np.clip(corr, -1+1e-6, 1-1e-6))
+            std = 1.0/np.sqrt(np.where(valid, n-3, 1))
+            pval = tests.z_test(fisher, std)
+            ci_fisher = intervals.ci_norm(conf, fisher, std)
+
+            # inverse transform
+            ci_low, ci_high = np.tanh(ci_fisher[0]), np.tanh(ci_fisher[1])
+
+        valid &= ~(np.isnan(ci_low) | np.isnan(ci_high) | np.isnan(pval))
+        return np.where(valid, ci_low, -1), np.where(valid, ci_high, 1), \
+            np.where(valid, pval, 1.0)
+
+    denom = np.sqrt(np.maximum(var_x, 0) * np.maximum(var_y, 0))
+
+    degenerate = denom == 0
+    return np.where(degenerate, 0, (n*sum_xy - sum_x*sum_y) /
+                    np.where(degenerate, 1, denom))
@@ -3,6 +3,7 @@ Abstract Fairness Metric.
 """
 
 import abc
+from copy import copy
 
 import numpy as np
 
@@ -27,8 +28,26 @@ class Metric(object):
     # max data size for approximate confidence intervals
     approx_LIMIT_CI = None
 
+    # vectorized versions of `approx_stats' and `abs_effect' (static methods
+    # of subclasses), or None
+    approx_stats_batch = None
+    batch_abs_effect = None
+
+    # type of the mergeable accumulator of the metric's sufficient statistics
+    # (see `accumulator.Accumulator'), or None if the metric needs the
+    # complete data
+    accumulator_type = None
+
+    # whether the metric is invariant to shifts of correlation data. The
+    # aggregate statistics of such metrics may be taken around any shift
+    # (e.g., centered on the means of the data), and are the raw sums of the
+    # data otherwise
+    shift_invariant = False
+
     def __init__(self):
         self.stats = None
+        # number of Monte-Carlo samples drawn by the tests of `compute'
+        self.num_samples = 0
 
     def get_size(self, data):
         """
@@ -55,7 +74,7 @@ class Metric(object):
             size = len(data)
         return size
 
-    def compute(self, data, conf, exact=True):
+    def compute(self, data, conf, exact=True, rng=None):
         """
         Computes a confidence interval and p-value for given data.
 
@@ -71,14 +90,20 @@ class Metric(object):
             the confidence level for confidence intervals
         exact :
             indicates whether exact methods should be used
+        rng :
+            the random number generator used by exact methods, or None for
+            numpy's global random state
 
         Returns
         -------
         self :
             a pointer to the current Metric object. The computed statistics
-            are stored as an attribute `stats'
+            are stored as an attribute `stats', and the number of Monte-Carlo
+            samples drawn by the tests (0 if the p-values are exact or
+            approximate) as an attribute `num_samples'
         """
         size = self.get_size(data)
+        self.num_samples = 0
 
         if not exact or size > min(self.approx_LIMIT_P, self.approx_LIMIT_CI):
             try:
@@ -87,14 +112,78 @@ class Metric(object):
                 ci_low, ci_high, pval = 0, 0, 10*10
 
         if exact and size <= self.approx_LIMIT_P:
-            pval = self.exact_test(data)
+            (pval, self.num_samples) = self.exact_test(data, conf, rng=rng)
 
         if exact and size <= self.approx_LIMIT_CI:
-            ci_low, ci_high = self.exact_ci(data, conf)
+            ci_low, ci_high = self.exact_ci(data, conf, rng=rng)
 
         self.stats = [ci_low, ci_high, pval]
         return self
 
+    def compute_batch(self, data, conf, exact=False, rng=None,
+                      full_output=False):
+        """
+        Computes confidence intervals, p-values and absolute effects for a
+        batch of contexts.
+
+        Approximate statistics are computed at once for all contexts if the
+        metric defines `approx_stats_batch'. Otherwise, each context is
+        computed separately as in `compute'.
+
+        Parameters
+        ----------
+        data :
+            a stacked array of the contexts' data (e.g., contingency tables
+            of shape (k, rows, cols)) or a list of the contexts' data
+        conf :
+            the confidence level for confidence intervals
+        exact :
+            indicates whether exact methods should be used
+        rng :
+            the random number generator used by exact methods, or None for
+            numpy's global random state
+        full_output :
+            whether to also return a Metric object for each context
+
+        Returns
+        -------
+        stats :
+            array of shape (k, 4) with the lower and upper ends of the
+            confidence intervals, the p-values and the absolute effects. For
+            metrics with several rows of statistics per context, the first
+            row (for the whole context) is used
+
+        metrics :
+            if `full_output' is set, copies of this Metric with the
+            statistics of each context
+        """
+        if not exact and self.approx_stats_batch is not None:
+            stats = np.zeros((len(data), 4))
+            for (idx, batch) in _stack_by_shape(data):
+                (ci_low, ci_high, pval) = self.approx_stats_batch(batch, conf)
+                stats[idx] = np.column_stack(
+                    (ci_low, ci_high, pval,
+                     self.batch_abs_effect(ci_low, ci_high)))
+
+            if not full_output:
+                return stats
+
+            metrics = [copy(self) for _ in range(len(stats))]
+            for (metric, row) in zip(metrics, stats):
+                metric.stats = list(row[0:3])
+                metric.num_samples = 0
+            return stats, metrics
+
+        metrics = [copy(self).compute(d, conf, exact=exact, rng=rng)
+                   for d in data]
+        stats = np.array([np.append(_first_row(m.stats), m.abs_effect())
+                          for m in metrics])
+        stats = stats.reshape((len(metrics), 4))
+
+        if full_output:
+            return stats, metrics
+        return stats
+
     @abc.abstractmethod
     def abs_effect(self):
         """
@@ -110,7 +199,7 @@ class Metric(object):
 
     @staticmethod
     @abc.abstractmethod
-    def exact_test(data):
+    def exact_test(data, conf=None, rng=None):
         """
         Performs an exact test of independence.
 
@@ -118,11 +207,20 @@ class Metric(object):
         ----------
         data :
             the data to be evaluated
+        conf :
+            the confidence level the test's p-value is compared to, if
+            known. Monte-Carlo tests may use it to stop early
+        rng :
+            the random number generator, or None for numpy's global random
+            state
 
         Returns
         -------
         pval :
             the p-value
+        num_samples :
+            the number of Monte-Carlo samples drawn by the test, or 0 if the
+            p-value is exact
         """
         return
 
@@ -147,7 +245,7 @@ class Metric(object):
 
     @staticmethod
     @abc.abstractmethod
-    def exact_ci(data, conf):
+    def exact_ci(data, conf, rng=None):
         """
         Computes an exact confidence interval.
 
@@ -157,6 +255,9 @@ class Metric(object):
             the data to be evaluated
         conf :
             the confidence level
+        rng :
+            the random number generator, or None for numpy's global random
+            state
 
         Returns
         -------
@@ -190,3 +291,112 @@ class Metric(object):
             the p-value
         """
         return
+
+
+def sub_group_stats(metric, data, conf, exact=True, rng=None, exact_cis=None):
+    """
+    Computes the statistics of each sub-group of a context, for conditional
+    metrics
+
+    The approximate statistics of all sub-groups are computed at once with
+    `metric.compute_batch'. As in `Metric.compute', exact p-values and
+    confidence intervals replace them for small sub-groups if `exact' is set.
+
+    Parameters
+    ----------
+    metric :
+        the metric computed for each sub-group (e.g., DIFF for CondDIFF),
+        which defines `approx_stats_batch'
+    data :
+        the data of each sub-group
+    conf :
+        the confidence level for confidence intervals
+    exact :
+        indicates whether exact methods should be used
+    rng :
+        the random number generator used by exact methods, or None for
+        numpy's global random state
+    exact_cis :
+        exact confidence intervals of each sub-group, of shape (groups, 2),
+        if they were computed along with those of the whole context (see
+        `confidence_interval.bootstrap_ci_ct_strata'), or None to compute
+        them with `metric.exact_ci'
+
+    Returns
+    -------
+    approx :
+        array of shape (groups, 3) with the approximate statistics of each
+        sub-group (lower and upper ends of the confidence intervals and
+        p-values)
+    stats :
+        array of shape (groups, 3) with the statistics of each sub-group
+    num_samples :
+        the number of Monte-Carlo samples drawn by the tests of all
+        sub-groups
+    """
+    approx = metric.compute_batch(data, conf, exact=False)[:, 0:3]
+    stats = approx.copy()
+    num_samples = 0
+
+    if exact:
+        for (idx, sub_data) in enumerate(data):
+            size = metric.get_size(sub_data)
+            if size <= metric.approx_LIMIT_P:
+                (stats[idx, 2], sub_samples) = metric.exact_test(
+                    sub_data, conf, rng=rng)
+                num_samples += sub_samples
+            if size <= metric.approx_LIMIT_CI:
+                stats[idx, 0:2] = metric.exact_ci(sub_data, conf, rng=rng) \
+                    if exact_cis is None else exact_cis[idx]
+
+    return approx, stats, num_samples
+
+
+def _first_row(stats):
+    """
+    Returns the first row of a metric's statistics
+
+    Parameters
+    ----------
+    stats :
+        the statistics of a metric: a triple (ci_low, ci_high, pval), a 2D
+        array with one such row per hypothesis, or a record array with
+        fields ci_low, ci_high and pval
+
+    Returns
+    -------
+    row :
+        an array [ci_low, ci_high, pval]
+    """
+    stats = np.asarray(stats)
+    if stats.dtype.names is not None:
+        return np.array([stats[col][0] for col in ['ci_low', 'ci_high',
+                                                   'pval']], dtype=float)
+    return np.atleast_2d(stats.astype(float))[0]
+
+
+def _stack_by_shape(data):
+    """
+    Stacks the data of contexts with the same shape
+
+    Parameters
+    ----------
+    data :
+        a stacked array of the contexts' data, or a list of the contexts'
+        data
+
+    Returns
+    -------
+    batches :
+        a list of pairs (indices, stacked data) for each shape
+    """
+    if isinstance(data, np.ndarray):
+        return [(np.arange(len(data)), data)]
+
+    data = [np.asarray(d) for d in data]
+    groups = {}
+    for (idx, d) in enumerate(data):
+        groups.setdefault(d.shape, []).append(idx)
+
+    return [(np.array(idx), np.array([data[i] for i in idx]))
+            for (_, idx) in sorted(groups.items())]
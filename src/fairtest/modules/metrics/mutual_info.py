@@ -2,12 +2,12 @@
 Mutual Information Metric.
 """
 
-from .metric import Metric
+from .metric import Metric, sub_group_stats
+from .accumulator import TableAccumulator
 import fairtest.modules.statistics.hypothesis_test as tests
 import fairtest.modules.statistics.confidence_interval as intervals
 import pandas as pd
 import numpy as np
-import scipy.stats as stats
 import sys
 
 
@@ -17,20 +17,30 @@ class NMI(Metric):
     """
 
     dataType = Metric.DATATYPE_CT
+    accumulator_type = TableAccumulator
 
     @staticmethod
     def approx_stats(data, conf):
         return mutual_info(data, norm=True, conf=conf)
 
     @staticmethod
-    def exact_test(data):
-        return tests.permutation_test_ct(data)
+    def exact_test(data, conf=None, rng=None):
+        return tests.exact_test_ct(data,
+                                   alpha=None if conf is None else 1-conf,
+                                   full_output=True, rng=rng)
 
     @staticmethod
-    def exact_ci(data, conf):
-        return intervals.bootstrap_ci_ct(data,
-                                         lambda s: mutual_info(s, norm=True),
-                                         conf=conf)
+    def exact_ci(data, conf, rng=None):
+        return intervals.bootstrap_ci_ct(data, batch_mutual_info, conf=conf,
+                                         vectorized=True, rng=rng)
+
+    @staticmethod
+    def approx_stats_batch(data, conf):
+        return batch_mutual_info(data, norm=True, conf=conf)
+
+    @staticmethod
+    def batch_abs_effect(ci_low, ci_high):
+        return ci_low
 
     @staticmethod
     def validate(sens, output, expl):
@@ -56,29 +66,40 @@ class CondNMI(Metric):
     Conditional Mutual Information metric.
     """
     dataType = Metric.DATATYPE_CT
+    accumulator_type = TableAccumulator
 
-    def compute(self, data, conf, exact=True):
+    def compute(self, data, conf, exact=True, rng=None):
         if exact:
-            pval = tests.permutation_test_ct_cond(
-                data, lambda ct: abs(cond_mutual_info(ct)))
-
-            ci_low, ci_high = intervals.bootstrap_ci_ct_cond(
-                data, lambda ct: abs(cond_mutual_info(ct)), conf=conf)
+            (pval, num_samples) = tests.permutation_test_ct_cond(
+                data, batch_cond_mutual_info, vectorized=True,
+                sequential=True, alpha=1-conf, full_output=True, rng=rng)
+
+            # the intervals of the whole context and of each sub-group are
+            # bootstrapped from the same samples
+            ci_low, ci_high = intervals.bootstrap_ci_ct_strata(
+                data, batch_mutual_info, conf=conf, rng=rng)
+            exact_cis = np.column_stack((ci_low[1:], ci_high[1:]))
         else:
-            [ci_low, ci_high, pval] = cond_mutual_info(data, conf=conf)
-
-        self.stats = pd.DataFrame(columns=['ci_low', 'ci_high', 'pval'])
-        self.stats.loc[0] = [ci_low, ci_high, pval]
+            exact_cis = None
 
-        # compute mutual information for each sub-group
-        for (idx, sub_ct) in enumerate(data):
-            self.stats.loc[idx+1] = NMI().compute(sub_ct, conf,
-                                                  exact=exact).stats
+        # compute the statistics of each sub-group. The first row holds the
+        # statistics of the whole context
+        approx, sub_stats, self.num_samples = sub_group_stats(
+            NMI(), data, conf, exact=exact, rng=rng, exact_cis=exact_cis)
+        if exact:
+            context_stats = [ci_low[0], ci_high[0], pval]
+            self.num_samples += num_samples
+        else:
+            # average of the approximate statistics of the sub-groups, as in
+            # `cond_mutual_info'
+            weights = [np.asarray(sub_ct).sum() for sub_ct in data]
+            context_stats = np.average(approx, axis=0, weights=weights)
+        self.stats = np.vstack((context_stats, sub_stats))
 
         return self
 
     def abs_effect(self):
-        (ci_low, _, _) = self.stats.loc[0]
+        (ci_low, _, _) = self.stats[0]
         return ci_low
 
     @staticmethod
@@ -86,11 +107,11 @@ class CondNMI(Metric):
         raise NotImplementedError()
 
     @staticmethod
-    def exact_test(data):
+    def exact_test(data, conf=None, rng=None):
         raise NotImplementedError()
 
     @staticmethod
-    def exact_ci(data, conf):
+    def exact_ci(data, conf, rng=None):
         raise NotImplementedError()
 
     @staticmethod
@@ -140,56 +161,11 @@ def mutual_info(data, norm=True, conf=None):
     if isinstance(data, pd.DataFrame):
         data = data.values
 
-    # data smoothing
-    data_smoothed = data.copy()
-    data_smoothed += 1
-
-    if data.shape[0] < 2 or data.shape[1] < 2:
-        if conf is not None:
-            return 0, 1, 1.0
-        else:
-            return 0
-
-    # row/column sums
-    sum_x = np.sum(data_smoothed, axis=1)
-    sum_y = np.sum(data_smoothed, axis=0)
-
-    # joint probabilities
-    data_size = np.array(data_smoothed).sum()
-
-    # entropies
-    h_x = stats.entropy(sum_x)
-    h_y = stats.entropy(sum_y)
-    h_xy = stats.entropy(data_smoothed.flatten())
-
-    mi = -h_xy + h_x + h_y
-
-    # normalized mutual info
-    if norm:
-        if (h_x == 0) or (h_y == 0) or (mi == 0):
-            mi = 0
-        else:
-            mi = mi/min(h_x, h_y)
-
-    # no confidence levels, return single measure
+    results = batch_mutual_info(np.asarray(data)[np.newaxis], norm=norm,
+                                conf=conf)
     if conf is None:
-        return mi
-
-    gstat, pval, dof, _ = tests.g_test(data)
-
-    ci_low, ci_high = intervals.ci_mi(gstat, dof, data_size, conf)
-
-    if pval > 1-conf:
-        ci_low = 0
-
-    if norm:
-        ci_low /= min(h_x, h_y)
-        ci_high /= min(h_x, h_y)
-
-    ci_low = max(ci_low, 0)
-    ci_high = min(ci_high, 1)
-
-    return ci_low, ci_high, pval
+        return float(results[0])
+    return tuple(float(a[0]) for a in results)
 
 
 def cond_mutual_info(data, norm=True, conf=None):
@@ -214,3 +190,107 @@ def cond_mutual_info(data, norm=True, conf=None):
     mis = [mutual_info(d, norm, conf) for d in data]
     cond_mi = np.average(mis, axis=0, weights=weights)
     return cond_mi
+
+
+def batch_mutual_info(data, norm=True, conf=None):
+    """
+    Mutual information, with or without normalization, for a stack of
+    contingency tables.
+
+    Parameters
+    ----------
+    data :
+        array of contingency tables, of shape (..., rows, cols)
+
+    norm :
+        whether the MI should be normalized
+
+    conf :
+        level for confidence intervals (or None)
+
+    Returns
+    -------
+    mis :
+        array of mutual information values, of shape (...). If `conf' is
+        set, arrays of the lower and upper bounds of the confidence
+        intervals and of the p-values are returned instead, as in
+        `mutual_info'
+    """
+    # integer counts (the common case) get their n*log(n) values from a
+    # precomputed table
+    counts = tests.as_counts(data)
+    data = np.asarray(data, dtype=float) if counts is None else counts
+
+    if data.shape[-2] < 2 or data.shape[-1] < 2:
+        zeros = np.zeros(data.shape[:-2])
+        if conf is not None:
+            return zeros, zeros + 1, zeros + 1.0
+        return zeros
+
+    # data smoothing
+    data_smoothed = data + 1
+    data_size = data_smoothed.sum(axis=(-2, -1))
+
+    # entropies, from the sums of n*log(n) over the (marginal) tables
+    log_n = np.log(data_size)
+    h_x = log_n - tests.xlogx(data_smoothed.sum(axis=-1)).sum(axis=-1) / \
+        data_size
+    h_y = log_n - tests.xlogx(data_smoothed.sum(axis=-2)).sum(axis=-1) / \
+        data_size
+    h_xy = log_n - tests.xlogx(data_smoothed).sum(axis=(-2, -1))/data_size
+
+    if conf is not None:
+        shape = data.shape
+        gstat, pval, dof = tests.g_test_batch(data.reshape((-1,) +
+                                                           shape[-2:]))
+        (gstat, pval, dof) = [a.reshape(shape[:-2])
+                              for a in (gstat, pval, dof)]
+
+        ci_low, ci_high = intervals.ci_mi(gstat, dof, data_size, conf)
+        ci_low = np.where(pval > 1-conf, 0, ci_low)
+
+        if norm:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ci_low = ci_low / np.minimum(h_x, h_y)
+                ci_high = ci_high / np.minimum(h_x, h_y)
+
+        return np.maximum(ci_low, 0), np.minimum(ci_high, 1), pval
+
+    mi = -h_xy + h_x + h_y
+
+    # normalized mutual info
+    if norm:
+        h_min = np.minimum(h_x, h_y)
+        degenerate = (h_min == 0) | (mi == 0)
+        mi = np.where(degenerate, 0, mi/np.where(degenerate, 1, h_min))
+
+    return mi
+
+
+def batch_cond_mutual_info(data, norm=True):
+    """
+    Conditional mutual information for a stack of 3-way contingency tables.
+
+    Parameters
+    ----------
+    data :
+        array of 3-way contingency tables, of shape (..., groups, rows, cols).
+        The mutual information between the rows and columns is computed
+        given the groups.
+
+    norm :
+        whether the MI should be normalized
+
+    Returns
+    -------
+    cond_mis :
+        array of conditional mutual information values, of shape (...), or
+        0 for stacks of empty tables
+    """
+    data = np.asarray(data, dtype=float)
+    weights = data.sum(axis=(-2, -1))
+    mis = batch_mutual_info(data, norm)
+
+    # stacks of empty tables have zero weights, and the degenerate value 0
+    total = np.sum(weights, axis=-1)
+    return np.sum(mis*weights, axis=-1) / np.where(total > 0, total, 1)
@@ -0,0 +1,113 @@
+"""
+Registry of fairness metrics, indexed by name.
+"""
+
+from .metric import Metric
+from .mutual_info import NMI, CondNMI
+from .binary_metrics import DIFF, RATIO, CondDIFF
+from .correlation import CORR, CondCORR
+from .regression import REGRESSION
+
+_REGISTRY = {}
+
+
+def register_metric(name, factory=None, replace=False):
+    """
+    Registers a metric under a name, so that investigations can refer to it
+    by its name
+
+    Can also be used as a class decorator, if `factory' is omitted.
+
+    Parameters
+    ----------
+    name :
+        the name of the metric
+
+    factory :
+        a Metric subclass, constructed without arguments, or a function
+        that takes the keyword arguments of the investigation (e.g., `topk'
+        for Discovery investigations) and returns a Metric
+
+    replace :
+        whether an existing metric with the same name may be replaced
+
+    Returns
+    -------
+    factory :
+        the registered factory
+    """
+    if factory is None:
+        return lambda f: register_metric(name, f, replace=replace)
+
+    if name in _REGISTRY and not replace:
+        raise ValueError('Metric {} is already registered'.format(name))
+    if not callable(factory):
+        raise ValueError('Metric factories should be callable, Got {}'
+                         .format(factory))
+
+    _REGISTRY[name] = factory
+    return factory
+
+
+def unregister_metric(name):
+    """
+    Removes a metric from the registry
+
+    Parameters
+    ----------
+    name :
+        the name of the metric
+    """
+    if name not in _REGISTRY:
+        raise ValueError('Unknown fairness Metric {}'.format(name))
+    del _REGISTRY[name]
+
+
+def get_metric(name, **kwargs):
+    """
+    Gets a new Metric from its name
+
+    Parameters
+    ----------
+    name :
+        the name of the metric
+
+    kwargs :
+        additional arguments used for constructing a metric. They are
+        ignored for Metric subclasses registered as factories
+
+    Returns
+    -------
+    metric :
+        the metric
+    """
+    if name not in _REGISTRY:
+        raise ValueError('Unknown fairness Metric {}'.format(name))
+
+    factory = _REGISTRY[name]
+    if isinstance(factory, type) and issubclass(factory, Metric):
+        return factory()
+    return factory(**kwargs)
+
+
+def registered_metrics():
+    """
+    Returns the names of the registered metrics
+
+    Returns
+    -------
+    names :
+        the sorted names of the registered metrics
+    """
+    return sorted(_REGISTRY)
+
+
+for (_name, _factory) in [('NMI', NMI), ('MI', NMI), ('CORR', CORR),
+                          ('DIFF', DIFF), ('RATIO', RATIO),
+                          ('CondDIFF', CondDIFF), ('CondNMI', CondNMI),
+                          ('CondCorr', CondCORR), ('CondCORR', CondCORR)]:
+    register_metric(_name, _factory)
+
+register_metric('REGRESSION',
+                lambda topk, candidates=None, **kwargs:
+                REGRESSION(topk=topk, candidates=candidates))
@@ -5,86 +5,143 @@ Regression metric.
 import fairtest.modules.statistics.hypothesis_test as tests
 import fairtest.modules.statistics.confidence_interval as intervals
 from .metric import Metric
-from .binary_metrics import DIFF
+from .binary_metrics import DIFF, batch_difference_z
 from sklearn.linear_model import LogisticRegression
+from scipy import linalg, sparse
 import pandas as pd
 import numpy as np
 
 
+# statistics of a label: its position in the data, the lower and upper ends
+# of the confidence interval of its coefficient and the p-value
+LABEL_STATS_DTYPE = np.dtype([('label', np.intp), ('ci_low', float),
+                              ('ci_high', float), ('pval', float)])
+
+
 class REGRESSION(Metric):
     """
     Logistic Regression metric.
+
+    If a number of `candidates' is set, the labels are first screened by the
+    z-score of their difference metric with the protected feature, and
+    only the candidates with the largest absolute z-scores are fitted by the
+    logistic regression. The label matrix may be sparse (a DataFrame of
+    sparse columns). When the metric is obtained from the metric of an
+    enclosing context with `child_metric', the logistic regression is
+    warm-started from the coefficients of the enclosing context's fit, and
+    the Gram matrix of the labels is obtained from the enclosing context's
+    Gram matrix by removing the contribution of the excluded rows, if they
+    are fewer.
+
+    The statistics of the top labels are a record array of type
+    `LABEL_STATS_DTYPE', sorted by decreasing effect.
     """
     dataType = Metric.DATATYPE_REG
 
-    def __init__(self, topk=10):
+    def __init__(self, topk=10, candidates=None):
         Metric.__init__(self)
+        if candidates is not None and candidates < topk:
+            raise ValueError('The number of candidates (%d) should be at '
+                             'least topk (%d)' % (candidates, topk))
         self.topk = topk
+        self.candidates = candidates
+
+        # the fit of this metric's context, and of the enclosing context
+        self.fit_state = None
+        self.parent_state = None
 
-    def compute(self, data, conf, exact=True):
+    def compute(self, data, conf, exact=True, rng=None):
 
         # regression not yet trained
         if self.stats is None:
-            sens = data[data.columns[-1]]
-            labels = data[data.columns[0:-1]]
+            sens = np.asarray(data[data.columns[-1]])
+            labels = label_matrix(data[data.columns[0:-1]])
+
+            # screen the labels to fit
+            columns = np.arange(labels.shape[1])
+            if self.candidates is not None and \
+                    self.candidates < len(columns):
+                columns = screen_labels(labels, sens, self.candidates)
+                labels = labels[:, columns]
 
-            reg = LogisticRegression()
+            parent = self.parent_state
+            reg = LogisticRegression(warm_start=parent is not None)
+            if parent is not None:
+                reg.coef_ = parent.coefficients(columns)
+                reg.intercept_ = parent.intercept.copy()
             reg.fit(labels, sens)
             sens_pred = reg.predict(labels)
 
             # approximate the standard errors for all regression coefficients
-            mse = np.mean((sens - sens_pred.T)**2)
-            var_est = mse * np.diag(np.linalg.pinv(np.dot(labels.T, labels)))
+            gram = gram_matrix(labels, data.index, parent, columns)
+            mse = np.mean((sens - sens_pred)**2)
+            var_est = mse * inverse_diagonal(gram)
             std_est = np.sqrt(var_est)
-            coeffs = reg.coef_[0].tolist()
+            coeffs = reg.coef_[0]
 
-            # compute confidence intervals and p-values for all coefficients
-            results = pd.DataFrame(coeffs, columns=['coeff'])
-            results['std'] = std_est
-            results['pval'] = tests.z_test(results['coeff'], results['std'])
+            self.fit_state = RegressionFit(reg.coef_, reg.intercept_,
+                                           data.index, labels, gram, columns)
+            # the enclosing context's fit is not needed anymore
+            self.parent_state = None
 
-            ci_s = intervals.ci_norm(conf, results['coeff'], results['std'])
-            results['ci_low'] = ci_s[0]
-            results['ci_high'] = ci_s[1]
-            results = results.fillna(0)
+            # compute confidence intervals and p-values for all coefficients.
+            # Labels absent from the context have undefined statistics
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pvals = tests.z_test(coeffs, std_est)
+                (ci_low, ci_high) = intervals.ci_norm(conf, coeffs, std_est)
+            (pvals, ci_low, ci_high) = [np.where(np.isnan(col), 0, col)
+                                        for col in (pvals, ci_low, ci_high)]
 
             # compute a standardized effect size
-            # and return the topK coefficients
-            results['effect'] = [intervals.z_effect(low, high)
-                                 for (low, high) in
-                                 zip(results['ci_low'], results['ci_high'])]
-            sorted_results = results.sort(columns=['effect'], ascending=False)
-
-            self.stats = \
-                sorted_results[['ci_low', 'ci_high', 'pval']].head(self.topk)
-            # print self.stats
+            # and return the topK coefficients, with the position of their
+            # label in the data
+            effect = intervals.batch_z_effect(ci_low, ci_high)
+            top = np.argsort(-effect, kind='mergesort')[:self.topk]
+            self.stats = label_records(
+                columns[top],
+                np.column_stack((ci_low[top], ci_high[top], pvals[top])))
             return self
         else:
-            # model was already trained, get the top labels
-            top_labels = self.stats.index
-
-            for idx in top_labels:
-                ct = pd.crosstab(data[data.columns[idx]],
-                                 data[data.columns[-1]])
-                self.stats.loc[idx] = DIFF().compute(ct, conf=conf,
-                                                     exact=exact).stats
+            # model was already trained, test the top labels with the DIFF
+            # metric. The statistics are replaced rather than updated, as
+            # they are shared with the metric they were computed by
+            top_labels = self.stats['label']
+            tables = label_tables(
+                label_matrix(data[data.columns[top_labels]]),
+                data[data.columns[-1]])
+            (stats, self.num_samples) = label_diff_stats(
+                tables, conf, exact=exact, full_output=True, rng=rng)
+            self.stats = label_records(top_labels, stats)
             return self
 
+    def child_metric(self):
+        """
+        Returns an untrained metric for sub-contexts of this metric's
+        context, that starts from this metric's fit.
+
+        Returns
+        -------
+        metric :
+            the metric for sub-contexts
+        """
+        metric = REGRESSION(topk=self.topk, candidates=self.candidates)
+        metric.parent_state = self.fit_state
+        return metric
+
     def abs_effect(self):
-        effects = np.array([intervals.z_effect(ci_low, ci_high)
-                            for (ci_low, ci_high, _) in self.stats.values])
-        return np.mean(effects)
+        return np.mean(intervals.batch_z_effect(self.stats['ci_low'],
+                                                self.stats['ci_high']))
 
     @staticmethod
     def approx_stats(data, conf):
         raise NotImplementedError()
 
     @staticmethod
-    def exact_test(data):
+    def exact_test(data, conf=None, rng=None):
         raise NotImplementedError()
 
     @staticmethod
-    def exact_ci(data, conf):
+    def exact_ci(data, conf, rng=None):
         raise NotImplementedError()
 
     @staticmethod
@@ -100,3 +157,346 @@ class REGRESSION(Metric):
 
     def __str__(self):
         return 'REG(topk={})'.format(self.topk)
+
+
+class RegressionFit(object):
+    """
+    The fit of a regression metric on a context, used to warm-start the
+    fits of sub-contexts
+    """
+    def __init__(self, coef, intercept, index, labels, gram, columns):
+        """
+        Parameters
+        ----------
+        coef :
+            the coefficients of the logistic regression
+
+        intercept :
+            the intercept of the logistic regression
+
+        index :
+            the index of the context's data
+
+        labels :
+            the label matrix of the context (dense or sparse)
+
+        gram :
+            the Gram matrix of the labels
+
+        columns :
+            the positions of the fitted labels in the data
+        """
+        self.coef = coef
+        self.intercept = intercept
+        self.index = index
+        self.labels = labels
+        self.gram = gram
+        self.columns = columns
+
+    def positions(self, columns):
+        """
+        Returns the positions of labels in this fit
+
+        Parameters
+        ----------
+        columns :
+            the positions of the labels in the data
+
+        Returns
+        -------
+        positions :
+            the positions of the labels in the fit's label matrix, or -1 for
+            labels that were not fitted
+        """
+        return pd.Index(self.columns).get_indexer(columns)
+
+    def coefficients(self, columns):
+        """
+        Returns the coefficients of labels, to start a fit from
+
+        Parameters
+        ----------
+        columns :
+            the positions of the labels in the data
+
+        Returns
+        -------
+        coef :
+            the coefficients of the labels, of shape (1, len(columns)).
+            Labels that were not fitted get a zero coefficient
+        """
+        pos = self.positions(columns)
+        return np.where(pos >= 0, self.coef[:, pos], 0)
+
+
+def label_records(labels, stats):
+    """
+    Record array of the statistics of labels
+
+    Parameters
+    ----------
+    labels :
+        the positions of the labels in the data
+
+    stats :
+        an array of shape (num labels, 3) with the lower and upper ends of
+        the confidence intervals, and the p-values
+
+    Returns
+    -------
+    records :
+        a record array of type `LABEL_STATS_DTYPE'
+    """
+    records = np.empty(len(labels), dtype=LABEL_STATS_DTYPE)
+    records['label'] = labels
+    for (i, col) in enumerate(['ci_low', 'ci_high', 'pval']):
+        records[col] = stats[:, i]
+    return records
+
+
+def label_matrix(labels):
+    """
+    Converts a DataFrame of labels to a matrix for regression
+
+    Parameters
+    ----------
+    labels :
+        the DataFrame of labels
+
+    Returns
+    -------
+    matrix :
+        a sparse CSR matrix if all the columns of the DataFrame are sparse,
+        and a dense array otherwise
+    """
+    if len(labels.columns) and \
+            all(isinstance(dtype, pd.SparseDtype) for dtype in labels.dtypes):
+        return labels.sparse.to_coo().tocsr().astype(float)
+    return np.asarray(labels, dtype=float)
+
+
+def screen_labels(labels, sens, num):
+    """
+    Selects the labels with the strongest marginal association with a binary
+    protected feature
+
+    The association of each label is measured by the z-score of the
+    difference metric computed over the 2x2 contingency table of the label
+    and the protected feature (see `label_tables').
+
+    Parameters
+    ----------
+    labels :
+        the binary label matrix (dense or sparse), of shape (n, num labels)
+
+    sens :
+        the protected feature, of length n
+
+    num :
+        the number of labels to select
+
+    Returns
+    -------
+    columns :
+        the sorted positions of the selected labels
+    """
+    tables = label_tables(labels, sens)
+    if tables.shape[-1] != 2:
+        return np.arange(min(num, labels.shape[1]))
+
+    z_scores = np.abs(batch_difference_z(tables))
+    return np.sort(np.argsort(-z_scores, kind='mergesort')[:num])
+
+
+def label_tables(labels, sens):
+    """
+    Contingency tables of binary labels and a protected feature
+
+    The tables of all labels are obtained from a single product of the label
+    matrix with the indicators of the protected feature's values. A
+    ValueError is raised if the labels are not binary (0 or 1).
+
+    Parameters
+    ----------
+    labels :
+        the binary label matrix (dense or sparse), of shape (n, num labels)
+
+    sens :
+        the protected feature, of length n
+
+    Returns
+    -------
+    tables :
+        the contingency tables, of shape (num labels, 2, num values), with
+        the counts of label values (0 and 1) for each value of the
+        protected feature, in sorted order
+    """
+    values = labels.data if sparse.issparse(labels) else np.asarray(labels)
+    if np.any((values != 0) & (values != 1)):
+        raise ValueError('Labels should be binary (0 or 1)')
+
+    levels, codes = np.unique(np.asarray(sens), return_inverse=True)
+    indicators = np.zeros((len(codes), len(levels)))
+    indicators[np.arange(len(codes)), codes] = 1
+
+    positives = np.asarray(labels.T.dot(indicators))
+    negatives = indicators.sum(axis=0) - positives
+    return np.stack((negatives, positives), axis=-2)
+
+
+def label_diff_stats(tables, conf, exact=True, full_output=False, rng=None):
+    """
+    DIFF statistics of the contingency tables of labels
+
+    Tables where a label or the protected feature takes a single value are
+    degenerate, as for DIFF on the crosstab of the label. If exact methods
+    are used (for small data, see `Metric.compute'), the tables are tested
+    one by one. Otherwise, the statistics of all tables are computed at once.
+
+    Parameters
+    ----------
+    tables :
+        the contingency tables of the labels (see `label_tables')
+
+    conf :
+        the confidence level for confidence intervals
+
+    exact :
+        indicates whether exact methods should be used
+
+    full_output :
+        whether to also return the number of Monte-Carlo samples drawn by
+        the tests
+
+    rng :
+        the random number generator used by exact methods, or None for
+        numpy's global random state
+
+    Returns
+    -------
+    stats :
+        an array of shape (num labels, 3) with the lower and upper ends of
+        the confidence intervals, and the p-values
+
+    num_samples :
+        the number of Monte-Carlo samples drawn by the tests of all labels,
+        if `full_output' is set
+    """
+    tables = np.asarray(tables, dtype=float)
+    rows = tables.sum(axis=-1) > 0
+    cols = tables.sum(axis=-2) > 0
+    size = tables[0].sum() if len(tables) else 0
+
+    if exact and size <= max(DIFF.approx_LIMIT_P, DIFF.approx_LIMIT_CI):
+        metrics = [DIFF().compute(ct[np.ix_(r, c)], conf=conf, exact=exact,
+                                  rng=rng)
+                   for (ct, r, c) in zip(tables, rows, cols)]
+        stats = np.array([metric.stats for metric in metrics],
+                         dtype=float).reshape(-1, 3)
+        num_samples = sum(metric.num_samples for metric in metrics)
+    else:
+        stats = np.tile([0, 1, 1.0], (len(tables), 1))
+        valid = (rows.sum(axis=-1) == 2) & (cols.sum(axis=-1) == 2)
+        if valid.any():
+            stats[valid] = np.column_stack(
+                DIFF.approx_stats_batch(tables[valid], conf))
+        num_samples = 0
+
+    if full_output:
+        return stats, num_samples
+    return stats
+
+
+def gram_matrix(labels, index, parent=None, columns=None):
+    """
+    Gram matrix of a label matrix
+
+    Parameters
+    ----------
+    labels :
+        the label matrix (dense or sparse)
+
+    index :
+        the index of the rows of the label matrix
+
+    parent :
+        the fit of an enclosing context (with a unique index), or None. If
+        the rows of the enclosing context that are not in `index' are fewer
+        than those in `index', the Gram matrix is obtained by removing their
+        contribution from the Gram matrix of the enclosing context
+
+    columns :
+        the positions of the labels in the data, used to find the labels in
+        the enclosing context's fit. All labels are used if None
+
+    Returns
+    -------
+    gram :
+        the dense Gram matrix
+    """
+    if parent is not None and parent.index.is_unique:
+        if columns is None:
+            columns = np.arange(labels.shape[1])
+        pos = parent.positions(columns)
+        rows = parent.index.get_indexer(index)
+        if len(rows) and rows.min() >= 0 and pos.min() >= 0:
+            excluded = np.ones(len(parent.index), dtype=bool)
+            excluded[rows] = False
+            if excluded.sum() < len(rows):
+                return parent.gram[np.ix_(pos, pos)] - \
+                    _gram(parent.labels[excluded][:, pos])
+
+    return _gram(labels)
+
+
+def _gram(labels):
+    """
+    Dense Gram matrix of a (sparse) label matrix
+    """
+    gram = labels.T.dot(labels)
+    if sparse.issparse(gram):
+        return gram.toarray()
+    return np.asarray(gram)
+
+
+def inverse_diagonal(gram, rcond=1e-12):
+    """
+    Diagonal of the pseudo-inverse of a Gram matrix
+
+    The diagonal is obtained from a Cholesky factorization of the rows and
+    columns of labels that appear in the data, rather than from a full
+    pseudo-inverse. Labels that do not appear have a zero diagonal entry, as
+    in the pseudo-inverse. Singular matrices fall back to the pseudo-inverse.
+
+    Parameters
+    ----------
+    gram :
+        the Gram matrix
+
+    rcond :
+        cut-off of the (squared) pivots of the factorization, relative to
+        the largest diagonal entry, below which the matrix is deemed singular
+
+    Returns
+    -------
+    diag :
+        the diagonal of the pseudo-inverse
+    """
+    diag = np.zeros(len(gram))
+    active = np.flatnonzero(np.diag(gram) > 0)
+    if not len(active):
+        return diag
+
+    sub_gram = gram[np.ix_(active, active)]
+    try:
+        factor = linalg.cholesky(sub_gram, lower=True)
+        if np.min(np.diag(factor))**2 <= rcond * np.max(np.diag(sub_gram)):
+            raise linalg.LinAlgError()
+    except linalg.LinAlgError:
+        return np.diag(np.linalg.pinv(gram))
+
+    # diag(G^-1) are the squared norms of the columns of L^-1, for G = L L^T
+    inv_factor = linalg.solve_triangular(factor, np.eye(len(active)),
+                                         lower=True)
+    diag[active] = np.sum(inv_factor**2, axis=0)
+    return diag
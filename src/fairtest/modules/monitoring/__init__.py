@@ -0,0 +1,3 @@
+"""
+Online Monitoring of Association Contexts.
+"""
@@ -0,0 +1,247 @@
+"""
+Streaming evaluation of the contexts of a trained guided tree.
+"""
+from fairtest.modules.metrics import Metric
+from fairtest.modules.context_discovery.tree_parser import tree_contexts, \
+    node_mask
+from .window import CumulativeWindow
+import numpy as np
+
+
+class ContextMonitor(object):
+    """
+    Online monitor for the association contexts of a trained tree.
+
+    Decisions are fed in micro-batches. Each batch is routed down the tree
+    and only the sufficient statistics of each context (a contingency table
+    or the sums used for correlation) are kept, so that the memory used per
+    context is constant and an update costs O(batch size * tree depth).
+
+    Statistics are aggregated over a `Window' (all decisions seen so far by
+    default). Call `advance' at bucket boundaries (e.g. once a day) for
+    windowed or decayed statistics.
+
+    Attributes
+    ----------
+    contexts :
+        the monitored contexts, in the level-order of the tree
+
+    window :
+        the window over which statistics are aggregated
+
+    shift :
+        for correlation metrics, the pair (shift_sens, shift_target)
+        subtracted from the data before summing (see
+        `accumulator.MomentAccumulator'). For metrics invariant to shifts
+        of the data, it is set to the means of the first batch, so that the
+        sums of all batches remain additive and well-conditioned. It is
+        (0, 0) for other metrics, which get the raw sums of the data
+    """
+    def __init__(self, tree, features_info, sens, expl, output, metric=None,
+                 conf=0.95, window=None):
+        """
+        Initializes a Context Monitor.
+
+        Parameters
+        ----------
+        tree :
+            the trained tree
+
+        features_info :
+            information for contextual features
+
+        sens :
+            the name of the sensitive feature
+
+        expl :
+            the name of the explanatory feature
+
+        output :
+            the target feature
+
+        metric :
+            the metric to monitor. Defaults to the metric the tree was
+            trained with
+
+        conf :
+            the confidence level for confidence intervals
+
+        window :
+            the window over which statistics are aggregated. Defaults to a
+            `CumulativeWindow'
+        """
+        if metric is None:
+            metric = tree.metric
+
+        if metric.dataType not in [Metric.DATATYPE_CT, Metric.DATATYPE_CORR]:
+            raise ValueError('Metric %s can not be monitored online' % metric)
+
+        if not 0 < conf < 1:
+            raise ValueError('conf should be in (0,1), Got %s' % conf)
+
+        self.metric = metric
+        self.conf = conf
+        self.sens = sens
+        self.expl = expl
+        self.target = output.names.tolist()[0]
+
+        if metric.dataType == Metric.DATATYPE_CT:
+            dim = (output.arity, features_info[sens].arity)
+        else:
+            dim = (6,)
+        if expl:
+            dim = (features_info[expl].arity,) + dim
+        self.dim = dim
+
+        # flatten the tree, numbering nodes in level-order as in
+        # `tree_parser.find_contexts'
+        self._nodes = list(tree.traverse("levelorder"))
+        node_ids = dict((id(node), i) for (i, node) in enumerate(self._nodes))
+        self._children = [[node_ids[id(child)]
+                           for child in node.get_children()]
+                          for node in self._nodes]
+        self.contexts = tree_contexts(tree, metric)
+
+        # the features needed to route a batch down the tree
+        self._columns = set([node.feature for node in self._nodes[1:]])
+        self._columns.update([self.sens, self.target])
+        if expl:
+            self._columns.add(expl)
+
+        self.window = window if window is not None else CumulativeWindow()
+        self.window.reset()
+        self.shift = None
+
+    def update(self, batch):
+        """
+        Adds a micro-batch of decisions to the monitored contexts
+
+        Parameters
+        ----------
+        batch :
+            a DataFrame of decisions, encoded as the training data
+        """
+        columns = dict((col, np.asarray(batch[col])) for col in self._columns)
+        values = np.zeros((len(self.contexts),) + self.dim)
+
+        if self.metric.dataType == Metric.DATATYPE_CORR and \
+                self.shift is None and len(batch):
+            if self.metric.shift_invariant:
+                self.shift = (columns[self.sens].astype(float).mean(),
+                              columns[self.target].astype(float).mean())
+            else:
+                self.shift = (0.0, 0.0)
+
+        stack = [(0, np.arange(len(batch)))]
+        while stack:
+            (idx, rows) = stack.pop()
+            values[idx] = self._aggregate(columns, rows)
+
+            for child in self._children[idx]:
+                node = self._nodes[child]
+                sub_rows = rows[node_mask(node, columns[node.feature][rows])]
+                if len(sub_rows):
+                    stack.append((child, sub_rows))
+
+        self.window.add(values)
+
+    def advance(self):
+        """
+        Closes the current bucket of the window
+        """
+        self.window.advance()
+
+    def values(self):
+        """
+        Returns the sufficient statistics of all contexts over the window
+
+        Returns
+        -------
+        values :
+            the statistics of all contexts, stacked along the first axis
+        """
+        values = self.window.total()
+        if values is None:
+            return np.zeros((len(self.contexts),) + self.dim)
+        return values
+
+    def sizes(self):
+        """
+        Returns the number of decisions in each context over the window
+
+        Returns
+        -------
+        sizes :
+            the (possibly decayed) context sizes
+        """
+        values = self.values()
+        if self.metric.dataType == Metric.DATATYPE_CT:
+            return values.reshape(len(values), -1).sum(axis=1)
+        return values[..., 5].reshape(len(values), -1).sum(axis=1)
+
+    def _aggregate(self, columns, rows):
+        """
+        Computes the sufficient statistics of a subset of a batch
+
+        Parameters
+        ----------
+        columns :
+            the batch's columns
+
+        rows :
+            the selected rows
+
+        Returns
+        -------
+        values :
+            the sufficient statistics
+        """
+        sens = columns[self.sens][rows]
+        target = columns[self.target][rows]
+
+        if self.metric.dataType == Metric.DATATYPE_CT:
+            # records ([expl,] target, sens) of a contingency table
+            records = [target, sens]
+        else:
+            # records ([expl,] x, y) for correlation
+            records = [sens, target]
+        if self.expl:
+            records = [columns[self.expl][rows]] + records
+
+        acc = self.metric.accumulator_type(self.dim)
+        acc.update(np.column_stack(records))
+
+        if self.metric.dataType == Metric.DATATYPE_CT:
+            return acc.finalize()
+        return acc.finalize(shift=self.shift)
+
+    def stats(self):
+        """
+        Computes the current effect estimates for all contexts, using
+        approximate methods
+
+        Returns
+        -------
+        stats :
+            the statistics of each context, or None for contexts that have
+            not received any decisions yet
+        """
+        all_stats = []
+        for (context, values, size) in zip(self.contexts, self.values(),
+                                           self.sizes()):
+            context.data = values
+            context.size = size
+            if size <= 0:
+                context.metric.stats = None
+            else:
+                context.metric.compute(values, self.conf, exact=False)
+            all_stats.append(context.metric.stats)
+
+        return all_stats
+
+    def reset(self):
+        """
+        Discards all the statistics collected so far
+        """
+        self.window.reset()
+        self.shift = None
@@ -0,0 +1,213 @@
+"""
+Windowed aggregation of additive sufficient statistics.
+
+Contingency tables and the sums used for correlation are additive, so
+statistics over a window of time can be obtained by merging per-bucket
+statistics instead of re-scanning the data.
+"""
+
+import abc
+
+import numpy as np
+
+
+class Window(object):
+    """
+    An abstract window over additive statistics.
+
+    Statistics are added to the current bucket. Calling `advance' closes the
+    current bucket and opens a new one (e.g. once per day).
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self):
+        self.values = None
+
+    def add(self, values):
+        """
+        Adds statistics to the current bucket
+
+        Parameters
+        ----------
+        values :
+            an array of additive statistics
+        """
+        values = np.asarray(values, dtype=float)
+        if self.values is None:
+            self.values = np.zeros(self._shape(values.shape))
+        self._current()[...] += values
+
+    def _shape(self, shape):
+        """
+        Returns the shape of the storage used for statistics of a given
+        shape
+
+        Parameters
+        ----------
+        shape :
+            the shape of the statistics
+
+        Returns
+        -------
+        shape :
+            the shape of the storage
+        """
+        return shape
+
+    def _current(self):
+        """
+        Returns a view on the current bucket
+        """
+        return self.values
+
+    @abc.abstractmethod
+    def advance(self):
+        """
+        Closes the current bucket and opens a new one
+        """
+        return
+
+    def total(self):
+        """
+        Merges the buckets of the window
+
+        Returns
+        -------
+        total :
+            the aggregated statistics over the window, or None if no
+            statistics were added
+        """
+        if self.values is None:
+            return None
+        return self.values.copy()
+
+    def reset(self):
+        """
+        Discards all statistics
+        """
+        self.values = None
+
+
+class CumulativeWindow(Window):
+    """
+    A window that aggregates all statistics seen so far.
+    """
+    def advance(self):
+        return
+
+    def __str__(self):
+        return 'Cumulative'
+
+
+class TumblingWindow(Window):
+    """
+    Fixed-size, non-overlapping windows of `size' buckets.
+
+    The statistics are discarded every `size' buckets.
+    """
+    def __init__(self, size):
+        """
+        Initializes a Tumbling Window.
+
+        Parameters
+        ----------
+        size :
+            the number of buckets in a window
+        """
+        if size < 1:
+            raise ValueError('window size must be positive')
+        Window.__init__(self)
+        self.size = size
+        self.num_buckets = 0
+
+    def advance(self):
+        self.num_buckets += 1
+        if self.num_buckets == self.size:
+            self.num_buckets = 0
+            if self.values is not None:
+                self.values[...] = 0
+
+    def reset(self):
+        Window.reset(self)
+        self.num_buckets = 0
+
+    def __str__(self):
+        return 'Tumbling(size={})'.format(self.size)
+
+
+class SlidingWindow(Window):
+    """
+    A window over the last `size' buckets.
+
+    Buckets are kept in a ring buffer and merged when the statistics for the
+    window are requested.
+    """
+    def __init__(self, size):
+        """
+        Initializes a Sliding Window.
+
+        Parameters
+        ----------
+        size :
+            the number of buckets in a window
+        """
+        if size < 1:
+            raise ValueError('window size must be positive')
+        Window.__init__(self)
+        self.size = size
+        self.pos = 0
+
+    def _shape(self, shape):
+        return (self.size,) + shape
+
+    def _current(self):
+        return self.values[self.pos]
+
+    def advance(self):
+        self.pos = (self.pos + 1) % self.size
+        if self.values is not None:
+            # the oldest bucket is recycled
+            self.values[self.pos] = 0
+
+    def total(self):
+        if self.values is None:
+            return None
+        return self.values.sum(axis=0)
+
+    def reset(self):
+        Window.reset(self)
+        self.pos = 0
+
+    def __str__(self):
+        return 'Sliding(size={})'.format(self.size)
+
+
+class DecayedWindow(Window):
+    """
+    Exponentially decayed statistics.
+
+    The weight of a bucket is divided by two every `half_life' buckets.
+    """
+    def __init__(self, half_life):
+        """
+        Initializes an exponentially Decayed Window.
+
+        Parameters
+        ----------
+        half_life :
+            the number of buckets after which statistics lose half their
+            weight
+        """
+        if half_life <= 0:
+            raise ValueError('half_life must be positive')
+        Window.__init__(self)
+        self.half_life = half_life
+        self.decay = 0.5 ** (1.0 / half_life)
+
+    def advance(self):
+        if self.values is not None:
+            self.values *= self.decay
+
+    def __str__(self):
+        return 'Decayed(half_life={})'.format(self.half_life)
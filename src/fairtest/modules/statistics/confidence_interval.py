@@ -7,6 +7,8 @@ import numpy as np
 import pandas as pd
 import scipy.stats as stats
 
+from fairtest.modules.statistics.hypothesis_test import _batches
+
 
 def z_effect(ci_low, ci_high):
     """
@@ -35,11 +37,38 @@ def z_effect(ci_low, ci_high):
     return 0 if (ci_low * ci_high < 0) else min(abs(ci_low), abs(ci_high))
 
 
-def ci_mi(g, dof, n, conf):
+def batch_z_effect(ci_low, ci_high):
+    """
+    Compute effect scores for arrays of confidence intervals (see
+    `z_effect').
+
+    Parameters
+    ----------
+    ci_low :
+        Lower bounds of the confidence intervals
+
+    ci_high :
+        Upper bounds of the confidence intervals
+
+    Returns
+    -------
+    scores :
+        An array of effect scores
+    """
+    (ci_low, ci_high) = (np.asarray(ci_low), np.asarray(ci_high))
+    effect = np.minimum(np.abs(ci_low), np.abs(ci_high))
+    return np.where(np.isnan(ci_low) | np.isnan(ci_high) |
+                    (ci_low * ci_high < 0), 0, effect)
+
+
+def ci_mi(g, dof, n, conf, tol=1e-8):
     """
     Compute confidence interval for mutual information from the chi-squared
     distribution.
 
+    All of `g', `dof' and `n' may be arrays, in which case the intervals are
+    computed elementwise.
+
     Parameters
     ----------
     g :
@@ -54,6 +83,10 @@ def ci_mi(g, dof, n, conf):
     conf :
         the confidence level
 
+    tol :
+        the relative tolerance of the noncentrality parameters (see
+        `chi2_noncentrality'). If None, scipy's inversion routine is used
+
     Returns
     -------
     ci_low :
@@ -71,12 +104,94 @@ def ci_mi(g, dof, n, conf):
     p_low = 1-(1-conf)/2
     p_high = (1-conf)/2
 
-    g_low = special.chndtrinc(g, dof, p_low)
-    g_high = special.chndtrinc(g, dof, p_high)
+    g_low = chi2_noncentrality(g, dof, p_low, tol=tol)
+    g_high = chi2_noncentrality(g, dof, p_high, tol=tol)
     ci_low, ci_high = ((g_low+dof)/(2.0*n), (g_high+dof)/(2.0*n))
     return ci_low, ci_high
 
 
+def chi2_noncentrality(x, dof, p, tol=1e-8, max_iter=20):
+    """
+    Find the noncentrality parameter of a noncentral chi-squared distribution
+    for which the cumulative distribution at `x' equals `p'.
+
+    This computes the same as `scipy.special.chndtrinc', but several times
+    faster on arrays: Newton's method is applied to all elements at once,
+    starting from a normal approximation of the square root of the statistic.
+    Elements that do not converge within `max_iter' iterations, and scalar
+    inputs, are computed with scipy.
+
+    Parameters
+    ----------
+    x :
+        the value(s) of the statistic
+
+    dof :
+        the number of degrees of freedom
+
+    p :
+        the target probability
+
+    tol :
+        the relative tolerance of the noncentrality parameter. Larger values
+        trade accuracy for speed. If None, scipy's routine is used
+
+    max_iter :
+        the maximal number of Newton iterations
+
+    Returns
+    -------
+    nc :
+        the noncentrality parameter(s). It is 0 where the central
+        distribution already has `p' mass at most at `x'
+    """
+    # for a single value, the overhead of array operations outweighs the
+    # gains of Newton's method
+    scalar = np.ndim(x) == 0 and np.ndim(dof) == 0 and np.ndim(p) == 0
+    if tol is None or scalar:
+        return special.chndtrinc(x, dof, p)
+
+    (x, dof, p) = np.broadcast_arrays(*[np.asarray(a, dtype=float)
+                                        for a in (x, dof, p)])
+    shape = x.shape
+    (x, dof, p) = (x.ravel(), dof.ravel(), p.ravel())
+
+    # the cumulative distribution decreases with the noncentrality. As in
+    # scipy, the result is undefined without degrees of freedom
+    nc = np.where(dof > 0, 0.0, np.nan)
+    idx = np.flatnonzero((dof > 0) & (special.chdtr(dof, x) > p))
+
+    # initial guess: sqrt(X) is approximately normal, with mean
+    # sqrt(dof + nc) and variance (dof + 2nc) / (2(dof + nc))
+    (xi, di, pi) = (x[idx], dof[idx], p[idx])
+    z = special.ndtri(pi)
+    guess = np.maximum(xi - di, 0)
+    for _ in range(4):
+        sigma = np.sqrt((di + 2*guess) / (2*(di + guess)))
+        guess = np.maximum(np.maximum(np.sqrt(xi) - z*sigma, 0)**2 - di, 0)
+    nc[idx] = guess
+
+    for _ in range(max_iter):
+        if not len(idx):
+            break
+        (xi, di, pi, nci) = (x[idx], dof[idx], p[idx], nc[idx])
+
+        # d/dnc F(x; dof, nc) = (F(x; dof+2, nc) - F(x; dof, nc)) / 2
+        cdf = special.chndtr(xi, di, nci)
+        deriv = 0.5*(special.chndtr(xi, di+2, nci) - cdf)
+        step = (cdf - pi) / np.where(deriv < 0, deriv, -np.inf)
+
+        # damped to remain positive
+        new_nc = np.maximum(nci - step, 0.5*nci)
+        nc[idx] = new_nc
+        idx = idx[np.abs(new_nc - nci) > tol*(1+new_nc)]
+
+    if len(idx):
+        nc[idx] = special.chndtrinc(x[idx], dof[idx], p[idx])
+
+    return nc.reshape(shape)
+
+
 def ci_norm(conf, stat, sigma):
     """
     Confidence interval for a normal approximation.
@@ -104,7 +219,8 @@ def ci_norm(conf, stat, sigma):
     return ci_low, ci_high
 
 
-def bootstrap_ci_ct(data, stat, num_samples=10000, conf=0.95):
+def bootstrap_ci_ct(data, stat, num_samples=10000, conf=0.95,
+                    vectorized=False, batch_size=1000, rng=None):
     """
     Bootstrap confidence interval computation on a contingency table
 
@@ -114,7 +230,8 @@ def bootstrap_ci_ct(data, stat, num_samples=10000, conf=0.95):
         Contingency table collected from independent samples
 
     stat :
-        Statistic to bootstrap. Takes a contingency table as argument
+        Statistic to bootstrap. Takes a contingency table as argument, or a
+        stack of contingency tables if `vectorized' is set
 
     num_samples :
         Number of bootstrap samples to generate
@@ -122,6 +239,17 @@ def bootstrap_ci_ct(data, stat, num_samples=10000, conf=0.95):
     conf :
         Confidence level for the interval
 
+    vectorized :
+        Whether `stat' operates on an array of tables of shape
+        (batch, rows, cols) and returns an array of statistics
+
+    batch_size :
+        Number of bootstrap tables passed to `stat' at once in vectorized mode
+
+    rng :
+        the random number generator (a numpy Generator or RandomState), or
+        None for numpy's global random state
+
     Returns
     -------
     ci_low :
@@ -129,6 +257,7 @@ def bootstrap_ci_ct(data, stat, num_samples=10000, conf=0.95):
     ci_high :
         The upper level of the confidence interval
     """
+    rng = np.random if rng is None else rng
     if isinstance(data, pd.DataFrame):
         data = data.values
 
@@ -143,18 +272,22 @@ def bootstrap_ci_ct(data, stat, num_samples=10000, conf=0.95):
     # Obtain `num_samples' random samples of `n' multinomial values, sampled
     # with replacement from {0, 1, ..., n-1}. For each sample, rebuild a
     # contingency table and compute the stat.
-    temp = np.random.multinomial(n, probas, size=num_samples)
-    bs_stats = [row.reshape(dim) for row in temp]
-    bs_stats = [stat(ct) for ct in bs_stats]
-
-    alpha = 1-conf
-    ci_low = np.percentile(bs_stats, 100*alpha/2)
-    ci_high = np.percentile(bs_stats, 100*(1-alpha/2))
-
-    return ci_low, ci_high
-
-
-def bootstrap_ci_corr(x, y, stat, num_samples=10000, conf=0.95):
+    if vectorized:
+        bs_stats = np.concatenate([
+            stat(rng.multinomial(n, probas, size=size).
+                 reshape((size,) + dim))
+            for size in _batches(num_samples, batch_size)])
+    else:
+        temp = rng.multinomial(n, probas, size=num_samples)
+        bs_stats = [row.reshape(dim) for row in temp]
+        bs_stats = [stat(ct) for ct in bs_stats]
+
+    return _percentile_ci(bs_stats, conf)
+
+
+def bootstrap_ci_corr(x, y, stat, num_samples=10000, conf=0.95,
+                      vectorized=False, max_cells=1000000, center=False,
+                      rng=None):
     """
     Bootstrap confidence interval computation for correlation
 
@@ -167,7 +300,9 @@ def bootstrap_ci_corr(x, y, stat, num_samples=10000, conf=0.95):
         Second dimension of the data
 
     stat :
-        Statistic to bootstrap. Takes a two-dimensional array as input
+        Statistic to bootstrap. Takes the two dimensions of the data as input.
+        If `vectorized' is set, takes instead an array of aggregate statistics
+        (sum_x, sum_x2, sum_y, sum_y2, sum_xy, n) of shape (batch, 6)
 
     num_samples :
         Number of bootstrap samples to generate
@@ -175,26 +310,69 @@ def bootstrap_ci_corr(x, y, stat, num_samples=10000, conf=0.95):
     conf :
         Confidence level for the interval
 
+    vectorized :
+        Whether `stat' operates on aggregate statistics of bootstrap samples
+
+    max_cells :
+        Maximal number of resampling weights drawn at once in vectorized mode
+
+    center :
+        In vectorized mode, whether the aggregate statistics are taken around
+        the means of the data rather than being raw sums. This avoids the
+        loss of precision of raw sums for data with a large mean compared
+        to its spread, for statistics invariant to shifts of the data (as
+        Pearson correlation)
+
+    rng :
+        the random number generator (a numpy Generator or RandomState), or
+        None for numpy's global random state
+
     Returns
     -------
     ci_low :
         The lower level of the confidence interval
     ci_high :
         The upper level of the confidence interval
-    """
-    data = np.array(zip(x, y))
-    n = len(data)
-    idxs = np.random.randint(0, n, (num_samples, n))
-    samples = [data[idx] for idx in idxs]
-    bs_stats = [stat(sample[:, 0], sample[:, 1]) for sample in samples]
-    alpha = 1-conf
-    ci_low = np.percentile(bs_stats, 100*alpha/2)
-    ci_high = np.percentile(bs_stats, 100*(1-alpha/2))
-
-    return ci_low, ci_high
-
 
-def bootstrap_ci_ct_cond(data, stat, num_samples=10000, conf=0.95):
+    Notes
+    -----
+    In vectorized mode, the data is never copied. Each bootstrap sample is
+    represented by a vector of multinomial counts over the distinct (x, y)
+    pairs, which is immediately reduced to the sample's aggregate statistics.
+    """
+    rng = np.random if rng is None else rng
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    if vectorized:
+        # aggregate repeated pairs, so that weights are drawn per distinct pair
+        pairs, counts = np.unique(np.column_stack((x, y)), axis=0,
+                                  return_counts=True)
+        n = counts.sum()
+        probas = (1.0*counts)/n
+        if center:
+            pairs = pairs - np.average(pairs, axis=0, weights=counts)
+        moments = np.column_stack((pairs[:, 0], pairs[:, 0]**2,
+                                   pairs[:, 1], pairs[:, 1]**2,
+                                   pairs[:, 0]*pairs[:, 1],
+                                   np.ones(len(pairs))))
+
+        batch_size = max(1, max_cells // len(pairs))
+        bs_stats = np.concatenate([
+            stat(np.dot(rng.multinomial(n, probas, size=size), moments))
+            for size in _batches(num_samples, batch_size)])
+    else:
+        data = np.column_stack((x, y))
+        n = len(data)
+        idxs = rng.choice(n, (num_samples, n))
+        samples = [data[idx] for idx in idxs]
+        bs_stats = [stat(sample[:, 0], sample[:, 1]) for sample in samples]
+
+    return _percentile_ci(bs_stats, conf)
+
+
+def bootstrap_ci_ct_cond(data, stat, num_samples=10000, conf=0.95,
+                         vectorized=False, batch_size=1000, rng=None):
     """
     Bootstrap confidence interval computation on a 3-way contingency table
 
@@ -204,7 +382,8 @@ def bootstrap_ci_ct_cond(data, stat, num_samples=10000, conf=0.95):
         Contingency table collected from independent samples
 
     stat :
-        Statistic to bootstrap. Takes a 3-way contingency table as argument
+        Statistic to bootstrap. Takes a 3-way contingency table as argument,
+        or a stack of 3-way contingency tables if `vectorized' is set
 
     num_samples :
         Number of bootstrap samples to generate
@@ -212,6 +391,17 @@ def bootstrap_ci_ct_cond(data, stat, num_samples=10000, conf=0.95):
     conf :
         Confidence level for the interval
 
+    vectorized :
+        Whether `stat' operates on an array of tables of shape
+        (batch, groups, rows, cols) and returns an array of statistics
+
+    batch_size :
+        Number of bootstrap tables passed to `stat' at once in vectorized mode
+
+    rng :
+        the random number generator (a numpy Generator or RandomState), or
+        None for numpy's global random state
+
     Returns
     -------
     ci_low :
@@ -219,6 +409,7 @@ def bootstrap_ci_ct_cond(data, stat, num_samples=10000, conf=0.95):
     ci_high :
         The upper level of the confidence interval
     """
+    rng = np.random if rng is None else rng
     data = np.array([ct.values if isinstance(ct, pd.DataFrame)
                      else ct for ct in data])
 
@@ -227,15 +418,102 @@ def bootstrap_ci_ct_cond(data, stat, num_samples=10000, conf=0.95):
 
     probas = [(1.0*ct)/ct.sum() for ct in data]
 
-    # Resample for each explanatory group
-    temp = np.dstack([np.random.multinomial(data[i].sum(),
-                                            probas[i],
-                                            size=num_samples)
-                      for i in range(dim[0])])
+    if vectorized:
+        # Resample each explanatory group, for a batch of samples at a time
+        bs_stats = np.concatenate([
+            stat(np.stack([rng.multinomial(data[i].sum(), probas[i],
+                                           size=size)
+                           for i in range(dim[0])], axis=1).
+                 reshape((size,) + dim))
+            for size in _batches(num_samples, batch_size)])
+    else:
+        # Resample for each explanatory group
+        temp = np.dstack([rng.multinomial(data[i].sum(),
+                                          probas[i],
+                                          size=num_samples)
+                          for i in range(dim[0])])
+
+        bs_stats = [row.T.reshape(dim) for row in temp]
+        bs_stats = [stat(ct) for ct in bs_stats]
+
+    return _percentile_ci(bs_stats, conf)
+
+
+def bootstrap_ci_ct_strata(data, stat, num_samples=10000, conf=0.95,
+                           batch_size=1000, rng=None):
+    """
+    Bootstrap confidence intervals on a 3-way contingency table, for a
+    statistic of each sub-group and for its average over the sub-groups,
+    weighted by their sizes
+
+    All intervals are obtained from the same bootstrap samples, and the
+    statistic is computed once per sub-group and sample. The samples are
+    drawn as in `bootstrap_ci_ct_cond', so that the interval of the average
+    is the one it returns for the weighted average of `stat'.
+
+    Parameters
+    ----------
+    data :
+        Contingency table collected from independent samples
+
+    stat :
+        Statistic to bootstrap. Takes an array of tables of shape
+        (..., rows, cols) and returns an array of statistics of shape (...)
+
+    num_samples :
+        Number of bootstrap samples to generate
+
+    conf :
+        Confidence level for the intervals
+
+    batch_size :
+        Number of bootstrap samples generated at once
+
+    rng :
+        the random number generator (a numpy Generator or RandomState), or
+        None for numpy's global random state
+
+    Returns
+    -------
+    ci_low :
+        The lower levels of the confidence intervals, of shape (groups+1,).
+        The first entry is for the weighted average, followed by each
+        sub-group
+    ci_high :
+        The upper levels of the confidence intervals
+    """
+    rng = np.random if rng is None else rng
+    data = np.array([ct.values if isinstance(ct, pd.DataFrame)
+                     else ct for ct in data])
+
+    dim = data.shape
+    data = [ct.flatten()+1 for ct in data]
+    probas = [(1.0*ct)/ct.sum() for ct in data]
+
+    bs_stats = []
+    for size in _batches(num_samples, batch_size):
+        tables = np.stack([rng.multinomial(data[i].sum(), probas[i],
+                                           size=size)
+                           for i in range(dim[0])], axis=1).\
+            reshape((size,) + dim)
 
-    bs_stats = [row.T.reshape(dim) for row in temp]
-    bs_stats = [stat(ct) for ct in bs_stats]
+        # statistics of each sub-group, and their weighted average
+        values = stat(tables)
+        weights = tables.sum(axis=(-2, -1)).astype(float)
+        average = np.sum(values*weights, axis=-1)/np.sum(weights, axis=-1)
+        bs_stats.append(np.column_stack((average, values)))
+    bs_stats = np.concatenate(bs_stats)
 
+    alpha = 1-conf
+    ci_low = np.percentile(bs_stats, 100*alpha/2, axis=0)
+    ci_high = np.percentile(bs_stats, 100*(1-alpha/2), axis=0)
+    return ci_low, ci_high
+
+
+def _percentile_ci(bs_stats, conf):
+    """
+    Percentile confidence interval from bootstrapped statistics
+    """
     alpha = 1-conf
     ci_low = np.percentile(bs_stats, 100*alpha/2)
     ci_high = np.percentile(bs_stats, 100*(1-alpha/2))
@@ -0,0 +1,247 @@
+"""
+Cost model for choosing between exact and asymptotic statistics.
+
+The runtime of the exact (bootstrap, permutation and sequential
+Monte-Carlo) and asymptotic procedures used by the metrics is estimated from
+the dimensions and size of each context's data. Given a wall-clock budget
+for all contexts, `plan' then chooses the contexts for which exact methods
+are used.
+"""
+
+import logging
+from math import log
+
+import numpy as np
+
+import fairtest.modules.statistics.hypothesis_test as tests
+from fairtest.modules.metrics.metric import Metric
+from fairtest.modules.metrics.mutual_info import NMI, CondNMI
+from fairtest.modules.metrics.binary_metrics import DIFF, CondDIFF
+from fairtest.modules.metrics.correlation import CORR, CondCORR
+
+# Time (in seconds) of the elementary operations of each procedure, measured
+# on a single core. Only their relative magnitudes matter for the choice of
+# methods, but their absolute values determine how well the budget is met.
+
+# asymptotic statistics of a contingency table or correlation
+COST_APPROX = 1.5e-3
+
+# exact test of a 2x2 contingency table
+COST_EXACT_2X2 = 5e-4
+
+# one cell of a permuted contingency table
+COST_PERMUTATION_CELL = 2e-7
+
+# one cell of a bootstrapped contingency table
+COST_BOOTSTRAP_CELL = 2e-7
+
+# one row of a permuted correlation sample
+COST_CORR_PERMUTATION = 2.5e-8
+
+# one row of a bootstrapped correlation sample
+COST_CORR_BOOTSTRAP = 7.5e-8
+
+# one row of data for the regression metric
+COST_REGRESSION = 1e-5
+
+# number of samples of the bootstrap and Monte-Carlo procedures
+NUM_SAMPLES = 10000
+
+# metrics computed on each stratum by the conditional metrics
+SUB_METRICS = {CondNMI: NMI, CondDIFF: DIFF, CondCORR: CORR}
+
+
+def expected_mc_samples(pval=None, alpha=None, num_samples=NUM_SAMPLES):
+    """
+    Expected number of samples of a sequential Monte-Carlo test.
+
+    Parameters
+    ----------
+    pval :
+        an estimate of the p-value (e.g., from an asymptotic test), or None
+
+    alpha :
+        the significance level of the test, or None
+
+    num_samples :
+        the maximal number of samples
+
+    Returns
+    -------
+    num_samples :
+        the expected number of samples before the test stops
+
+    Notes
+    -----
+    See `hypothesis_test.monte_carlo_pval' for the stopping rules. A test
+    stops after about h/p samples for h = `SEQUENTIAL_EXCEEDANCES', or, if
+    the p-value is below `alpha', after about log(1/delta)/alpha samples
+    for an error probability delta.
+    """
+    if pval is None or not np.isfinite(pval):
+        return num_samples
+
+    samples = num_samples
+    if pval > 0:
+        samples = min(samples, tests.SEQUENTIAL_EXCEEDANCES / pval)
+    if alpha is not None and pval < alpha:
+        samples = min(samples, log(1.0 / tests.SEQUENTIAL_ERROR) / alpha)
+
+    return max(int(samples), min(tests.SEQUENTIAL_FIRST_BATCH, num_samples))
+
+
+def estimate_cost(metric, data, exact, conf, pval=None):
+    """
+    Estimated runtime of `metric.compute(data, conf, exact)'.
+
+    Parameters
+    ----------
+    metric :
+        the metric
+
+    data :
+        the data of the context
+
+    exact :
+        whether exact methods are requested
+
+    conf :
+        the confidence level of the statistics
+
+    pval :
+        an estimate of the context's p-value, used to predict the length of
+        sequential Monte-Carlo tests
+
+    Returns
+    -------
+    cost :
+        the estimated runtime, in seconds
+    """
+    alpha = 1 - conf
+
+    if metric.dataType == Metric.DATATYPE_REG:
+        return COST_REGRESSION * len(data)
+
+    # conditional metrics test the whole table, and each stratum separately
+    if type(metric) in SUB_METRICS:
+        strata = [np.asarray(d) for d in data]
+        sub_metric = SUB_METRICS[type(metric)]()
+        cost = sum(estimate_cost(sub_metric, d, exact, conf) for d in strata)
+
+        if isinstance(metric, CondCORR) or \
+                (isinstance(metric, CondNMI) and not exact):
+            return cost + COST_APPROX * len(strata)
+
+        cells = sum(d.size for d in strata)
+        samples = expected_mc_samples(pval, alpha)
+        return cost + cells * (samples * COST_PERMUTATION_CELL +
+                               NUM_SAMPLES * COST_BOOTSTRAP_CELL)
+
+    size = metric.get_size(data)
+    exact_p = exact and size <= metric.approx_LIMIT_P
+    exact_ci = exact and size <= metric.approx_LIMIT_CI
+
+    cost = 0.0
+    if not (exact_p and exact_ci):
+        cost += COST_APPROX
+
+    if metric.dataType == Metric.DATATYPE_CT:
+        cells = np.asarray(data).size
+        if exact_p:
+            if np.asarray(data).shape == (2, 2):
+                cost += COST_EXACT_2X2
+            else:
+                samples = expected_mc_samples(pval, alpha)
+                cost += samples * cells * COST_PERMUTATION_CELL
+        if exact_ci:
+            cost += NUM_SAMPLES * cells * COST_BOOTSTRAP_CELL
+    else:
+        rows = size
+        if exact_p:
+            samples = expected_mc_samples(pval, alpha)
+            cost += samples * rows * COST_CORR_PERMUTATION
+        if exact_ci:
+            cost += NUM_SAMPLES * rows * COST_CORR_BOOTSTRAP
+
+    return cost
+
+
+def plan(metrics, data, confs, budget, n_jobs=1):
+    """
+    Chooses the contexts for which exact methods are used, so that the
+    estimated runtime of all contexts fits within a budget.
+
+    All contexts start with asymptotic methods. Contexts are then switched
+    to exact methods by increasing size, as long as the budget allows it:
+    asymptotic approximations are least accurate for small contexts, which
+    are also the cheapest to handle exactly. The p-values of asymptotic
+    tests are used to predict the length of sequential Monte-Carlo tests.
+
+    Parameters
+    ----------
+    metrics :
+        the metrics of the contexts
+
+    data :
+        the data of the contexts
+
+    confs :
+        the confidence levels of the contexts' statistics
+
+    budget :
+        the wall-clock budget, in seconds
+
+    n_jobs :
+        the number of worker processes computing the statistics
+
+    Returns
+    -------
+    exact :
+        a list of booleans indicating which contexts use exact methods
+    """
+    pvals = [_approx_pval(m, d, conf)
+             for (m, d, conf) in zip(metrics, data, confs)]
+
+    approx_costs = [estimate_cost(m, d, False, conf)
+                    for (m, d, conf) in zip(metrics, data, confs)]
+    exact_costs = [estimate_cost(m, d, True, conf, pval)
+                   for (m, d, conf, pval) in zip(metrics, data, confs, pvals)]
+
+    capacity = budget * max(n_jobs, 1)
+    total = sum(approx_costs)
+
+    exact = [False]*len(metrics)
+    order = sorted(range(len(metrics)),
+                   key=lambda i: _size(metrics[i], data[i]))
+    for i in order:
+        extra = exact_costs[i] - approx_costs[i]
+        if total + extra <= capacity:
+            exact[i] = True
+            total += extra
+
+    logging.info('Exact methods for %d of %d contexts (estimated %.2fs)',
+                 sum(exact), len(exact), total / max(n_jobs, 1))
+    return exact
+
+
+def _approx_pval(metric, data, conf):
+    """
+    P-value of an asymptotic test, or None if there is no cheap asymptotic
+    test for the metric
+    """
+    if metric.dataType == Metric.DATATYPE_REG or type(metric) in SUB_METRICS:
+        return None
+    try:
+        return metric.approx_stats(data, conf)[2]
+    except ValueError:
+        return None
+
+
+def _size(metric, data):
+    """
+    Size of a context's data, including conditional metrics
+    """
+    if type(metric) in SUB_METRICS:
+        sub_metric = SUB_METRICS[type(metric)]()
+        return sum(sub_metric.get_size(d) for d in data)
+    return metric.get_size(data)
@@ -4,9 +4,27 @@ Statistical Hypothesis Tests
 
 import pandas as pd
 import scipy.stats as stats
+import scipy.special as special
 import numpy as np
-import sklearn.metrics as metrics
-from collections import Counter
+import logging
+import itertools
+
+# number of exceedances after which a sequential Monte-Carlo test stops
+# (Besag and Clifford, 1991)
+SEQUENTIAL_EXCEEDANCES = 100
+
+# probability that a sequential Monte-Carlo test wrongly stops early for a
+# rejection
+SEQUENTIAL_ERROR = 1e-3
+
+# size of the first batch of samples in a sequential Monte-Carlo test
+SEQUENTIAL_FIRST_BATCH = 100
+
+# integer counts below this bound get their x*log(x) values from a shared
+# precomputed table (see `xlogx')
+XLOGX_TABLE_SIZE = 2**16
+
+_xlogx_table = np.zeros(0)
 
 
 def g_test(data, correction=False):
@@ -39,14 +57,91 @@ def g_test(data, correction=False):
     if isinstance(data, pd.DataFrame):
         data = data.values
 
-    # remove zero rows/columns
-    data = data[~np.all(data == 0, axis=1)]
-    data = data[:, ~np.all(data == 0, axis=0)]
-
+    data = np.asarray(data)
     if data.sum() == 0:
         return 0, 1.0, 1, None
 
-    return stats.chi2_contingency(data, correction=correction, lambda_="log-likelihood")
+    (g, pval, dof) = g_test_batch(data[np.newaxis], correction=correction)
+
+    # expected frequencies of the table without zero rows/columns
+    rows = data.sum(axis=1)
+    cols = data.sum(axis=0)
+    expected = np.outer(rows[rows > 0], cols[cols > 0]) / (1.0*data.sum())
+
+    return g[0], pval[0], dof[0], expected
+
+
+def g_test_batch(data, correction=False):
+    """
+    G-test (likelihood ratio test) of a stack of contingency tables.
+
+    Zero rows and columns of each table are ignored, as in `g_test'.
+
+    Parameters
+    ----------
+    data :
+        an array of contingency tables, of shape (k, rows, cols)
+
+    correction :
+        whether to apply Yates' continuity correction to tables with one
+        degree of freedom
+
+    Returns
+    -------
+    g :
+        the test statistics, of shape (k,)
+    p :
+        the p-values
+    df :
+        the numbers of degrees of freedom
+
+    References
+    ----------
+    https://en.wikipedia.org/wiki/G-test
+    """
+    counts = None if correction else as_counts(data)
+    data = np.asarray(data, dtype=float) if counts is None else counts
+
+    rows = data.sum(axis=2)
+    cols = data.sum(axis=1)
+    n = rows.sum(axis=1)
+
+    # degrees of freedom, ignoring zero rows/columns
+    dof = (np.count_nonzero(rows, axis=1) - 1) * \
+        (np.count_nonzero(cols, axis=1) - 1)
+    dof = np.maximum(dof, 0)
+
+    if counts is not None:
+        # for integer counts, G = 2*(sum of n*log(n) over the cells, minus
+        # those of the margins, plus that of the total), which only needs
+        # table lookups. Zero rows and columns do not contribute
+        g = 2 * (xlogx(counts).sum(axis=(1, 2)) - xlogx(rows).sum(axis=1) -
+                 xlogx(cols).sum(axis=1) + xlogx(n))
+        g = np.where(dof > 0, np.maximum(g, 0), 0)
+        pval = np.where(dof > 0, special.chdtrc(np.maximum(dof, 1), g), 1.0)
+        return g, pval, np.where(n > 0, dof, 1)
+
+    expected = rows[:, :, np.newaxis] * cols[:, np.newaxis, :] / \
+        np.maximum(n, 1)[:, np.newaxis, np.newaxis]
+
+    if correction:
+        # move the observed frequencies half a unit towards the expected ones
+        diff = expected - data
+        shift = np.sign(diff) * np.minimum(0.5, np.abs(diff))
+        data = np.where((dof == 1)[:, np.newaxis, np.newaxis],
+                        data + shift, data)
+
+    # cells with zero expected frequencies are in zero rows/columns
+    ratio = np.where(expected > 0, data, 1) / np.where(expected > 0, expected,
+                                                       1)
+    g = 2 * special.xlogy(data, ratio).sum(axis=(1, 2))
+    g = np.where(dof > 0, g, 0)
+    pval = np.where(dof > 0, special.chdtrc(np.maximum(dof, 1), g), 1.0)
+
+    # empty tables
+    dof = np.where(n > 0, dof, 1)
+
+    return g, pval, dof
 
 
 def z_test(stat, sigma):
@@ -75,55 +170,324 @@ def z_test(stat, sigma):
     return pval
 
 
-def permutation_test_ct2(data, num_samples=10000):
+def permutation_test_ct2(data, num_samples=10000, batch_size=1000,
+                         sequential=False, alpha=None, full_output=False,
+                         rng=None):
     """
     Monte-Carlo permutation test for a 2-way contingency table
 
+    Permuted tables are drawn directly from the multivariate hypergeometric
+    distribution with the margins of the observed table, in batches.
+
     Parameters
     ----------
     data :
         the contingency table
 
     num_samples :
-        the number of random permutations to perform
+        the (maximal) number of random permutations to perform
+
+    batch_size :
+        the number of permuted tables generated at once
+
+    sequential :
+        whether to stop early once the p-value is settled (see
+        `monte_carlo_pval')
+
+    alpha :
+        the significance level the p-value is compared to, for early stopping
+
+    full_output :
+        whether to also return the number of permutations performed
+
+    rng :
+        the random number generator (a numpy Generator or RandomState), or
+        None for numpy's global random state
 
     Returns
     -------
     pval :
         the p-value
 
+    num_samples :
+        the number of permutations performed, if `full_output' is set
+
     References
     ----------
     https://en.wikipedia.org/wiki/Resampling_(statistics)
     """
-    if isinstance(data, pd.DataFrame):
-        data = np.array(data)
+    data = np.array(data, dtype=int)
+
+    # with fixed margins, the mutual information of a table only depends on
+    # the sum of n*log(n) over all cells
+    stat_0 = xlogx(data).sum()
+    tol = 1e-9 * max(1.0, abs(stat_0))
+
+    def exceedances(size):
+        tables = sample_tables(data, size, rng=rng)
+        return xlogx(tables).sum(axis=(1, 2)) >= stat_0 - tol
+
+    return monte_carlo_pval(exceedances, num_samples, batch_size,
+                            sequential=sequential, alpha=alpha,
+                            full_output=full_output)
+
+
+def monte_carlo_pval(exceedances, num_samples, batch_size, sequential=False,
+                     alpha=None, full_output=False):
+    """
+    Monte-Carlo p-value from batches of random samples.
+
+    With `sequential' set, sampling stops as soon as the test's outcome is
+    settled:
+
+    - after `SEQUENTIAL_EXCEEDANCES' samples at least as extreme as the
+      observed statistic, with p-value h/m for h exceedances in m samples
+      (Besag and Clifford, 1991). This p-value is valid, and large p-values
+      are typically settled after a few hundred samples.
+
+    - if `alpha' is given, once the Clopper-Pearson upper confidence bound on
+      the p-value falls below `alpha'. The bound is returned as the p-value.
+      The probability of stopping wrongly is at most `SEQUENTIAL_ERROR',
+      over all batches.
+
+    When the test's significance level is Bonferroni adjusted, as in
+    `multiple_testing', `alpha' should be the adjusted level, which is also
+    the smallest level of Holm's procedure.
+
+    Parameters
+    ----------
+    exceedances :
+        function that draws a given number of random samples and returns a
+        boolean array indicating the samples at least as extreme as the
+        observed data
+
+    num_samples :
+        the maximal number of samples
+
+    batch_size :
+        the maximal number of samples drawn at once
+
+    sequential :
+        whether to stop early
 
-    dim = data.shape
-    data_x = []
-    data_y = []
+    alpha :
+        the significance level, or None
 
-    for x in range(0, dim[0]):
-        for y in range(0, dim[1]):
-            data_x += [x]*data[x, y]
-            data_y += [y]*data[x, y]
+    full_output :
+        whether to also return the number of samples drawn
 
-    stat_0 = metrics.mutual_info_score(data_x, data_y)
+    Returns
+    -------
+    pval :
+        the p-value
+
+    num_samples :
+        the number of samples drawn, if `full_output' is set
+
+    References
+    ----------
+    Besag, J., & Clifford, P. (1991). Sequential Monte Carlo p-values.
+    Biometrika, 78(2), 301-304.
+    """
+    if sequential:
+        sizes = list(_growing_batches(num_samples, batch_size,
+                                      SEQUENTIAL_FIRST_BATCH))
+    else:
+        sizes = list(_batches(num_samples, batch_size))
+
+    # split the error probability over all looks at the data
+    delta = SEQUENTIAL_ERROR / len(sizes)
 
     k = 0
-    for _ in range(num_samples):
-        np.random.shuffle(data_x)
-        mi = metrics.mutual_info_score(data_x, data_y)
-        k += stat_0 < mi
+    m = 0
+    pval = None
+    for size in sizes:
+        exceed = np.asarray(exceedances(size), dtype=bool)
+
+        if sequential:
+            hits = np.flatnonzero(k + np.cumsum(exceed) >=
+                                  SEQUENTIAL_EXCEEDANCES)
+            if len(hits):
+                m += hits[0] + 1
+                k = SEQUENTIAL_EXCEEDANCES
+                pval = (1.0*k) / m
+                break
+
+        k += np.sum(exceed)
+        m += size
+
+        if sequential and alpha is not None:
+            upper = stats.beta.ppf(1-delta, k+1, m-k)
+            if upper < alpha:
+                pval = upper
+                break
+
+    if pval is None:
+        pval = max((1.0*k) / m, 1.0/num_samples)
+
+    if sequential:
+        logging.debug('Monte-Carlo test stopped after %d samples', m)
+
+    if full_output:
+        return pval, m
+    return pval
+
+
+def sample_tables(data, num_samples, rng=None):
+    """
+    Draws random contingency tables with the same margins as a given table,
+    as obtained by randomly permuting the column labels of the data.
+
+    Parameters
+    ----------
+    data :
+        the contingency table
+
+    num_samples :
+        the number of tables to draw
+
+    rng :
+        the random number generator (a numpy Generator or RandomState), or
+        None for numpy's global random state
+
+    Returns
+    -------
+    tables :
+        an array of `num_samples' contingency tables
+    """
+    data = np.array(data, dtype=int)
+    (rows, cols) = data.shape
+    row_sums = data.sum(axis=1)
 
-    pval = (1.0*k) / num_samples
-    return max(pval, 1.0/num_samples)
+    tables = np.zeros((num_samples, rows, cols), dtype=int)
 
+    # column counts that are still available
+    cols_left = np.tile(data.sum(axis=0), (num_samples, 1))
 
-def permutation_test_ct(data, num_samples=100000):
+    # fill the table row by row, drawing each row's counts without
+    # replacement from the remaining column counts
+    for i in range(rows - 1):
+        row_left = np.repeat(row_sums[i], num_samples)
+        for j in range(cols - 1):
+            others = cols_left[:, j+1:].sum(axis=1)
+            draw = _hypergeometric(cols_left[:, j], others, row_left, rng)
+            tables[:, i, j] = draw
+            row_left = row_left - draw
+        tables[:, i, cols - 1] = row_left
+        cols_left -= tables[:, i, :]
+
+    tables[:, rows - 1, :] = cols_left
+    return tables
+
+
+def xlogx(data):
+    """
+    Element-wise x*log(x), with 0*log(0) = 0.
+
+    For integer arrays, the values of counts below `XLOGX_TABLE_SIZE' are
+    read from a precomputed table rather than computed.
+
+    Parameters
+    ----------
+    data :
+        an array of non-negative values
+
+    Returns
+    -------
+    values :
+        the array of x*log(x) values
+    """
+    data = np.asarray(data)
+    if data.dtype.kind not in 'iu':
+        data = data.astype(float)
+        return data * np.log(np.where(data > 0, data, 1))
+
+    table = xlogx_table()
+    if data.size and data.max() < len(table):
+        return table[data]
+
+    inside = data < len(table)
+    values = data.astype(float)
+    return np.where(inside, table[np.where(inside, data, 0)],
+                    values * np.log(np.where(values > 0, values, 1)))
+
+
+def xlogx_table():
+    """
+    The table of x*log(x) values of the integers below `XLOGX_TABLE_SIZE',
+    shared by all calls to `xlogx'
+
+    Returns
+    -------
+    table :
+        the array of x*log(x) for x = 0, ..., XLOGX_TABLE_SIZE-1
+    """
+    global _xlogx_table
+    if len(_xlogx_table) != XLOGX_TABLE_SIZE:
+        _xlogx_table = xlogx(np.arange(XLOGX_TABLE_SIZE, dtype=float))
+    return _xlogx_table
+
+
+def as_counts(data):
+    """
+    Converts a table of integer counts stored as floats to an integer array
+
+    Parameters
+    ----------
+    data :
+        an array of non-negative values
+
+    Returns
+    -------
+    counts :
+        the data as an integer array, or None if some values are not
+        integers
+    """
+    data = np.asarray(data)
+    if data.dtype.kind in 'iu':
+        return data
+    counts = data.astype(np.int64)
+    if not np.array_equal(counts, data):
+        return None
+    return counts
+
+
+def _hypergeometric(ngood, nbad, nsample, rng=None):
+    """
+    Vectorized hypergeometric draws that allow empty samples
+    """
+    rng = np.random if rng is None else rng
+    empty = nsample == 0
+    draw = rng.hypergeometric(np.where(empty, 1, ngood), nbad,
+                              np.where(empty, 1, nsample))
+    return np.where(empty, 0, draw)
+
+
+def _batches(num_samples, batch_size):
+    """
+    Split a number of samples into batches
+    """
+    for start in range(0, num_samples, batch_size):
+        yield min(batch_size, num_samples - start)
+
+
+def _growing_batches(num_samples, batch_size, first):
+    """
+    Split a number of samples into batches of doubling size
+    """
+    start = 0
+    size = min(first, batch_size)
+    while start < num_samples:
+        yield min(size, num_samples - start)
+        start += size
+        size = min(2*size, batch_size)
+
+
+def permutation_test_ct(data, num_samples=100000, sequential=False,
+                        alpha=None, full_output=False, rng=None):
     """
     Monte-Carlo permutation test for a contingency table.
-    Uses the chi square statistic.
+    Uses the mutual information statistic.
 
     Parameters
     ----------
@@ -131,40 +495,359 @@ def permutation_test_ct(data, num_samples=100000):
         the contingency table
 
     num_samples :
-        the number of random permutations to perform
+        the (maximal) number of random permutations to perform
+
+    sequential :
+        whether to stop early once the p-value is settled (see
+        `monte_carlo_pval')
+
+    alpha :
+        the significance level the p-value is compared to, for early stopping
+
+    full_output :
+        whether to also return the number of permutations performed
+
+    rng :
+        the random number generator (a numpy Generator or RandomState), or
+        None for numpy's global random state
 
     Returns
     -------
     pval :
         the p-value
 
-    Notes
-    -----
-    Uses the R 'coin' package that can directly handle contingency
-    tables instead of having to convert into arrays x,y
+    num_samples :
+        the number of permutations performed, if `full_output' is set
 
     References
     ----------
     https://en.wikipedia.org/wiki/Resampling_(statistics)
     """
+    data = _trim_ct(data)
+    if data is None:
+        return (1, 0) if full_output else 1
+
+    return permutation_test_ct2(data, num_samples=num_samples,
+                                sequential=sequential, alpha=alpha,
+                                full_output=full_output, rng=rng)
+
+
+def exact_test_ct(data, max_size=5000000, alpha=None, full_output=False,
+                  rng=None):
+    """
+    Exact conditional test of independence for a contingency table.
+
+    The p-value is the probability, over all tables with the same margins as
+    the observed table, of a mutual information at least as large as the
+    observed one. This is the test that `permutation_test_ct' approximates,
+    computed without Monte-Carlo noise.
+
+    2x2 tables are handled by summing over the hypergeometric distribution
+    of the first cell. Larger tables are handled with the network algorithm
+    of Mehta and Patel: the table is filled one column at a time, tables
+    with the same remaining row sums are merged into a single node, and
+    paths through a node with the same partial statistic are merged. Paths
+    whose completions are all (or none) at least as extreme as the observed
+    table are resolved from bounds on the statistic of the remaining
+    columns, without being followed further. With two columns left, the
+    completions of a node are sorted by statistic, and each path through the
+    node is resolved with a binary search.
+
+    Parameters
+    ----------
+    data :
+        the contingency table
+
+    max_size :
+        the maximal number of arcs to follow at any stage of the network.
+        The number of arcs of a stage is counted before following them, and
+        larger networks fall back to a sequential Monte-Carlo permutation
+        test
+
+    alpha :
+        the significance level used for early stopping by the Monte-Carlo
+        fall-back
+
+    full_output :
+        whether to also return the number of permutations performed by the
+        Monte-Carlo fall-back
+
+    rng :
+        the random number generator (a numpy Generator or RandomState), or
+        None for numpy's global random state
+
+    Returns
+    -------
+    pval :
+        the p-value
+
+    num_samples :
+        the number of permutations performed (0 if the p-value is exact), if
+        `full_output' is set
+
+    References
+    ----------
+    Mehta, C. R., & Patel, N. R. (1983). A network algorithm for performing
+    Fisher's exact test in r x c contingency tables. Journal of the American
+    Statistical Association, 78(382), 427-434.
+
+    https://en.wikipedia.org/wiki/Fisher%27s_exact_test
+    """
+    data = _trim_ct(data)
+    if data is None:
+        return (1, 0) if full_output else 1
+
+    # with fixed margins, the mutual information of a table only depends on
+    # the sum of n*log(n) over all cells
+    stat_0 = xlogx(data).sum()
+    threshold = stat_0 - 1e-7 * max(1.0, abs(stat_0))
+
+    if data.shape == (2, 2):
+        pval = _exact_test_2x2(data, threshold)
+    else:
+        pval = _network_test(data, threshold, max_size)
+
+    if pval is None:
+        logging.debug('Network too large for exact test of size %d',
+                      data.sum())
+        return permutation_test_ct(data, sequential=True, alpha=alpha,
+                                   full_output=full_output, rng=rng)
+    return (pval, 0) if full_output else pval
+
+
+def _trim_ct(data):
+    """
+    Removes empty rows and columns from a contingency table, or returns None
+    if the table has less than two non-empty rows or columns
+    """
     if not isinstance(data, pd.DataFrame):
         data = pd.DataFrame(data)
     data = data[data.columns[(data != 0).any()]]
     data = data[(data.T != 0).any()]
 
-    # print 'permutation test of size {}'.format(data.sum())
-
     data = np.array(data, dtype='int')
     if len(data.shape) != 2:
-        return 1
+        return None
     if data.shape[0] < 2 or data.shape[1] < 2:
-        return 1
+        return None
+    return data
+
+
+def _exact_test_2x2(data, threshold):
+    """
+    Exact test for a 2x2 table, over the hypergeometric support of the
+    first cell
+    """
+    (r_0, r_1) = data.sum(axis=1)
+    (c_0, _) = data.sum(axis=0)
+    n = r_0 + r_1
+    a = np.arange(max(0, c_0 - r_1), min(r_0, c_0) + 1)
+    tables = np.array([a, r_0 - a, c_0 - a, r_1 - c_0 + a])
+
+    log_f = log_factorials(n)
+    log_pmf = log_f[r_0] + log_f[r_1] + log_f[c_0] + log_f[n - c_0] - \
+        log_f[n] - log_f[tables].sum(axis=0)
 
-    ch, pval = stats.chisquare(data, axis=None)
-    return max(pval, 1.0/num_samples)
+    extreme = xlogx(tables).sum(axis=0) >= threshold
+    return min(1.0, np.exp(log_pmf[extreme]).sum())
 
 
-def permutation_test_corr(x, y, num_samples=10000):
+def _network_test(data, threshold, max_size):
+    """
+    Network algorithm for the exact test of an r x c table. Returns None if
+    more than `max_size' arcs have to be followed at some stage, before
+    following them
+    """
+    # the network is smaller with few rows and large columns first
+    if data.shape[0] > data.shape[1]:
+        data = data.T
+    cols = sorted(data.sum(axis=0), reverse=True)
+    last = len(cols) - 2
+
+    log_f = log_factorials(data.sum())
+    f = xlogx(np.arange(data.sum() + 2))
+
+    # nodes are sorted by a single integer key, if it does not overflow
+    codes = None
+    if data.shape[0] * np.log2(data.sum() + 1) < 62:
+        codes = (data.sum() + 1) ** np.arange(data.shape[0])[::-1]
+
+    def arcs(node, col):
+        # fills of a column from a node, with their statistic and
+        # probability
+        fills = _column_fills(node, col)
+        log_norm = log_f[node.sum()] - log_f[col] - log_f[node.sum() - col]
+        probas = np.exp((log_f[node] - log_f[fills] -
+                         log_f[node - fills]).sum(axis=1) - log_norm)
+        return fills, f[fills].sum(axis=1), probas
+
+    def min_split(total, parts):
+        # smallest sum of x*log(x) over `parts' values summing to `total'
+        (q, rem) = np.divmod(total, parts)
+        return rem * f[q + 1] + (parts - rem) * f[q]
+
+    # the paths of the current stage: remaining row sums (in sorted order)
+    # of the node the path leads to, partial statistic and probability.
+    # Paths are sorted by node
+    nodes = np.sort(data.sum(axis=1))[np.newaxis]
+    pasts = np.zeros(1)
+    probas = np.ones(1)
+
+    pval = 0.0
+    for (k, col) in enumerate(cols[:last+1]):
+        # bounds on the statistic of the columns left to fill, obtained by
+        # relaxing either the row or the column margins
+        parts = np.maximum((nodes > 0).sum(axis=1), 1)
+        low = np.maximum(
+            sum(min_split(c, parts) for c in cols[k:]),
+            min_split(nodes, len(cols) - k).sum(axis=1))
+        high = np.minimum(f[cols[k:]].sum(), f[nodes].sum(axis=1))
+
+        # resolve the paths whose completions are all or none extreme
+        extreme = pasts + low >= threshold
+        pval += probas[extreme].sum()
+        undecided = ~extreme & (pasts + high >= threshold)
+        (nodes, pasts, probas) = (nodes[undecided], pasts[undecided],
+                                  probas[undecided])
+        if not len(pasts):
+            break
+
+        # the number of arcs to follow out of each node, if there are not
+        # too many. With two columns left, the completions of a node are
+        # given by the fills of its next column, and are shared by all the
+        # paths through the node
+        groups = _node_groups(nodes)
+        sizes = _count_fills(nodes[[paths.start for paths in groups]], col)
+        if k < last:
+            sizes *= [paths.stop - paths.start for paths in groups]
+        if sizes.sum() > max_size:
+            return None
+
+        if k == last:
+            # the completions are sorted by statistic, so that the paths
+            # through a node are resolved with a binary search
+            for paths in groups:
+                node = nodes[paths.start]
+                (fills, stats, fill_probas) = arcs(node, col)
+                stats = stats + f[node - fills].sum(axis=1)
+
+                order = np.argsort(stats)
+                tails = np.append(np.cumsum(fill_probas[order][::-1])[::-1],
+                                  0)
+                idx = np.searchsorted(stats[order], threshold - pasts[paths])
+                pval += np.dot(probas[paths], tails[idx])
+            break
+
+        # follow all arcs out of each node
+        children = []
+        for paths in groups:
+            node = nodes[paths.start]
+            (fills, arc_stats, arc_probas) = arcs(node, col)
+            children.append((
+                np.repeat(np.sort(node - fills, axis=1),
+                          paths.stop - paths.start, axis=0),
+                (arc_stats[:, np.newaxis] + pasts[paths]).ravel(),
+                (arc_probas[:, np.newaxis] * probas[paths]).ravel()))
+
+        # merge the paths reaching a node with the same partial statistic,
+        # leaving them sorted by node
+        nodes = np.concatenate([c[0] for c in children])
+        pasts = np.round(np.concatenate([c[1] for c in children]), 9)
+        probas = np.concatenate([c[2] for c in children])
+        if codes is None:
+            order = np.lexsort((pasts,) + tuple(nodes.T[::-1]))
+        else:
+            order = np.lexsort((pasts, nodes.dot(codes)))
+        (nodes, pasts, probas) = (nodes[order], pasts[order], probas[order])
+        new = np.ones(len(pasts), dtype=bool)
+        new[1:] = (nodes[1:] != nodes[:-1]).any(axis=1) | \
+            (pasts[1:] != pasts[:-1])
+        probas = np.bincount(np.cumsum(new) - 1, weights=probas)
+        (nodes, pasts) = (nodes[new], pasts[new])
+
+    return min(1.0, pval)
+
+
+def _node_groups(nodes):
+    """
+    Slices of the runs of paths leading to the same node, for paths sorted
+    by node
+    """
+    new = np.ones(len(nodes), dtype=bool)
+    new[1:] = (nodes[1:] != nodes[:-1]).any(axis=1)
+    bounds = np.append(np.flatnonzero(new), len(nodes))
+    return [slice(start, end) for (start, end) in zip(bounds[:-1],
+                                                       bounds[1:])]
+
+
+def _count_fills(nodes, total):
+    """
+    Number of ways of splitting `total' over rows of given capacities, for
+    each row of `nodes', by inclusion-exclusion over the rows filled beyond
+    their capacity
+    """
+    nodes = np.atleast_2d(nodes)
+    r = nodes.shape[1]
+    counts = np.zeros(len(nodes))
+    for over in itertools.product([0, 1], repeat=r):
+        left = total - np.dot(nodes + 1, over)
+        # number of splits of `left' over r rows without capacities
+        splits = np.ones(len(nodes))
+        for j in range(1, r):
+            splits *= (left + j) / float(j)
+        counts += (-1) ** sum(over) * np.where(left >= 0, splits, 0)
+    return np.round(counts)
+
+
+def _column_fills(rows, total):
+    """
+    All ways of splitting `total' over rows of given capacities, as an array
+    with one row per split
+    """
+    fills = np.zeros((1, 0), dtype=int)
+    left = np.array([total])
+    for (i, cap) in enumerate(rows):
+        rest = rows[i+1:].sum()
+        low = np.maximum(0, left - rest)
+        high = np.minimum(cap, left)
+        counts = high - low + 1
+        idx = np.repeat(np.arange(len(fills)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) -
+                                                      counts, counts)
+        values = low[idx] + offsets
+        fills = np.column_stack((fills[idx], values))
+        left = left[idx] - values
+    return fills
+
+
+# cached log-factorials, see `log_factorials'
+_LOG_FACTORIALS = np.zeros(1)
+
+
+def log_factorials(n):
+    """
+    Table of log(k!) for k = 0, ..., n, cached across calls.
+
+    Parameters
+    ----------
+    n :
+        the largest integer in the table
+
+    Returns
+    -------
+    log_f :
+        an array of size at least n+1 with log_f[k] = log(k!)
+    """
+    global _LOG_FACTORIALS
+    if len(_LOG_FACTORIALS) <= n:
+        size = max(n + 1, 2 * len(_LOG_FACTORIALS))
+        _LOG_FACTORIALS = special.gammaln(np.arange(size) + 1.0)
+    return _LOG_FACTORIALS
+
+
+def permutation_test_corr(x, y, num_samples=10000, batch_size=100,
+                          sequential=False, alpha=None, full_output=False,
+                          rng=None):
     """
     Monte-Carlo permutation test for correlation
 
@@ -177,34 +860,66 @@ def permutation_test_corr(x, y, num_samples=10000):
         Values for the second dimension
 
     num_samples :
-        the number of random permutations to perform
+        the (maximal) number of random permutations to perform
+
+    batch_size :
+        the number of permutations performed at once
+
+    sequential :
+        whether to stop early once the p-value is settled (see
+        `monte_carlo_pval')
+
+    alpha :
+        the significance level the p-value is compared to, for early stopping
+
+    full_output :
+        whether to also return the number of permutations performed
+
+    rng :
+        the random number generator (a numpy Generator or RandomState), or
+        None for numpy's global random state
 
     Returns
     -------
     pval :
         the p-value
 
+    num_samples :
+        the number of permutations performed, if `full_output' is set
+
     References
     ----------
     https://en.wikipedia.org/wiki/Resampling_(statistics)
     """
+    rng = np.random if rng is None else rng
     x = np.array(x, dtype='float')
     y = np.array(y, dtype='float')
 
-    obs_0, _ = stats.pearsonr(x, y)
-    k = 0
-    z = np.concatenate([x, y])
-    for _ in range(num_samples):
-        np.random.shuffle(z)
-        k += abs(obs_0) < abs(stats.pearsonr(z[:len(x)], z[len(x):])[0])
-    pval = (1.0*k) / num_samples
-    return max(pval, 1.0/num_samples)
+    # the correlation only depends on the permutation through sum(x*y)
+    x = x - x.mean()
+    obs_0 = abs(np.dot(x, y))
+    tol = 1e-9 * max(1.0, obs_0)
 
+    def exceedances(size):
+        # permute `y' independently for each sample
+        perms = np.argsort(rng.random((size, len(y))), axis=1)
+        return np.abs(np.dot(y[perms], x)) >= obs_0 - tol
 
-def permutation_test_ct_cond(data, stat, num_samples=10000):
+    return monte_carlo_pval(exceedances, num_samples, batch_size,
+                            sequential=sequential, alpha=alpha,
+                            full_output=full_output)
+
+
+def permutation_test_ct_cond(data, stat, num_samples=10000, batch_size=1000,
+                             vectorized=False, sequential=False, alpha=None,
+                             full_output=False, rng=None):
     """
     Monte-Carlo permutation test for a 3-way contingency table
 
+    The labels are permuted independently within each sub-group. Permuted
+    tables are drawn directly from the multivariate hypergeometric
+    distribution of each sub-group, in batches.
+
     Parameters
     ----------
     data :
@@ -214,47 +929,62 @@ def permutation_test_ct_cond(data, stat, num_samples=10000):
         the statistic to apply to each permuted table
 
     num_samples :
-        the number of random permutations to perform
+        the (maximal) number of random permutations to perform
+
+    batch_size :
+        the number of permuted tables generated at once
+
+    vectorized :
+        whether `stat' takes a whole batch of 3-way tables (an array of
+        shape (batch_size, groups, rows, cols)) and returns an array of
+        statistics
+
+    sequential :
+        whether to stop early once the p-value is settled (see
+        `monte_carlo_pval')
+
+    alpha :
+        the significance level the p-value is compared to, for early stopping
+
+    full_output :
+        whether to also return the number of permutations performed
+
+    rng :
+        the random number generator (a numpy Generator or RandomState), or
+        None for numpy's global random state
 
     Returns
     -------
     pval :
         the p-value
 
+    num_samples :
+        the number of permutations performed, if `full_output' is set
+
     References
     ----------
     https://en.wikipedia.org/wiki/Resampling_(statistics)
     """
     data = np.array([ct.values if isinstance(ct, pd.DataFrame)
-                     else ct for ct in data])
-
-    dim = data.shape
-    data_x = [[] for _ in data]
-    data_y = [[] for _ in data]
-    stat_0 = stat(data)
+                     else ct for ct in data], dtype=int)
 
-    # convert the table into an array of data points
-    for e in range(0, dim[0]):
-        for x in range(0, dim[1]):
-            for y in range(0, dim[2]):
-                data_x[e] += [x]*data[e, x, y]
-                data_y[e] += [y]*data[e, x, y]
+    if vectorized:
+        stat_0 = stat(data[np.newaxis])[0]
+    else:
+        stat_0 = stat(data)
+    tol = 1e-9 * max(1.0, abs(stat_0))
 
-    k = 0
-    for _ in range(num_samples):
-        temp = np.zeros(dim)
+    def exceedances(size):
         # permute each sub-group individually
-        for e in range(0, dim[0]):
-            np.random.shuffle(data_x[e])
-
-            # re-form a contingency table
-            counter = Counter(zip(data_x[e], data_y[e]))
-            for x in range(0, dim[1]):
-                for y in range(0, dim[2]):
-                    temp[e, x, y] = counter.get((x, y), 0)
-
-        temp_stat = stat(temp)
-        k += stat_0 < temp_stat
-
-    pval = (1.0*k) / num_samples
-    return max(pval, 1.0/num_samples)
+        tables = np.stack([sample_tables(ct, size, rng=rng) for ct in data],
+                          axis=1)
+
+        if vectorized:
+            temp_stats = stat(tables)
+        else:
+            temp_stats = np.array([stat(ct) for ct in tables])
+        return temp_stats >= stat_0 - tol
+
+    return monte_carlo_pval(exceedances, num_samples, batch_size,
+                            sequential=sequential, alpha=alpha,
+                            full_output=full_output)
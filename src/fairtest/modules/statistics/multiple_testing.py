@@ -4,11 +4,16 @@ Run multiple hypothesis tests
 import pandas as pd
 import numpy as np
 from statsmodels.sandbox.stats.multicomp import multipletests
+from fairtest.modules.metrics.metric import Metric
+from fairtest.modules.metrics.correlation import float_array, \
+    centered_moments, raw_moments
+import fairtest.modules.statistics.cost_model as cost_model
 import logging
 import multiprocessing
 
 
-def compute_all_stats(investigations, exact=True, conf=0.95, correct=True):
+def compute_all_stats(investigations, exact=True, conf=0.95, correct=True,
+                      n_jobs=1, time_budget=None):
     """
     Compute all statistics for all investigations and protected features
 
@@ -22,17 +27,92 @@ def compute_all_stats(investigations, exact=True, conf=0.95, correct=True):
 
     conf :
         overall confidence level (1-familywise error rate)
+
+    correct :
+        whether the p-values and confidence levels are corrected for
+        multiple testing
+
+    n_jobs :
+        the number of worker processes computing statistics (-1 for one
+        per CPU)
+
+    time_budget :
+        if set (in seconds) and exact tests are requested, exact tests are
+        only used for the contexts chosen by `cost_model.plan' so that the
+        estimated runtime fits within the budget. Asymptotic methods are used
+        for the others
     """
 
     # reserve the same "confidence budget" for each investigation, independently
     # of the number of hypotheses tested in each
     adj_conf = 1-(1-conf)/len(investigations) if correct else conf
 
-    for inv in investigations:
-        inv.stats = compute_investigation_stats(inv, exact, adj_conf, correct)
+    if exact and time_budget is not None:
+        exact = _plan_exact(investigations, adj_conf, correct, n_jobs,
+                            time_budget)
+    else:
+        exact = [exact]*len(investigations)
+
+    for (inv, inv_exact) in zip(investigations, exact):
+        inv.stats = compute_investigation_stats(inv, inv_exact, adj_conf,
+                                                correct, n_jobs)
+
+
+def _plan_exact(investigations, conf, correct, n_jobs, time_budget):
+    """
+    Chooses the contexts of all investigations that use exact statistics,
+    within a time budget
+
+    Parameters
+    ----------
+    investigations :
+        list of investigations
+
+    conf :
+        confidence level of each investigation
+
+    correct :
+        whether the confidence levels are corrected for multiple testing
+
+    n_jobs :
+        the number of worker processes computing statistics (-1 for one
+        per CPU)
 
+    time_budget :
+        the time budget, in seconds
 
-def compute_investigation_stats(inv, exact=True, conf=0.95, correct=True):
+    Returns
+    -------
+    exact :
+        for each investigation, a dictionary mapping each protected feature
+        to a list of booleans, one per context
+    """
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+
+    keys = []
+    metrics = []
+    data = []
+    confs = []
+    for (idx, inv) in enumerate(investigations):
+        adj_conf = 1-(1-conf)/num_hypotheses(inv) if correct else conf
+        for (sens, contexts) in inv.contexts.items():
+            for c in contexts:
+                keys.append((idx, sens))
+                metrics.append(c.metric)
+                data.append(c.data)
+                confs.append(adj_conf)
+
+    exact = [{sens: [] for sens in inv.contexts} for inv in investigations]
+    for ((idx, sens), c_exact) in zip(keys, cost_model.plan(
+            metrics, data, confs, time_budget, n_jobs)):
+        exact[idx][sens].append(c_exact)
+
+    return exact
+
+
+def compute_investigation_stats(inv, exact=True, conf=0.95, correct=True,
+                                n_jobs=1):
     """
     Compute all statistics for all protected features of an investigation
 
@@ -42,15 +122,25 @@ def compute_investigation_stats(inv, exact=True, conf=0.95, correct=True):
         the investigation
 
     exact :
-        whether exact tests should be used
+        whether exact tests should be used, or a dictionary mapping each
+        protected feature to a list of booleans, one per context
 
     conf :
         overall confidence level (1- familywise error rate)
 
+    correct :
+        whether the p-values and confidence levels are corrected for
+        multiple testing
+
+    n_jobs :
+        the number of worker processes computing statistics (-1 for one
+        per CPU)
+
     Returns
     -------
     all_stats:
-        list of all statistics for the investigation
+        a dictionary mapping each protected feature to the list of
+        (corrected) statistics of its contexts (see `from_records')
     """
 
     # count the number of hypotheses to test
@@ -62,49 +152,146 @@ def compute_investigation_stats(inv, exact=True, conf=0.95, correct=True):
     #
     adj_conf = 1-(1-conf)/total_hypotheses if correct else conf
 
-    # statistics for all investigations
-    all_stats = {sens: compute_stats(ctxts, exact, adj_conf, inv.random_state)
-                 for (sens, ctxts) in sorted(inv.contexts.items())}
+    # statistics for all investigations, with independent random streams for
+    # each protected feature
+    sens_contexts = sorted(inv.contexts.items())
+    seeds = np.random.SeedSequence(inv.random_state).spawn(len(sens_contexts))
+    if not isinstance(exact, dict):
+        exact = {sens: exact for sens in inv.contexts}
+    all_stats = [compute_stats(ctxts, exact[sens], adj_conf, seed,
+                               n_jobs)['stats']
+                 for ((sens, ctxts), seed) in zip(sens_contexts, seeds)]
 
-    # flattened array of all p-values
-    all_pvals = [max(stat[-1], 1e-180)
-                 for sens_stats in all_stats.values()
-                 for stat in sens_stats['stats']]
+    # all hypotheses of the investigation in a single record array
+    records = [to_records(sens_stats) for sens_stats in all_stats]
+    all_records = np.concatenate(records)
 
     # correct p-values
+    pvals = np.maximum(all_records['pval'], 1e-180)
     if correct:
-        pvals_corr = multipletests(all_pvals, alpha=1-conf,  method='holm')[1]
-    else:
-        pvals_corr = all_pvals
-
-    # replace p-values by their corrected value
-    idx = 0
-
-    # iterate over all protected features for the investigation
-    for (sens, sens_contexts) in inv.contexts.items():
-        sens_stats = all_stats[sens]['stats']
-        # iterate over all contexts for a protected feature
-        for i in range(len(sens_stats)):
-            old_stats = sens_stats[i]
-            all_stats[sens]['stats'][i] = \
-                np.append(old_stats[0:-1], pvals_corr[idx])
-            idx += 1
-
-    for (sens, sens_contexts) in inv.contexts.items():
-        metric = sens_contexts[0].metric
-        # For regression, re-form the dataframes for each context
-        if isinstance(metric.stats, pd.DataFrame):
-            res = all_stats[sens]
-            res = pd.DataFrame(res['stats'], index=res['index'],
-                               columns=res['cols'])
-            all_stats[sens] = \
-                {'stats':
-                     np.array_split(res, len(res)/len(metric.stats))}
-
-    all_stats = {sens: sens_stats['stats']
-                 for (sens, sens_stats) in all_stats.items()}
-
-    return all_stats
+        pvals = multipletests(pvals, alpha=1-conf, method='holm')[1]
+    all_records['pval'] = pvals
+
+    # split the corrected records back by protected feature and context
+    splits = np.cumsum([len(sens_records) for sens_records in records])[:-1]
+    return {sens: from_records(sens_records, type(ctxts[0].metric))
+            for ((sens, ctxts), sens_records)
+            in zip(sens_contexts, np.split(all_records, splits))}
+
+
+# record of a single hypothesis: the index of its context, the index of the
+# hypothesis in the context (e.g., a sub-group of a conditional metric or a
+# label of a regression metric), and its statistics
+STATS_DTYPE = np.dtype([('context', np.intp), ('hypothesis', np.intp),
+                        ('ci_low', float), ('ci_high', float),
+                        ('pval', float)])
+
+
+def to_records(stats):
+    """
+    Converts the statistics of a list of contexts to a record array, with
+    one record per tested hypothesis
+
+    Parameters
+    ----------
+    stats :
+        the statistics of each context, as computed by a metric. Either a
+        triple (ci_low, ci_high, pval), a 2D array with one such row per
+        hypothesis, or a record array of the statistics of labels
+        (regression, see `regression.LABEL_STATS_DTYPE')
+
+    Returns
+    -------
+    records :
+        a record array of type `STATS_DTYPE'
+    """
+    hypotheses = []
+    values = []
+    for c_stats in stats:
+        if getattr(c_stats, 'dtype', None) is not None and \
+                c_stats.dtype.names is not None:
+            hypotheses.append(np.asarray(c_stats['label'], dtype=np.intp))
+            values.append(np.column_stack([c_stats['ci_low'],
+                                           c_stats['ci_high'],
+                                           c_stats['pval']]))
+        else:
+            c_values = np.atleast_2d(np.asarray(c_stats, dtype=float))
+            hypotheses.append(np.arange(len(c_values)))
+            values.append(c_values)
+    sizes = [len(c_values) for c_values in values]
+
+    records = np.empty(sum(sizes), dtype=STATS_DTYPE)
+    if not sizes:
+        return records
+
+    records['context'] = np.repeat(np.arange(len(sizes)), sizes)
+    records['hypothesis'] = np.concatenate(hypotheses)
+    values = np.concatenate(values)
+    for (i, col) in enumerate(['ci_low', 'ci_high', 'pval']):
+        records[col] = values[:, i]
+    return records
+
+
+def from_records(records, metric_class):
+    """
+    Splits a record array back into the statistics of each context
+
+    Parameters
+    ----------
+    records :
+        a record array of type `STATS_DTYPE', sorted by context
+
+    metric_class :
+        the class of the contexts' metric
+
+    Returns
+    -------
+    stats :
+        a list with the statistics of each context: an array
+        [ci_low, ci_high, pval] for metrics testing a single hypothesis per
+        context, a 2D array with one row per hypothesis for conditional
+        metrics, and the context's records for regression metrics (see
+        `stats_frame')
+    """
+    num_contexts = records['context'][-1] + 1 if len(records) else 0
+    bounds = np.searchsorted(records['context'], np.arange(1, num_contexts))
+    stats = []
+    for c_records in np.split(records, bounds):
+        if metric_class.dataType == Metric.DATATYPE_REG:
+            stats.append(c_records)
+            continue
+        values = np.column_stack([c_records['ci_low'], c_records['ci_high'],
+                                  c_records['pval']])
+        stats.append(values[0] if len(values) == 1 else values)
+    return stats
+
+
+def stats_frame(records, index=None):
+    """
+    A DataFrame view of the records of a context, for reporting
+
+    Parameters
+    ----------
+    records :
+        a record array of type `STATS_DTYPE'
+
+    index :
+        labels of the hypotheses (e.g., the names of the output labels). If
+        None, the hypothesis indices are used
+
+    Returns
+    -------
+    stats :
+        a DataFrame with columns ci_low, ci_high and pval, indexed by
+        hypothesis
+    """
+    hypotheses = records['hypothesis']
+    if index is not None:
+        hypotheses = [index[idx] for idx in hypotheses]
+    return pd.DataFrame({col: records[col]
+                         for col in ['ci_low', 'ci_high', 'pval']},
+                        index=hypotheses,
+                        columns=['ci_low', 'ci_high', 'pval'])
 
 
 def num_hypotheses(inv):
@@ -124,7 +311,8 @@ def num_hypotheses(inv):
     tot = 0
     for contexts in inv.contexts.values():
         metric = contexts[0].metric
-        if isinstance(metric.stats, pd.DataFrame):
+        if metric.dataType == Metric.DATATYPE_REG or \
+                np.ndim(metric.stats) == 2:
             tot += len(contexts)*len(metric.stats)
         else:
             tot += len(contexts)
@@ -132,39 +320,102 @@ def num_hypotheses(inv):
     return tot
 
 
-def _wrapper(context, conf, exact, seed):
+def _wrapper(job):
     """
-    Helper, wrapper used for map_async callback
+    Helper, computes the statistics of a single context. Used as the task of
+    worker processes
 
     Parameters
     ----------
-    context :
-        a discrimination context
-
-    conf :
-        confidence level
-
-    exact :
-        whether exact statistics should be computed
-
-    seed :
-        a seed for the random number generators
+    job :
+        a tuple (index, metric, data, conf, exact, seed) with the index of
+        the context, its metric, its data (see `_compact_data'), the
+        confidence level, whether exact statistics should be computed and a
+        seed sequence for the context's random number generator
 
     Returns
     -------
-    dict :
+    index :
+        the index of the context
+
+    stats :
         discrimination statistics for the given context
+
+    num_samples :
+        the number of Monte-Carlo samples drawn by the context's tests
     """
+    (idx, metric, data, conf, exact, seed) = job
 
-    # seed the PRNGs used to compute statistics
+    # each context gets its own random stream, so that the statistics do not
+    # depend on the order in which (or the process in which) contexts are
+    # processed
     # import rpy2.robjects as ro
     # logging.info('Computing stats for context %d' % context.num)
     # ro.r('set.seed({})'.format(seed))
-    np.random.seed(seed)
-    return context.metric.compute(context.data, conf, exact=exact).stats
+    rng = np.random.default_rng(seed)
+    metric = metric.compute(data, conf, exact=exact, rng=rng)
+    return idx, metric.stats, metric.num_samples
+
 
+def _compact_data(metric, data, exact=True):
+    """
+    Converts the data of a context to plain numpy arrays, which are much
+    cheaper to send to worker processes than DataFrames
+
+    Complete correlation data that is only used for asymptotic statistics is
+    reduced to its aggregate statistics (see `Metric.shift_invariant'), for
+    metrics defined by them.
+
+    Parameters
+    ----------
+    metric :
+        the context's metric
+
+    data :
+        the context's data
+
+    exact :
+        whether exact statistics are computed for the context
+
+    Returns
+    -------
+    data :
+        the data as an array, or a list of arrays for conditional metrics.
+        Data for regression metrics is returned unchanged
+    """
+    if metric.dataType == Metric.DATATYPE_CT:
+        if isinstance(data, list):
+            return [np.asarray(ct) for ct in data]
+        return np.asarray(data)
+    elif metric.dataType == Metric.DATATYPE_CORR:
+        # the strata of conditional metrics are computed by another metric
+        sub_metric = cost_model.SUB_METRICS.get(type(metric), metric)
+        if isinstance(data, list):
+            return [_compact_corr(sub_metric, d, exact) for d in data]
+        return _compact_corr(metric, data, exact)
+    return data
+
+
+def _compact_corr(metric, data, exact):
+    """
+    Converts correlation data to an array, or to its aggregate statistics
+    (sum_x, sum_x2, sum_y, sum_y2, sum_xy, n) of the protected feature (x)
+    and target (y) if exact methods do not need the complete data
+    """
+    # single precision data is kept in single precision
+    data = float_array(data)
+    if metric.accumulator_type is None or data.shape[-1] != 2:
+        return data
+
+    size = len(data)
+    if exact and size <= max(metric.approx_LIMIT_P, metric.approx_LIMIT_CI):
+        return data
 
-def compute_stats(contexts, exact, conf, seed):
+    moments = centered_moments if metric.shift_invariant else raw_moments
+    return moments(data[:, ::-1])
+
+
+def compute_stats(contexts, exact, conf, seed, n_jobs=1):
     """
     Compute statistics for a list of contexts
 
@@ -174,49 +425,82 @@ def compute_stats(contexts, exact, conf, seed):
         a list of contexts
 
     exact :
-        whether exact statistics should be computed
+        whether exact statistics should be computed, or a list of booleans,
+        one per context
 
     conf :
         confidence level
 
     seed :
-        seed for the PRNGs used to compute statistics
+        seed (or numpy SeedSequence) for the PRNGs used to compute statistics.
+        An independent stream is spawned from it for each context
+
+    n_jobs :
+        the number of worker processes. If -1, one worker per CPU is used.
+        The statistics do not depend on the number of workers
 
     Returns
     -------
     dict :
-        a dictionary containing the computed statistics as well as index
-        information if more than one hypothesis was tested in a context
+        a dictionary containing the list of computed statistics, one entry
+        per context (see `to_records'), and the list of the numbers of
+        Monte-Carlo samples drawn by the tests of each context. Both are
+        also stored in the contexts' metrics
     """
     metric = contexts[0].metric
 
     logging.info('Computing stats for %d contexts' % len(contexts))
 
-    """
-    P = multiprocessing.Pool(multiprocessing.cpu_count())
-    results = P.map_async(_wrapper, zip(contexts, [conf]*len(contexts), [exact]*len(contexts), [seed]*len(contexts)))
-    stats = results.get()
-    P.close()
-    P.join()
-    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    seeds = seed.spawn(len(contexts))
+
+    if not isinstance(exact, list):
+        exact = [exact]*len(contexts)
+
+    jobs = [(idx, c.metric, _compact_data(c.metric, c.data, c_exact), conf,
+             c_exact, context_seed)
+            for (idx, (c, c_exact, context_seed))
+            in enumerate(zip(contexts, exact, seeds))]
+
+    # asymptotic statistics are computed at once for all contexts, if the
+    # metric supports it
+    results = []
+    if metric.approx_stats_batch is not None:
+        approx_jobs = [job for job in jobs if not job[4]]
+        jobs = [job for job in jobs if job[4]]
+        if approx_jobs:
+            batch_stats = metric.compute_batch([job[2] for job in approx_jobs],
+                                               conf, exact=False)
+            results = [(job[0], list(row[0:3]), 0)
+                       for (job, row) in zip(approx_jobs, batch_stats)]
+
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+
+    if n_jobs > 1 and len(jobs) > 1:
+        # schedule the largest contexts first, for load balancing
+        jobs.sort(key=lambda job: job[1].get_size(job[2]), reverse=True)
+
+        pool = multiprocessing.Pool(min(n_jobs, len(jobs)))
+        try:
+            results += list(pool.imap_unordered(_wrapper, jobs))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results += [_wrapper(job) for job in jobs]
 
-    stats = [_wrapper(context, conf, exact, seed) for context in contexts]
+    stats = [None]*len(contexts)
+    num_samples = [0]*len(contexts)
+    for (idx, c_stats, c_samples) in results:
+        stats[idx] = c_stats
+        num_samples[idx] = c_samples
 
-    #
-    # When calling 'map_async', the Context object is pickled
-    # (passed by value), so we have to apply the change to the stats here.
-    # There's probably a cleaner way to do this.
-    #
-    for (c, c_stats) in zip(contexts, stats):
+    # the metrics were computed on copies (in workers), so the results are
+    # stored back in the contexts' metrics here
+    for (c, c_stats, c_samples) in zip(contexts, stats, num_samples):
         c.metric.stats = c_stats
+        c.metric.num_samples = c_samples
 
-    # For regression, we have multiple p-values per context
-    # (one per topK coefficient)
-    if isinstance(metric.stats, pd.DataFrame):
-        stats = pd.concat(stats)
-        index = stats.index
-        cols = stats.columns
-        stats = stats.values
-        return {'stats': stats, 'index': index, 'cols': cols}
-
-    return {'stats': stats}
+    return {'stats': stats, 'num_samples': num_samples}